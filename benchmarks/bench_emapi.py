@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Throughput, latency and memory of EMApi against the local fake Environment Manager:
+#   python benchmarks/bench_emapi.py --calls 2000 --workers 20 --latency 0.005 --json before.json
+#   python benchmarks/bench_emapi.py --calls 2000 --workers 20 --latency 0.005 --baseline before.json
+
+import argparse
+import gc
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+import simplejson
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from environment_manager import EMApi
+from tests.fake_server import FakeEMServer
+
+try:
+    import asyncio
+    from environment_manager.aio import AsyncEMApi, aiohttp
+except (ImportError, SyntaxError):
+    aiohttp = None
+
+SCENARIOS = ('sequential', 'batch', 'concurrent', 'async')
+
+def _serve(connection, settings):
+    server = FakeEMServer(**settings)
+    connection.send(server.url)
+    server.serve_forever()
+
+def start_server(settings, in_process=False):
+    """ Start a fake server and return (url, stop function). A separate process keeps it from competing with the client for the GIL """
+    if in_process:
+        server = FakeEMServer(**settings).start()
+        return server.url, server.stop
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(child, settings))
+    process.daemon = True
+    process.start()
+    url = parent.recv()
+    return url, process.terminate
+
+def call_mix(count, items):
+    """ count (method, kwargs) calls cycling through the read endpoints a deployment pipeline hits most """
+    calls = []
+    for number in range(count):
+        index = number % items
+        environment, service = 'env%02d' % index, 'service%02d' % index
+        kind = number % 4
+        if kind == 0:
+            calls.append(('get_asg_ready', {'environment': environment, 'asgname': '%s-%s' % (environment, service)}))
+        elif kind == 1:
+            calls.append(('get_service_overall_health', {'service': service, 'environment': environment}))
+        elif kind == 2:
+            calls.append(('get_deployment', {'deployment_id': str(uuid.UUID(int=index + 1))}))
+        else:
+            calls.append(('get_environment', {'environment': environment}))
+    return calls
+
+class Recorder(object):
+    """ Per-call latencies and errors of a run """
+
+    def __init__(self):
+        # list.append is atomic, so worker threads can record without a lock
+        self.latencies = []
+        self.errors = []
+
+    def timed(self, function):
+        def call(**kwargs):
+            start = time.time()
+            try:
+                return function(**kwargs)
+            except Exception as error:
+                self.errors.append(type(error).__name__)
+                raise
+            finally:
+                self.latencies.append(time.time() - start)
+        return call
+
+def run_sequential(client, calls, recorder, workers):
+    for method, kwargs in calls:
+        try:
+            recorder.timed(getattr(client, method))(**kwargs)
+        except Exception:
+            pass
+
+def run_batch(client, calls, recorder, workers):
+    client.batch([(recorder.timed(getattr(client, method)), kwargs) for method, kwargs in calls], max_workers=workers)
+
+def run_concurrent(client, calls, recorder, workers):
+    def worker(call):
+        try:
+            recorder.timed(getattr(client, call[0]))(**call[1])
+        except Exception:
+            pass
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(worker, calls))
+
+def run_async(url, calls, recorder, workers, client_settings):
+    async def timed(client, method, kwargs):
+        start = time.time()
+        try:
+            await getattr(client, method)(**kwargs)
+        except Exception as error:
+            recorder.errors.append(type(error).__name__)
+        finally:
+            recorder.latencies.append(time.time() - start)
+
+    async def main():
+        async with AsyncEMApi(url, 'bench', 'bench', max_concurrency=workers, **client_settings) as client:
+            await client._get_token()
+            await asyncio.gather(*[timed(client, method, kwargs) for method, kwargs in calls])
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a sorted list """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+def run_scenario(name, url, calls, workers, client_settings, trace_memory):
+    """ Run one scenario on a fresh client, returns (recorder, seconds, peak allocated bytes or None) """
+    recorder = Recorder()
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    if name == 'async':
+        run_async(url, calls, recorder, workers, client_settings)
+    else:
+        with EMApi(url, 'bench', 'bench', pool_maxsize=workers, **client_settings) as client:
+            # Authenticate before the clock matters, every scenario pays it the same
+            client._get_token()
+            start = time.time()
+            globals()['run_%s' % name](client, calls, recorder, workers)
+    seconds = time.time() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return recorder, seconds, peak
+
+def compare(results, baseline, tolerance):
+    """ Print throughput and p99 changes against a baseline, True if any scenario lost more than tolerance of its throughput """
+    regressed = False
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        throughput_change = result['calls_per_second'] / before['calls_per_second'] - 1
+        p99_change = result['p99_ms'] / before['p99_ms'] - 1 if before.get('p99_ms') else 0
+        flag = ''
+        if throughput_change < -tolerance:
+            flag = '  REGRESSION'
+            regressed = True
+        print('%-11s calls/s %+6.1f%%  p99 %+6.1f%%%s' % (name, throughput_change * 100, p99_change * 100, flag))
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark EMApi against a local fake Environment Manager')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Scenarios to run, all by default')
+    parser.add_argument('--calls', type=int, default=1000, help='Calls per scenario')
+    parser.add_argument('--workers', type=int, default=10, help='Threads, or in-flight requests for async')
+    parser.add_argument('--latency', type=float, default=0.002, help='Server side seconds per request')
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--payload-items', type=int, default=50)
+    parser.add_argument('--payload-padding', type=int, default=200)
+    parser.add_argument('--cache', action='store_true', help='Enable the client response cache')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the extra tracemalloc run measuring allocations')
+    parser.add_argument('--server', help='Benchmark an already running fake server at this URL')
+    parser.add_argument('--in-process', action='store_true', help='Run the fake server in this process')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--baseline', help='Compare with results written by --json, exits 1 on a throughput regression')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Throughput loss tolerated against the baseline, 0 to 1')
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or list(SCENARIOS)
+    if 'async' in scenarios and aiohttp is None:
+        print('Skipping async scenario, aiohttp is not installed')
+        scenarios.remove('async')
+    settings = {'latency': args.latency, 'latency_jitter': args.latency_jitter, 'error_rate': args.error_rate,
+                'payload_items': args.payload_items, 'payload_padding': args.payload_padding}
+    client_settings = {'cache': True} if args.cache else {}
+    stop = None
+    url = args.server
+    if url is None:
+        url, stop = start_server(settings, in_process=args.in_process)
+    calls = call_mix(args.calls, args.payload_items)
+    trace_memory = tracemalloc is not None and not args.no_memory
+
+    results = {}
+    print('%-11s %7s %6s %8s %9s %8s %8s %10s' % ('scenario', 'calls', 'errors', 'seconds', 'calls/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    try:
+        for name in scenarios:
+            recorder, seconds, peak = run_scenario(name, url, calls, args.workers, client_settings, False)
+            if trace_memory:
+                peak = run_scenario(name, url, calls, args.workers, client_settings, True)[2]
+            latencies = sorted(recorder.latencies)
+            result = {'calls': len(latencies), 'errors': len(recorder.errors), 'seconds': seconds,
+                      'calls_per_second': len(latencies) / seconds if seconds else 0,
+                      'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+                      'peak_kib': peak / 1024.0 if peak is not None else None}
+            results[name] = result
+            print('%-11s %7d %6d %8.2f %9.1f %8.2f %8.2f %10s' % (name, result['calls'], result['errors'], seconds,
+                                                                  result['calls_per_second'], result['p50_ms'], result['p99_ms'],
+                                                                  '%.0f' % result['peak_kib'] if peak is not None else '-'))
+    finally:
+        if stop is not None:
+            stop()
+    if resource is not None:
+        # Linux reports kilobytes, macOS bytes
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('max RSS %.1f MiB' % (max_rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            output.write(simplejson.dumps({'settings': dict(settings, calls=args.calls, workers=args.workers, cache=args.cache),
+                                           'results': results}, indent=2, sort_keys=True))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = simplejson.loads(baseline_file.read())
+        if compare(results, baseline.get('results', {}), args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
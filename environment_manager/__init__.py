@@ -1,3 +1,7 @@
 """ Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
 
+import sys
 from .api import EMApi
+
+if sys.version_info >= (3, 5):
+    from .aio import AsyncEMApi
@@ -0,0 +1,438 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import asyncio
+import copy
+import time
+from environment_manager import codec
+from environment_manager.api import EMApi, HTTP_METHODS
+from environment_manager.batch import BatchResult, resolve_call
+from environment_manager.cache import ResponseCache, affected_by_write
+from environment_manager.routes import endpoint_template
+from environment_manager.utils import LogWrapper
+
+log = LogWrapper(__name__)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+class AioResponse(object):
+    """ Fully read response, exposes the subset of requests.Response used by the client """
+
+    def __init__(self, status_code, headers, content, encoding='utf-8'):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        """ Body decoded as text """
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        """ Body decoded as JSON, raises ValueError if it isn't """
+        return codec.loads(self.content)
+
+class AioHttpTransport(object):
+    """ Pooled keep-alive HTTP transport backed by an aiohttp ClientSession """
+
+    def __init__(self, limit=100, limit_per_host=0, keep_alive=True, verify=False):
+        """ Initialise transport, limit is the total number of pooled connections and limit_per_host the cap per server (0 is unlimited) """
+        if aiohttp is None:
+            raise ImportError('AsyncEMApi needs the aiohttp package, install it with: pip install aiohttp')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keep_alive = keep_alive
+        self.verify = verify
+        self._session = None
+
+    @property
+    def session(self):
+        """ Return the underlying session, it has to be created inside a running event loop """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             force_close=not self.keep_alive,
+                                             ssl=None if self.verify else False)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def request(self, method, url, timeout=30, verify=None, **kwargs):
+        """ Send a request through the pooled session and return a fully read AioResponse, timeout is total seconds or (connect, read) """
+        if isinstance(timeout, tuple):
+            client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        else:
+            client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with self.session.request(method.upper(), url, timeout=client_timeout, **kwargs) as response:
+            content = await response.read()
+            return AioResponse(response.status, response.headers, content, response.charset)
+
+    async def close(self):
+        """ Close all pooled connections """
+        session, self._session = self._session, None
+        if session is not None:
+            await session.close()
+
+def _sync_only(name):
+    """ Stand-in for an EMApi method built on blocking calls, which AsyncEMApi can't offer """
+    def method(self, *args, **kwargs):
+        raise TypeError('%s is only available on the blocking EMApi client, not on AsyncEMApi' % name)
+    method.__name__ = name
+    method.__doc__ = 'Not available on AsyncEMApi, use EMApi.%s' % name
+    return method
+
+class AsyncEMApi(EMApi):
+    """ Asyncio flavour of EMApi, every endpoint method returns an awaitable with the same arguments and result """
+
+    def __init__(self, server=None, user=None, password=None, retries=5, default_headers={},
+                 transport=None, max_concurrency=100, limit=100, limit_per_host=0, keep_alive=True,
+                 token_refresh_margin=60, token_cache=None, cache=None,
+                 coalesce_requests=True, conditional_requests=False, retry_policy=None, circuit_breaker=None,
+                 rate_limiter=None, metrics=None, tracer=None):
+        """ Initialise new API object, max_concurrency bounds the number of in-flight requests """
+        if transport is None:
+            transport = AioHttpTransport(limit=limit, limit_per_host=limit_per_host, keep_alive=keep_alive)
+        EMApi.__init__(self, server=server, user=user, password=password, retries=retries,
+                       default_headers=default_headers, transport=transport,
+                       token_refresh_margin=token_refresh_margin, token_cache=token_cache,
+                       cache=cache, coalesce_requests=coalesce_requests,
+                       conditional_requests=conditional_requests, retry_policy=retry_policy,
+                       circuit_breaker=circuit_breaker, rate_limiter=rate_limiter,
+                       metrics=metrics, tracer=tracer)
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._auth_lock = None
+        self._in_flight = {}
+
+    @property
+    def semaphore(self):
+        """ Semaphore bounding concurrent requests, created lazily inside the event loop """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def auth_lock(self):
+        """ Lock making sure only one coroutine authenticates at a time """
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        return self._auth_lock
+
+    # Streamed and paginated reads, and the watchers polling in threads, only exist for the blocking client
+    iter_asgs = _sync_only('iter_asgs')
+    iter_audit_config = _sync_only('iter_audit_config')
+    iter_deployments = _sync_only('iter_deployments')
+    iter_export_resource = _sync_only('iter_export_resource')
+    iter_instances = _sync_only('iter_instances')
+    paginate_audit_config = _sync_only('paginate_audit_config')
+    paginate_deployments = _sync_only('paginate_deployments')
+    wait_for_deployments = _sync_only('wait_for_deployments')
+    tail_deployment_logs = _sync_only('tail_deployment_logs')
+
+    async def close(self):
+        """ Release pooled connections held by this client """
+        self.token_manager.stop()
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _api_auth(self):
+        """ Function to authenticate in Environment Manager """
+        log.debug('Authenticating in EM with user %s', self.user)
+        em_token_url = '%s/api/v1/token' % self.base_url
+        token_payload = {'username': self.user,
+                         'password': self.password}
+        with self.tracer.start_span('EM authenticate', {'em.server': self.server, 'em.user': self.user}):
+            policy = self.retry_policy.copy(max_attempts=self.retries)
+            deadline = policy.start()
+            attempt = 0
+            while attempt < policy.max_attempts and not deadline.expired():
+                attempt += 1
+                em_token = None
+                try:
+                    em_token = await self._send('POST', '/api/v1/token', attempt=attempt, url=em_token_url, data=codec.dumps_bytes(token_payload), headers=self.default_headers,
+                                                timeout=policy.timeout_for('/api/v1/token', deadline))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    log.debug('There was a problem with the connection, trying again: %s', error)
+                else:
+                    if int(str(em_token.status_code)[:1]) == 2:
+                        return 'Bearer %s' % em_token.text
+                    log.debug('Could not authenticate, trying again: %s', em_token.status_code)
+                delay = policy.delay(attempt, em_token)
+                if attempt >= policy.max_attempts or not deadline.allows(delay):
+                    break
+                await asyncio.sleep(delay)
+            raise SystemError('Could not authenticate against Environment Manager')
+
+    async def _refresh_token(self, expired_token=None):
+        """ Authenticate, or reuse a token from the shared cache, and hand it to the token manager. Caller holds auth_lock """
+        start = time.time()
+        token = None
+        # The token cache is a locked file, read and write it off the event loop
+        loop = asyncio.get_event_loop()
+        if self.token_manager.cache is not None:
+            token = await loop.run_in_executor(None, self.token_manager._from_cache, expired_token)
+        if token is None:
+            token = await self._api_auth()
+            if self.token_manager.cache is not None:
+                await loop.run_in_executor(None, self.token_manager._to_cache, token)
+        self.token_manager.set(token, time.time() - start)
+
+    async def _get_token(self):
+        """ Internal function to get a valid token, concurrent callers share a single authentication """
+        if self.token_manager.needs_refresh():
+            async with self.auth_lock:
+                if self.token_manager.needs_refresh():
+                    try:
+                        await self._refresh_token()
+                    except Exception:
+                        if self.token_manager.refresh_failed() is None:
+                            raise
+        return self.token
+
+    async def _renew_token(self, expired_token=None):
+        """ Internal function to renew a token, skipped if another coroutine already renewed it """
+        async with self.auth_lock:
+            if expired_token is None or self.token == expired_token:
+                await self._refresh_token(expired_token)
+
+    async def query(self, query_endpoint=None, data=None, headers={}, query_type='get', retries=None, backoff=None, use_cache=True, stream=False):
+        """ Function to querying Environment Manager, retries and backoff override the retry policy for this call """
+        if stream:
+            raise SyntaxError('Streamed queries are only supported by EMApi, aiohttp responses are read whole')
+        if query_endpoint is None:
+            log.info('No endpoint specified, cant just go and query nothing')
+            raise SyntaxError('No endpoint specified, cant just go and query nothing')
+        if query_type.lower() == 'post' and data is None:
+            log.info('No data specified, we need to send data with method %s', query_type)
+            raise SyntaxError('No data specified, we need to send data with method %s' % query_type)
+        if query_type.upper() not in HTTP_METHODS:
+            raise SyntaxError('Cannot process query type %s' % query_type)
+        if not self.tracer.enabled:
+            return await self._dispatch(query_endpoint, data, headers, query_type, retries, backoff, use_cache)
+        with self._query_span(query_type, query_endpoint):
+            return await self._dispatch(query_endpoint, data, headers, query_type, retries, backoff, use_cache)
+
+    async def _dispatch(self, query_endpoint, data, headers, query_type, retries, backoff, use_cache):
+        """ Serve a validated query from the cache, a coalesced identical request or Environment Manager """
+        if query_type.upper() != 'GET':
+            if self.cache is None and self.validators is None and self.single_flight is None:
+                return await self._query(query_endpoint, data, headers, query_type, retries, backoff)
+            try:
+                return await self._query(query_endpoint, data, headers, query_type, retries, backoff)
+            finally:
+                if self.cache is not None:
+                    self.cache.invalidate_for_write(query_endpoint)
+                if self.validators is not None:
+                    self.validators.invalidate_for_write(query_endpoint)
+                if self.single_flight is not None:
+                    for key in [key for key in self._in_flight if affected_by_write(key[0], query_endpoint)]:
+                        del self._in_flight[key]
+        request_key = ResponseCache.key(query_endpoint, headers if isinstance(headers, dict) else None)
+        cacheable = self.cache is not None and use_cache and self.cache.ttl_for(query_endpoint) > 0
+        if cacheable:
+            hit, result = self.cache.get(request_key)
+            if hit:
+                self.tracer.current_span().set_attribute('em.cache_hit', True)
+                return result
+            generation = self.cache.generation()
+        if self.single_flight is not None:
+            result = await self._coalesced(request_key, self._query(query_endpoint, data, headers, query_type, retries, backoff))
+        else:
+            result = await self._query(query_endpoint, data, headers, query_type, retries, backoff)
+        if cacheable:
+            self.cache.put(request_key, result, generation=generation)
+        return result
+
+    async def _coalesced(self, key, coroutine):
+        """ Await coroutine, or the identical request already in flight under key """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            coroutine.close()
+            self.single_flight.shared += 1
+            return copy.deepcopy(await asyncio.shield(in_flight))
+        task = asyncio.ensure_future(coroutine)
+        self._in_flight[key] = task
+        self.single_flight.calls += 1
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+        return copy.deepcopy(result)
+
+    async def _send(self, query_type, query_endpoint, attempt=1, **request_values):
+        """ Send a single HTTP request through the rate limiter, circuit breaker and the concurrency semaphore """
+        observed = self.hooks['pre_request'] or self.hooks['post_request']
+        if observed:
+            event = {'endpoint': query_endpoint, 'template': endpoint_template(query_endpoint),
+                     'method': query_type.upper(), 'attempt': attempt}
+            self._emit('pre_request', event)
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.reserve(query_endpoint)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        breaker = None
+        if self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.get(self.server, query_endpoint)
+            breaker.allow()
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            # Cancelled while waiting, the request was never sent
+            if breaker is not None:
+                breaker.release_probe()
+            raise
+        span = None
+        if self.tracer.enabled:
+            span = self.tracer.start_span('HTTP %s' % query_type.upper(), {'http.method': query_type.upper(), 'http.url': request_values.get('url'), 'em.attempt': attempt})
+            request_values['headers'] = self.tracer.inject(request_values.get('headers'), span)
+        success = False
+        response = None
+        error = None
+        start = time.time()
+        try:
+            response = await self.transport.request(query_type, **request_values)
+            success = response.status_code < 500 and response.status_code != 429
+            return response
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            self.semaphore.release()
+            if breaker is not None:
+                if success:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            if observed:
+                self._emit('post_request', self._response_event(event, response, error, time.time() - start))
+            if span is not None:
+                self._finish_span(span, response, error)
+
+    async def _query(self, query_endpoint, data, headers, query_type, retries, backoff):
+        """ Send a query to Environment Manager, retrying according to the retry policy and renewing expired tokens """
+        conditional = self.validators is not None and query_type.upper() == 'GET'
+        if conditional:
+            request_key = ResponseCache.key(query_endpoint, headers if isinstance(headers, dict) else None)
+        policy = self.retry_policy
+        if retries is not None or backoff is not None:
+            policy = policy.copy(max_attempts=retries, backoff_base=backoff)
+        deadline = policy.start()
+        request = None
+        revalidate = True
+        retry_num = 0
+        while retry_num < policy.max_attempts:
+            retry_num += 1
+            log.debug('Going through query iteration %s out of %s', retry_num, policy.max_attempts)
+            token = await self._get_token()
+            request_url = '%s%s' % (self.base_url, query_endpoint)
+            log.debug('Calling URL %s', request_url)
+            query_headers = self.default_headers.copy()
+            query_headers.update({'Authorization': token})
+            if isinstance(headers, dict):
+                query_headers.update(headers)
+            if conditional and revalidate:
+                query_headers.update(self.validators.request_headers(request_key))
+
+            request_values = {'url': request_url, 'headers': query_headers, 'timeout': policy.timeout_for(query_endpoint, deadline)}
+            if data is not None:
+                request_values['data'] = codec.dumps_bytes(data)
+
+            request = None
+            try:
+                request = await self._send(query_type, query_endpoint, attempt=retry_num, **request_values)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if not (policy.is_idempotent(query_type, query_endpoint) or isinstance(error, aiohttp.ClientConnectorError)):
+                    log.info('Connection problem on non idempotent %s %s, not retrying', query_type, query_endpoint)
+                    raise
+                log.debug('There was a problem with the connection, trying again')
+                delay = policy.delay(retry_num)
+                if retry_num >= policy.max_attempts or not deadline.allows(delay):
+                    break
+                await asyncio.sleep(delay)
+                continue
+            status_type = int(str(request.status_code)[:1])
+
+            if request.status_code == 304 and conditional:
+                not_modified, result = self.validators.not_modified_value(request_key)
+                if not_modified:
+                    return result
+                if revalidate:
+                    # The stored response went away since the validators were sent, ask again for the whole response
+                    log.debug('%s not modified but its stored response is gone, asking again unconditionally', query_endpoint)
+                    revalidate = False
+                    retry_num -= 1
+                    continue
+            if status_type == 2 or status_type == 3:
+                result = self._decode(request, query_endpoint, query_type, retry_num)
+                if conditional and request.status_code == 200:
+                    self.validators.store(request_key, request.headers, result, request.content)
+                return result
+            elif policy.retry_on_status(query_type, query_endpoint, request.status_code):
+                log.info('Got a status %s from EM, cant serve, retrying', request.status_code)
+                delay = policy.delay(retry_num, request)
+                if retry_num >= policy.max_attempts or not deadline.allows(delay):
+                    break
+                await asyncio.sleep(delay)
+            elif status_type == 4:
+                try:
+                    error_msg = request.json()['error']
+                except:
+                    try:
+                        error_msg = request.json()['errors']
+                    except:
+                        if request.text == 'jwt expired' or request.text == 'invalid token':
+                            log.info('Your auth token expired or is inavlid, re-authenticating and attempting request again...')
+                            await self._renew_token(token)
+                            continue
+                        elif request.text:
+                            error_msg = request.text
+                        else:
+                            error_msg = 'An unknown error occured'
+                raise ValueError(error_msg)
+            else:
+                log.info('Got a status %s from EM on non idempotent %s %s, not retrying', request.status_code, query_type, query_endpoint)
+                break
+        last_status = request.status_code if request is not None else None
+        raise SystemError('Max number of retries (%s) querying Environment Manager, last http code is %s, will abort for now' % (retry_num, last_status))
+
+    async def batch(self, calls, max_workers=10, ordered=True, stream=False):
+        """ Run a list of (method, kwargs) calls concurrently, at most max_workers at a time, and return a BatchResult
+        per call. method is an AsyncEMApi method name or a callable returning an awaitable. Results come back in input
+        order, or in completion order if ordered is False """
+        if stream:
+            raise TypeError('AsyncEMApi.batch can not stream results, use ordered=False for completion order')
+        if max_workers < 1:
+            raise ValueError('max_workers needs to be at least 1')
+        prepared = [(index, method, resolve_call(self, method), kwargs or {}) for index, (method, kwargs) in enumerate(calls)]
+        if not prepared:
+            return []
+        # Authenticate once upfront so calls share the same token
+        await self._get_token()
+        workers = asyncio.Semaphore(max_workers)
+        results = []
+
+        async def run_call(index, method, function, kwargs):
+            async with workers:
+                try:
+                    result = BatchResult(index, method, kwargs, result=await function(**kwargs))
+                except Exception as error:
+                    result = BatchResult(index, method, kwargs, error=error)
+            results.append(result)
+
+        await asyncio.gather(*[run_call(*call) for call in prepared])
+        if ordered:
+            results.sort(key=lambda result: result.index)
+        return results
+
+    async def map(self, method, kwargs_list, max_workers=10, ordered=True, stream=False):
+        """ Call the same method concurrently once per kwargs dictionary, see batch """
+        return await self.batch([(method, kwargs) for kwargs in kwargs_list], max_workers=max_workers, ordered=ordered, stream=stream)
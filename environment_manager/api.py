@@ -6,122 +6,409 @@ import requests
 import logging
 from requests.exceptions import *
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from environment_manager.utils import LogWrapper, json_encode, to_list
+from environment_manager import codec
+from environment_manager.utils import LogWrapper, to_list
+from environment_manager.transport import SessionTransport
+from environment_manager.batch import run_batch
+from environment_manager.auth import TokenManager, TokenCache
+from environment_manager.cache import ResponseCache, ValidatorStore, affected_by_write
+from environment_manager.singleflight import SingleFlight
+from environment_manager.retry import RetryPolicy
+from environment_manager.circuit import CircuitBreakers, AdaptiveLimiter
+from environment_manager.metrics import MetricsRegistry
+from environment_manager.routes import endpoint_template
+from environment_manager.tracing import NOOP_TRACER, SimpleTracer
+from environment_manager.streaming import iter_json_items, DEFAULT_CHUNK_SIZE
+from environment_manager.pagination import TimeWindowPager, deployment_key, deployment_timestamp
+from environment_manager.deployments import tail_deployment_logs, wait_for_deployments
 
 # Remove insecure request warning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+log = LogWrapper(__name__)
+
+HTTP_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS')
+HOOK_EVENTS = ('pre_request', 'post_request', 'decode')
 
 class EMApi(object):
     """Defines all api calls and treats them like an object to give proper interfacing"""
 
-    def __init__(self, server=None, user=None, password=None, retries=5, default_headers={}):
+    def __init__(self, server=None, user=None, password=None, retries=5, default_headers={},
+                 transport=None, pool_connections=10, pool_maxsize=10, keep_alive=True,
+                 token_refresh_margin=60, background_token_refresh=False, token_cache=None, cache=None,
+                 coalesce_requests=True, conditional_requests=False, retry_policy=None,
+                 circuit_breaker=None, concurrency_limiter=None, rate_limiter=None, metrics=None, tracer=None):
         """ Initialise new API object """
         self.server = server
         self.user = user
         self.password = password
         self.retries = retries
+        self.retry_policy = retry_policy or RetryPolicy()
         self.default_headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
         self.default_headers.update(default_headers)
-        self.token = None
+        # token_cache can be True for the default per-user cache file, a path, or a TokenCache
+        if token_cache is True:
+            token_cache = TokenCache()
+        elif isinstance(token_cache, str):
+            token_cache = TokenCache(token_cache)
+        elif not token_cache:
+            token_cache = None
+        self.token_manager = TokenManager(self._api_auth, refresh_margin=token_refresh_margin,
+                                          background_refresh=background_token_refresh, cache=token_cache,
+                                          cache_key=TokenCache.key(server, user))
 
         # Sanitise input
         if server is None or user is None or password is None:
             raise ValueError('EMApi(server=SERVERNAME, user=USERNAME, password=PASSWORD, [retries=N])')
         if server == '' or user == '' or password == '':
             raise ValueError('EMApi(server=SERVERNAME, user=USERNAME, password=PASSWORD, [retries=N])')
+        # server is a host name reached over HTTPS, or a full base URL such as http://127.0.0.1:8080 for a local fake server
+        self.base_url = server.rstrip('/') if '://' in server else 'https://%s' % server
+
+        # cache can be True for the default GET response cache policy, or a ResponseCache
+        if cache is True:
+            cache = ResponseCache()
+        self.cache = cache or None
+        # Identical GETs in flight at the same time share one HTTP call
+        self.single_flight = SingleFlight() if coalesce_requests else None
+        # conditional_requests can be True or a ValidatorStore, GETs are then revalidated with ETag/Last-Modified
+        if conditional_requests is True:
+            conditional_requests = ValidatorStore()
+        self.validators = conditional_requests or None
+        # circuit_breaker can be True for one breaker per server, or CircuitBreakers; concurrency_limiter True or an AdaptiveLimiter
+        if circuit_breaker is True:
+            circuit_breaker = CircuitBreakers()
+        self.circuit_breakers = circuit_breaker or None
+        if concurrency_limiter is True:
+            concurrency_limiter = AdaptiveLimiter()
+        self.concurrency_limiter = concurrency_limiter or None
+        self.rate_limiter = rate_limiter
+        self.hooks = dict((event, []) for event in HOOK_EVENTS)
+        # metrics can be True for a new MetricsRegistry, or a registry to share between clients
+        if metrics is True:
+            metrics = MetricsRegistry()
+        self.metrics = metrics.install(self) if metrics else None
+        # tracer can be True for a SimpleTracer keeping spans in memory, or any tracer; the no-op default costs nothing
+        if tracer is True:
+            tracer = SimpleTracer()
+        self.tracer = tracer or NOOP_TRACER
+
+        # One pooled transport per instance so connections are reused between calls
+        if transport is None:
+            transport = SessionTransport(pool_connections=pool_connections, pool_maxsize=pool_maxsize, keep_alive=keep_alive)
+        self.transport = transport
+
+    @property
+    def token(self):
+        """ Current bearer token, None until we authenticate """
+        return self.token_manager.token
+
+    @token.setter
+    def token(self, value):
+        self.token_manager.set(value)
+
+    def close(self):
+        """ Release pooled connections held by this client and stop background token refreshes """
+        self.token_manager.stop()
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _api_auth(self):
         """ Function to authenticate in Environment Manager """
-        log = LogWrapper()
-        logging.getLogger("requests").setLevel(logging.WARNING)
-        logging.getLogger("urllib3").setLevel(logging.WARNING)
-        log.debug('Authenticating in EM with user %s' % self.user)
-        # Build base url
-        base_url = 'https://%s' % self.server
+        log.debug('Authenticating in EM with user %s', self.user)
+        em_token_url = '%s/api/v1/token' % self.base_url
         # Request token
         token_payload = {'username': self.user,
                          'password': self.password}
-        token = None
-        no_token = True
-        retries = 0
-        while no_token and retries < self.retries:
-            try:
-                retries += 1
-                em_token_url = '%s/api/v1/token' % base_url
-                em_token = requests.post(em_token_url, data=json_encode(token_payload), headers=self.default_headers, timeout=5, verify=False)
-                if int(str(em_token.status_code)[:1]) == 2:
-                    token = em_token.text
-                    no_token = False
+        with self.tracer.start_span('EM authenticate', {'em.server': self.server, 'em.user': self.user}):
+            policy = self.retry_policy.copy(max_attempts=self.retries)
+            deadline = policy.start()
+            attempt = 0
+            while attempt < policy.max_attempts and not deadline.expired():
+                attempt += 1
+                em_token = None
+                try:
+                    em_token = self._send('POST', '/api/v1/token', attempt=attempt, url=em_token_url, data=codec.dumps_bytes(token_payload), headers=self.default_headers,
+                                          timeout=policy.timeout_for('/api/v1/token', deadline), verify=False)
+                except (ConnectionError, Timeout) as error:
+                    log.debug('There was a problem with the connection, trying again: %s', error)
                 else:
-                    log.debug('Could not authenticate, trying again: %s' % em_token.status_code)
-                    time.sleep(2)
-            except (ConnectionError, Timeout) as error:
-                log.debug('There was a problem with the connection, trying again: %s' % error.message)
-                time.sleep(2)
-        if token is not None:
-            # Got token now lets get URL
-            token_bearer = 'Bearer %s' % token
-            return token_bearer
-        else:
+                    if int(str(em_token.status_code)[:1]) == 2:
+                        # Got token now lets get URL
+                        return 'Bearer %s' % em_token.text
+                    log.debug('Could not authenticate, trying again: %s', em_token.status_code)
+                delay = policy.delay(attempt, em_token)
+                if attempt >= policy.max_attempts or not deadline.allows(delay):
+                    break
+                time.sleep(delay)
             raise SystemError('Could not authenticate against Environment Manager')
 
+    def add_hook(self, event, callback):
+        """ Call callback(event_dict) on every pre_request, post_request or decode event.
+        Events carry endpoint, template, method and attempt; post_request adds status, bytes, elapsed, ttfb and error;
+        decode adds elapsed. Hooks run inline so they should be quick, their exceptions are logged and swallowed """
+        if event not in self.hooks:
+            raise ValueError('Unknown hook event %s, pick one of %s' % (event, ', '.join(HOOK_EVENTS)))
+        self.hooks[event].append(callback)
+
+    def remove_hook(self, event, callback):
+        """ Stop calling a hook """
+        self.hooks[event].remove(callback)
+
+    def _emit(self, event, payload):
+        """ Run the hooks of an event """
+        for callback in self.hooks[event]:
+            try:
+                callback(payload)
+            except Exception:
+                log.error('Hook %s failed on %s', callback, event)
+
     def _get_token(self):
-        """ Internal function to get a new token """
-        if self.token is None:
-            self.token = self._api_auth()
-        return self.token
-
-    def _renew_token(self):
-        """ Internal function to renew a token """
-        self.token = self._api_auth()
-
-    def query(self, query_endpoint=None, data=None, headers={}, query_type='get', retries=5, backoff=2):
-        """ Function to querying Environment Manager """
-        log = LogWrapper()
-        logging.getLogger("requests").setLevel(logging.WARNING)
-        logging.getLogger("urllib3").setLevel(logging.WARNING)
+        """ Internal function to get a valid token, renewed ahead of its expiry """
+        return self.token_manager.get()
+
+    def _renew_token(self, expired_token=None):
+        """ Internal function to renew a token, skipped if another thread already replaced expired_token """
+        return self.token_manager.renew(expired_token)
+
+    def query(self, query_endpoint=None, data=None, headers={}, query_type='get', retries=None, backoff=None, use_cache=True, stream=False):
+        """ Function to querying Environment Manager, retries and backoff override the retry policy for this call.
+        With stream a GET returns an iterator decoding the items of the response array as they arrive, bypassing the caches """
         if query_endpoint is None:
             log.info('No endpoint specified, cant just go and query nothing')
             raise SyntaxError('No endpoint specified, cant just go and query nothing')
         if query_type.lower() == 'post' and data is None:
-            log.info('No data specified, we need to send data with method %s' % query_type)
+            log.info('No data specified, we need to send data with method %s', query_type)
             raise SyntaxError('No data specified, we need to send data with method %s' % query_type)
+        if query_type.upper() not in HTTP_METHODS:
+            raise SyntaxError('Cannot process query type %s' % query_type)
+        if stream and query_type.upper() != 'GET':
+            raise SyntaxError('Only GET queries can be streamed')
+        if not self.tracer.enabled:
+            return self._dispatch(query_endpoint, data, headers, query_type, retries, backoff, use_cache, stream)
+        with self._query_span(query_type, query_endpoint):
+            return self._dispatch(query_endpoint, data, headers, query_type, retries, backoff, use_cache, stream)
+
+    def _query_span(self, query_type, query_endpoint):
+        """ Span of a logical call, parent of one span per HTTP attempt """
+        return self.tracer.start_span('EM %s %s' % (query_type.upper(), endpoint_template(query_endpoint)),
+                                      {'em.server': self.server, 'em.method': query_type.upper(), 'em.endpoint': query_endpoint})
+
+    def _dispatch(self, query_endpoint, data, headers, query_type, retries, backoff, use_cache, stream=False):
+        """ Serve a validated query from the cache, a coalesced identical request or Environment Manager """
+        if stream:
+            return self._query(query_endpoint, data, headers, query_type, retries, backoff, stream=True)
+        if query_type.upper() != 'GET':
+            if self.cache is None and self.validators is None and self.single_flight is None:
+                return self._query(query_endpoint, data, headers, query_type, retries, backoff)
+            try:
+                return self._query(query_endpoint, data, headers, query_type, retries, backoff)
+            finally:
+                # Even a failed write may have gone through, don't serve stale reads
+                if self.cache is not None:
+                    self.cache.invalidate_for_write(query_endpoint)
+                if self.validators is not None:
+                    self.validators.invalidate_for_write(query_endpoint)
+                if self.single_flight is not None:
+                    # GETs sent before the write may answer with what it replaced, later ones mustn't join them
+                    self.single_flight.detach(lambda key: affected_by_write(key[0], query_endpoint))
+        request_key = ResponseCache.key(query_endpoint, headers if isinstance(headers, dict) else None)
+        cacheable = self.cache is not None and use_cache and self.cache.ttl_for(query_endpoint) > 0
+        if cacheable:
+            hit, result = self.cache.get(request_key)
+            if hit:
+                log.debug('Serving %s from cache', query_endpoint)
+                self.tracer.current_span().set_attribute('em.cache_hit', True)
+                return result
+            generation = self.cache.generation()
+        fetch = lambda: self._query(query_endpoint, data, headers, query_type, retries, backoff)
+        if self.single_flight is not None:
+            result = self.single_flight.do(request_key, fetch)
+        else:
+            result = fetch()
+        if cacheable:
+            self.cache.put(request_key, result, generation=generation)
+        return result
+
+    def _send(self, query_type, query_endpoint, attempt=1, **request_values):
+        """ Send a single HTTP request through the rate limiter, circuit breaker and concurrency limiter """
+        observed = self.hooks['pre_request'] or self.hooks['post_request']
+        if observed:
+            event = {'endpoint': query_endpoint, 'template': endpoint_template(query_endpoint),
+                     'method': query_type.upper(), 'attempt': attempt}
+            self._emit('pre_request', event)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(query_endpoint)
+        breaker = None
+        if self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.get(self.server, query_endpoint)
+            breaker.allow()
+        if self.concurrency_limiter is not None:
+            try:
+                self.concurrency_limiter.acquire()
+            except Exception:
+                if breaker is not None:
+                    breaker.release_probe()
+                raise
+        span = None
+        if self.tracer.enabled:
+            span = self.tracer.start_span('HTTP %s' % query_type.upper(), {'http.method': query_type.upper(), 'http.url': request_values.get('url'), 'em.attempt': attempt})
+            request_values['headers'] = self.tracer.inject(request_values.get('headers'), span)
+        success = False
+        response = None
+        error = None
+        start = time.time()
+        try:
+            response = self.transport.request(query_type, **request_values)
+            success = response.status_code < 500 and response.status_code != 429
+            return response
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            elapsed = time.time() - start
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.release(elapsed, success)
+            if breaker is not None:
+                if success:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            if observed:
+                self._emit('post_request', self._response_event(event, response, error, elapsed))
+            if span is not None:
+                self._finish_span(span, response, error)
+
+    @classmethod
+    def _finish_span(cls, span, response, error):
+        """ Record the outcome of an HTTP attempt on its span """
+        if response is not None:
+            span.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 400:
+                span.record_error('HTTP %s' % response.status_code)
+        if error is not None:
+            span.record_error(error)
+        span.finish()
+
+    @classmethod
+    def _response_event(cls, event, response, error, elapsed):
+        """ Complete a pre_request event with what we know about the response """
+        event = dict(event, elapsed=elapsed, status=None, bytes=0, ttfb=None, error=None)
+        if error is not None:
+            event['error'] = type(error).__name__
+        if response is not None:
+            event['status'] = response.status_code
+            content = getattr(response, '_content', None)
+            if content is None:
+                content = getattr(response, 'content', None)
+            event['bytes'] = len(content) if isinstance(content, bytes) else 0
+            # requests measures until the response headers are parsed, that is connection, TLS and server time
+            response_elapsed = getattr(response, 'elapsed', None)
+            if response_elapsed is not None:
+                event['ttfb'] = response_elapsed.total_seconds()
+        return event
+
+    def _decode(self, request, query_endpoint, query_type, attempt):
+        """ Decode a response body as JSON straight from its bytes, falling back to its text """
+        start = time.time()
+        try:
+            return codec.loads(request.content)
+        except ValueError:
+            return request.text
+        finally:
+            if self.hooks['decode']:
+                self._emit('decode', {'endpoint': query_endpoint, 'template': endpoint_template(query_endpoint),
+                                      'method': query_type.upper(), 'attempt': attempt, 'elapsed': time.time() - start})
+
+    def _stream_items(self, response):
+        """ Yield the items of a streamed response body, releasing the connection once done """
+        try:
+            for item in iter_json_items(response.iter_content(chunk_size=DEFAULT_CHUNK_SIZE)):
+                yield item
+        finally:
+            response.close()
+
+    def _query(self, query_endpoint, data, headers, query_type, retries, backoff, stream=False):
+        """ Send a query to Environment Manager, retrying according to the retry policy and renewing expired tokens """
+        conditional = self.validators is not None and query_type.upper() == 'GET' and not stream
+        if conditional:
+            request_key = ResponseCache.key(query_endpoint, headers if isinstance(headers, dict) else None)
+        policy = self.retry_policy
+        if retries is not None or backoff is not None:
+            policy = policy.copy(max_attempts=retries, backoff_base=backoff)
+        deadline = policy.start()
+        request = None
+        revalidate = True
         retry_num = 0
-        while retry_num < retries:
+        while retry_num < policy.max_attempts:
             retry_num += 1
-            log.debug('Going through query iteration %s out of %s' % (retry_num, retries))
+            log.debug('Going through query iteration %s out of %s', retry_num, policy.max_attempts)
             token = self._get_token()
-            log.debug('Using token %s for auth' % token)
-            # Build base url
-            base_url = 'https://%s' % self.server
-            request_url = '%s%s' % (base_url, query_endpoint)
-            log.debug('Calling URL %s' % request_url)
+            log.debug('Using token %s for auth', token)
+            request_url = '%s%s' % (self.base_url, query_endpoint)
+            log.debug('Calling URL %s', request_url)
             query_headers = self.default_headers.copy()
             query_headers.update({'Authorization': token})
             if isinstance(headers, dict):
                 query_headers.update(headers)
+            if conditional and revalidate:
+                query_headers.update(self.validators.request_headers(request_key))
 
-            request_values = {'url':request_url, 'headers':query_headers, 'timeout':30, 'verify':False}
+            request_values = {'url':request_url, 'headers':query_headers, 'timeout':policy.timeout_for(query_endpoint, deadline), 'verify':False}
+            if stream:
+                request_values['stream'] = True
             if data is not None:
-                request_values['data'] = json_encode(data)
-
-            request_method = getattr(requests, query_type.lower())
-            if request_method is None:
-                raise SyntaxError('Cannot process query type %s' % query_type)
+                request_values['data'] = codec.dumps_bytes(data)
 
             request = None
             try:
-                request = request_method(**request_values)
+                request = self._send(query_type, query_endpoint, attempt=retry_num, **request_values)
             except (ConnectionError, Timeout) as error:
+                if not policy.retry_on_error(query_type, query_endpoint, error):
+                    log.info('Connection problem on non idempotent %s %s, not retrying', query_type, query_endpoint)
+                    raise
                 log.debug('There was a problem with the connection, trying again')
+                delay = policy.delay(retry_num)
+                if retry_num >= policy.max_attempts or not deadline.allows(delay):
+                    break
+                time.sleep(delay)
                 continue
             status_type = int(str(request.status_code)[:1])
 
+            if request.status_code == 304 and conditional:
+                not_modified, result = self.validators.not_modified_value(request_key)
+                if not_modified:
+                    log.debug('%s not modified, using stored response', query_endpoint)
+                    return result
+                if revalidate:
+                    # The stored response went away since the validators were sent, ask again for the whole response
+                    log.debug('%s not modified but its stored response is gone, asking again unconditionally', query_endpoint)
+                    revalidate = False
+                    retry_num -= 1
+                    continue
+            if stream and status_type == 2:
+                return self._stream_items(request)
             if status_type == 2 or status_type == 3:
-                try:
-                    return request.json()
-                except ValueError:
-                    return request.text
+                result = self._decode(request, query_endpoint, query_type, retry_num)
+                if conditional and request.status_code == 200:
+                    self.validators.store(request_key, request.headers, result, request.content)
+                return result
+            elif policy.retry_on_status(query_type, query_endpoint, request.status_code):
+                log.info('Got a status %s from EM, cant serve, retrying', request.status_code)
+                if stream:
+                    # Unread streamed bodies hold on to their pooled connection
+                    request.close()
+                delay = policy.delay(retry_num, request)
+                if retry_num >= policy.max_attempts or not deadline.allows(delay):
+                    break
+                time.sleep(delay)
             elif status_type == 4:
                 try:
                     error_msg = request.json()['error']
@@ -131,7 +418,7 @@ class EMApi(object):
                     except:
                         if request.text == 'jwt expired' or request.text == 'invalid token':
                             log.info('Your auth token expired or is inavlid, re-authenticating and attempting request again...')
-                            self._renew_token()
+                            self._renew_token(token)
                             continue
                         elif request.text:
                             error_msg = request.text
@@ -139,12 +426,32 @@ class EMApi(object):
                             error_msg = 'An unknown error occured'
                 raise ValueError(error_msg)
             else:
-                log.info('Got a status %s from EM, cant serve, retrying' % request.status_code)
-                log.debug(request.request.headers)
-                log.debug(request.__dict__)
-                time.sleep(backoff)
+                log.info('Got a status %s from EM on non idempotent %s %s, not retrying', request.status_code, query_type, query_endpoint)
+                break
         # General one if we exceeded our retries
-        raise SystemError('Max number of retries (%s) querying Environment Manager, last http code is %s, will abort for now' % (retries, request.status_code))
+        last_status = request.status_code if request is not None else None
+        raise SystemError('Max number of retries (%s) querying Environment Manager, last http code is %s, will abort for now' % (retry_num, last_status))
+
+    def batch(self, calls, max_workers=10, ordered=True, stream=False):
+        """ Run a list of (method, kwargs) calls concurrently and return a BatchResult per call.
+        method is an EMApi method name or a callable. Results come back in input order, or as an
+        iterator in completion order if stream is True. Size the pool (pool_maxsize) to at least
+        max_workers so every worker gets a kept-alive connection """
+        calls = list(calls)
+        if calls:
+            # Authenticate once upfront so workers share the same token
+            self._get_token()
+        results = run_batch(self, calls, max_workers=max_workers)
+        if stream:
+            return results
+        results = list(results)
+        if ordered:
+            results.sort(key=lambda result: result.index)
+        return results
+
+    def map(self, method, kwargs_list, max_workers=10, ordered=True, stream=False):
+        """ Call the same method concurrently once per kwargs dictionary, see batch """
+        return self.batch([(method, kwargs) for kwargs in kwargs_list], max_workers=max_workers, ordered=ordered, stream=stream)
 
     #######################################################
     # This is a full API implementation based on EM docs  #
@@ -191,6 +498,10 @@ class EMApi(object):
         request_endpoint = '/api/v1/asgs?account=%s' % account
         return self.query(query_endpoint=request_endpoint, query_type='GET', **kwargs)
 
+    def iter_asgs(self, account='Non-Prod', **kwargs):
+        """ Same as get_asgs, yielding ASGs one at a time while the response is downloaded """
+        return self.get_asgs(account=account, stream=True, **kwargs)
+
     def get_asg(self, environment=None, asgname=None, **kwargs):
         """ Get a single ASG for the given environment """
         if environment is None or asgname is None:
@@ -284,6 +595,19 @@ class EMApi(object):
         request_endpoint = '/api/v1/config/audit%s' % constructed_qs
         return self.query(query_endpoint=request_endpoint, query_type='GET', **kwargs)
 
+    def iter_audit_config(self, since=None, until=None, **kwargs):
+        """ Same as get_audit_config, yielding audit entries one at a time while the response is downloaded """
+        return self.get_audit_config(since=since, until=until, stream=True, **kwargs)
+
+    def paginate_audit_config(self, since=None, until=None, window=3600, max_workers=4, target_records=500, **kwargs):
+        """ Yield the audit entries between since and until (default now) in time order, fetched as concurrent
+        time windows of adaptive size instead of one huge response. since/until are datetimes, epoch seconds or
+        ISO 8601 strings """
+        if since is None:
+            raise SyntaxError('since has not been specified')
+        fetch = lambda window_since, window_until: self.get_audit_config(since=window_since, until=window_until, **kwargs)
+        return iter(TimeWindowPager(fetch, since, until, window=window, max_workers=max_workers, target_records=target_records))
+
     def get_audit_key_config(self, key=None, **kwargs):
         """ Get a specific audit log """
         if key is None:
@@ -333,6 +657,38 @@ class EMApi(object):
             request_endpoint = '{0}?{1}'.format(request_endpoint, q)
         return self.query(query_endpoint=request_endpoint, query_type='GET', **kwargs)
 
+    def iter_deployments(self, query_args=None, **kwargs):
+        """ Same as get_deployments, yielding deployments one at a time while the response is downloaded """
+        return self.get_deployments(query_args=query_args, stream=True, **kwargs)
+
+    def paginate_deployments(self, since=None, until=None, query_args=None, window=86400, max_workers=4, target_records=500, **kwargs):
+        """ Yield the deployments started between since and until (default now) in time order, fetched as concurrent
+        time windows of adaptive size. query_args holds the other filters (environment, status, cluster). Each window
+        is requested with since and until, records outside it are dropped in case the server ignores until """
+        if since is None:
+            raise SyntaxError('since has not been specified')
+        def fetch(window_since, window_until):
+            window_args = dict(query_args or {}, since=window_since, until=window_until)
+            return self.get_deployments(query_args=window_args, **kwargs)
+        return iter(TimeWindowPager(fetch, since, until, timestamp=deployment_timestamp, key=deployment_key,
+                                    window=window, max_workers=max_workers, target_records=target_records))
+
+    def wait_for_deployments(self, deployment_ids=None, timeout=3600, **kwargs):
+        """ Watch one or many deployments, yielding DeploymentEvents as they change state until all have finished or
+        timeout seconds have passed. Polls are shared and adapt to each deployment's phase, see DeploymentWaiter """
+        if not deployment_ids:
+            raise SyntaxError('Deployment ids have not been specified')
+        if not isinstance(deployment_ids, (list, tuple, set, frozenset)):
+            deployment_ids = [deployment_ids]
+        return wait_for_deployments(self, deployment_ids, timeout=timeout, **kwargs)
+
+    def tail_deployment_logs(self, deployment_id=None, account=None, instances=None, follow=True, **kwargs):
+        """ Yield new lines of the logs of every instance of a deployment as one stream, until the deployment has
+        finished. Each instance is only read as often as its log grows, see DeploymentLogTail """
+        if deployment_id is None:
+            raise SyntaxError('Deployment id has not been specified')
+        return tail_deployment_logs(self, deployment_id, account=account, instances=instances, follow=follow, **kwargs)
+
     def post_deployments(self, dry_run=False, data={}, **kwargs):
         """ Create a new deployment. This will provision any required infrastructure and update the required target-state """
         request_endpoint = '/api/v1/deployments?dry_run=%s' % dry_run
@@ -563,6 +919,10 @@ class EMApi(object):
         request_endpoint = '/api/v1/config/export/%s?account=%s' % (resource, account)
         return self.query(query_endpoint=request_endpoint, query_type='GET', **kwargs)
 
+    def iter_export_resource(self, resource=None, account=None, **kwargs):
+        """ Same as export_resource, yielding exported items one at a time while the response is downloaded """
+        return self.export_resource(resource=resource, account=account, stream=True, **kwargs)
+
     ## Import
     def import_resource(self, resource=None, account=None, mode=None, data={}, **kwargs):
         """ Import a configuration resources dynamo table """
@@ -586,6 +946,10 @@ class EMApi(object):
             request_endpoint += '?{0}'.format('&'.join(queries))
         return self.query(query_endpoint=request_endpoint, query_type='GET', **kwargs)
 
+    def iter_instances(self, environment=None, cluster=None, account=None, **kwargs):
+        """ Same as get_instances, yielding instances one at a time while the response is downloaded """
+        return self.get_instances(environment=environment, cluster=cluster, account=account, stream=True, **kwargs)
+
     def get_instance(self, instance_id=None, **kwargs):
         """ Get a specific instance """
         if instance_id is None:
@@ -0,0 +1,154 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import hashlib
+import sqlite3
+import threading
+import time
+from environment_manager import codec
+from environment_manager.pagination import to_epoch, to_iso
+from environment_manager.utils import LogWrapper
+
+log = LogWrapper(__name__)
+
+SCHEMA_VERSION = 1
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS audit ('
+    ' audit_id TEXT PRIMARY KEY, transaction_id TEXT, entity_type TEXT, entity_key TEXT, entity_range TEXT,'
+    ' change_type TEXT, changed_by TEXT, timestamp REAL, record TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS audit_entity_key ON audit (entity_key, timestamp)',
+    'CREATE INDEX IF NOT EXISTS audit_changed_by ON audit (changed_by, timestamp)',
+    'CREATE INDEX IF NOT EXISTS audit_timestamp ON audit (timestamp)',
+    'CREATE TABLE IF NOT EXISTS checkpoint (name TEXT PRIMARY KEY, value REAL NOT NULL)',
+)
+_INSERT = ('INSERT OR REPLACE INTO audit (audit_id, transaction_id, entity_type, entity_key, entity_range, change_type,'
+           ' changed_by, timestamp, record) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+class AuditStore(object):
+    """ Local SQLite copy of the Environment Manager audit log, kept up to date incrementally by sync """
+
+    def __init__(self, path, checkpoint='audit'):
+        """ path is the database file, ':memory:' for a throwaway store. checkpoint names the high water mark, so
+        copies of different servers can share one file """
+        self.path = path
+        self.checkpoint_name = checkpoint
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise ValueError('%s was written by a newer environment_manager, schema %s' % (path, version))
+            with self._connection:
+                for statement in _SCHEMA:
+                    self._connection.execute(statement)
+                self._connection.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+    @classmethod
+    def _row(cls, record):
+        """ Column values of an audit entry """
+        entity = record.get('Entity') or {}
+        audit_id = record.get('AuditID')
+        if audit_id is None:
+            audit_id = hashlib.sha1(codec.dumps_bytes(record)).hexdigest()
+        return (str(audit_id), record.get('TransactionID'), entity.get('Type'), entity.get('Key'), entity.get('Range'),
+                record.get('ChangeType'), record.get('ChangedBy'), to_epoch(record.get('Timestamp')), codec.dumps(record))
+
+    def checkpoint(self):
+        """ Epoch seconds up to which the audit log has been synced, None before the first sync """
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM checkpoint WHERE name = ?', (self.checkpoint_name,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, records, checkpoint=None):
+        """ Insert or update audit entries in one transaction, moving the high water mark to checkpoint if given """
+        rows = [self._row(record) for record in records]
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(_INSERT, rows)
+                if checkpoint is not None:
+                    self._connection.execute('INSERT OR REPLACE INTO checkpoint (name, value) VALUES (?, ?)',
+                                             (self.checkpoint_name, checkpoint))
+        return len(rows)
+
+    def sync(self, em_session, since=None, until=None, overlap=300, batch_size=1000, **pagination):
+        """ Download the audit entries added since the last sync and store them. The first sync starts at since
+        (default a day ago), later ones at the checkpoint minus overlap seconds, catching entries written late with an
+        earlier timestamp. Entries are inserted batch_size at a time, the checkpoint following each committed batch, so
+        an interrupted sync resumes where it stopped. Other arguments go to EMApi.paginate_audit_config.
+        Returns the number of entries written """
+        until = to_epoch(until) if until is not None else time.time()
+        checkpoint = self.checkpoint()
+        if checkpoint is not None:
+            since = checkpoint - overlap
+        elif since is None:
+            since = until - 86400
+        else:
+            since = to_epoch(since)
+        if since >= until:
+            return 0
+        written = 0
+        batch = []
+        for record in em_session.paginate_audit_config(since=since, until=until, **pagination):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                # Entries come in time order, everything before the last one stored is complete
+                written += self.add(batch, checkpoint=max(checkpoint or since, to_epoch(record.get('Timestamp')) or since))
+                batch = []
+        written += self.add(batch, checkpoint=until)
+        log.info('Synced %s audit entries from %s to %s', written, to_iso(since), to_iso(until))
+        return written
+
+    def refresh(self, em_session, keys):
+        """ Re-download specific audit entries with get_audit_key_config and store them, returns how many were found """
+        records = []
+        for key in keys:
+            try:
+                record = em_session.get_audit_key_config(key=key)
+            except (SystemError, ValueError):
+                log.info('Audit entry %s could not be fetched', key)
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+        return self.add(records)
+
+    def entries(self, entity_key=None, changed_by=None, entity_type=None, since=None, until=None, limit=None):
+        """ Stored audit entries matching all the given filters, oldest first. since/until are datetimes, epoch seconds
+        or ISO 8601 strings """
+        conditions = []
+        arguments = []
+        for column, value in (('entity_key', entity_key), ('changed_by', changed_by), ('entity_type', entity_type)):
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                arguments.append(value)
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            arguments.append(to_epoch(since))
+        if until is not None:
+            conditions.append('timestamp < ?')
+            arguments.append(to_epoch(until))
+        statement = 'SELECT record FROM audit'
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        statement += ' ORDER BY timestamp, audit_id'
+        if limit is not None:
+            statement += ' LIMIT %d' % int(limit)
+        with self._lock:
+            rows = self._connection.execute(statement, arguments).fetchall()
+        return [codec.loads(row[0]) for row in rows]
+
+    def count(self):
+        """ Number of stored audit entries """
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM audit').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,282 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import base64
+import hashlib
+import os
+import threading
+import time
+from environment_manager import codec
+from environment_manager.utils import LogWrapper, file_lock, write_private_file
+
+log = LogWrapper(__name__)
+
+def decode_jwt_expiry(token):
+    """ Return the exp claim (epoch seconds) of a JWT, with or without Bearer prefix, or None if it can't be read """
+    if not token:
+        return None
+    if token.startswith('Bearer '):
+        token = token[len('Bearer '):]
+    parts = token.strip().split('.')
+    if len(parts) != 3:
+        return None
+    payload = parts[1]
+    payload += '=' * (-len(payload) % 4)
+    try:
+        claims = codec.loads(base64.urlsafe_b64decode(payload.encode('ascii')))
+        return float(claims['exp'])
+    except (ValueError, TypeError, KeyError, UnicodeError):
+        return None
+
+def default_token_cache_path():
+    """ Per-user token cache location, under XDG_CACHE_HOME or ~/.cache """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'environment_manager', 'tokens.json')
+
+class TokenCache(object):
+    """ On-disk bearer token cache shared by processes of the same user, keyed by server and user """
+
+    def __init__(self, path=None):
+        """ Initialise cache, the file and its directory are created owner-only on first write """
+        self.path = path or default_token_cache_path()
+        self.lock_path = '%s.lock' % self.path
+
+    @classmethod
+    def key(cls, server, user):
+        """ Cache key for a server and user, hashed so the file doesn't list who logged in where """
+        return hashlib.sha256(('%s\0%s' % (server, user)).encode('utf-8')).hexdigest()
+
+    def _ensure_directory(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+    def _read(self):
+        """ Read all entries, caller holds the lock. A missing or corrupt file is an empty cache """
+        try:
+            with open(self.path, 'r') as cache_file:
+                entries = codec.loads(cache_file.read())
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, key, min_validity=0):
+        """ Return a cached token valid for at least min_validity more seconds, or None """
+        if not os.path.exists(self.path):
+            return None
+        with file_lock(self.lock_path):
+            entry = self._read().get(key)
+        if not entry or entry.get('expires_at') is None:
+            return None
+        if time.time() + min_validity >= entry['expires_at']:
+            return None
+        return entry.get('token')
+
+    def put(self, key, token):
+        """ Store token under key, tokens without an exp claim are not cached. Expired entries are purged on the way """
+        expires_at = decode_jwt_expiry(token)
+        if expires_at is None:
+            return
+        self._ensure_directory()
+        now = time.time()
+        with file_lock(self.lock_path):
+            entries = self._read()
+            entries = dict((k, v) for k, v in entries.items() if isinstance(v, dict) and (v.get('expires_at') or 0) > now)
+            entries[key] = {'token': token, 'expires_at': expires_at}
+            write_private_file(self.path, codec.dumps(entries))
+
+    def discard(self, key, token=None):
+        """ Remove the entry for key, only if it still holds token when given """
+        if not os.path.exists(self.path):
+            return
+        with file_lock(self.lock_path):
+            entries = self._read()
+            entry = entries.get(key)
+            if entry is None or (token is not None and entry.get('token') != token):
+                return
+            del entries[key]
+            write_private_file(self.path, codec.dumps(entries))
+
+class TokenManager(object):
+    """ Thread-safe bearer token holder that refreshes ahead of the JWT expiry, with only one refresh in flight at a time """
+
+    def __init__(self, fetch_token, refresh_margin=60, background_refresh=False, cache=None, cache_key=None,
+                 retry_interval=5, max_retry_interval=60):
+        """ fetch_token is a callable returning a new bearer token, refresh_margin the seconds before expiry at which we
+        renew, at most half the token lifetime. An early refresh that fails is retried after retry_interval seconds,
+        doubling up to max_retry_interval, the current token being used meanwhile. An optional TokenCache lets processes
+        share tokens stored under cache_key """
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.background_refresh = background_refresh
+        self.cache = cache
+        self.cache_key = cache_key
+        self.cache_hits = 0
+        self.token = None
+        self.expires_at = None
+        self.issued_at = None
+        self.refresh_count = 0
+        self.refresh_errors = 0
+        self.last_refresh_latency = None
+        self.total_refresh_latency = 0.0
+        self._refreshing = False
+        # Failed early refreshes in a row, and when to try again
+        self._failures = 0
+        self._retry_at = None
+        self._condition = threading.Condition(threading.Lock())
+        self._timer = None
+
+    def needs_refresh(self, now=None):
+        """ True if we don't have a token or it is about to expire """
+        if self.token is None:
+            return True
+        if self.expires_at is None:
+            return False
+        if now is None:
+            now = time.time()
+        if now >= self.expires_at:
+            return True
+        if self._retry_at is not None and now < self._retry_at:
+            return False
+        return now >= self.expires_at - self.margin()
+
+    def margin(self):
+        """ Seconds before expiry at which the current token is renewed, so a short lived token isn't renewed on every use """
+        if self.expires_at is None or self.issued_at is None:
+            return self.refresh_margin
+        return max(0, min(self.refresh_margin, (self.expires_at - self.issued_at) / 2.0))
+
+    def get(self):
+        """ Return a valid token, refreshing it first if missing or close to expiry """
+        if not self.needs_refresh():
+            return self.token
+        return self._refresh(None)
+
+    def renew(self, expired_token=None):
+        """ Force a refresh, unless another thread already replaced expired_token """
+        return self._refresh(expired_token, force=True)
+
+    def set(self, token, latency=None):
+        """ Store a freshly fetched token and record refresh statistics """
+        with self._condition:
+            self._store(token, latency)
+
+    def _store(self, token, latency):
+        """ Store token, caller holds the lock """
+        self.token = token
+        self.expires_at = decode_jwt_expiry(token)
+        self.issued_at = time.time()
+        self._failures = 0
+        self._retry_at = None
+        self.refresh_count += 1
+        if latency is not None:
+            self.last_refresh_latency = latency
+            self.total_refresh_latency += latency
+        self._schedule()
+
+    def _refresh(self, expired_token, force=False):
+        """ Single-flight refresh, concurrent callers wait for the refresh already in progress """
+        with self._condition:
+            while self._refreshing:
+                self._condition.wait()
+            if force and expired_token is not None and self.token != expired_token:
+                return self.token
+            if not force and not self.needs_refresh():
+                return self.token
+            self._refreshing = True
+        token = None
+        start = time.time()
+        try:
+            token = self._from_cache(expired_token if force else None)
+            if token is None:
+                token = self.fetch_token()
+                self._to_cache(token)
+        except Exception:
+            current = self.refresh_failed(force)
+            if current is None:
+                raise
+            return current
+        finally:
+            with self._condition:
+                if token is not None:
+                    self._store(token, time.time() - start)
+                self._refreshing = False
+                self._condition.notify_all()
+        return token
+
+    def refresh_failed(self, force=False):
+        """ Record a failed refresh. Returns the current token if it is still valid and the refresh was only early,
+        holding off the next attempt, None if the caller has nothing to use """
+        with self._condition:
+            self.refresh_errors += 1
+            current = self.token
+            if current is None or force or (self.expires_at is not None and time.time() >= self.expires_at):
+                return None
+            self._failures += 1
+            delay = min(self.max_retry_interval, self.retry_interval * 2 ** (self._failures - 1))
+            self._retry_at = time.time() + delay
+        log.info('Could not refresh token ahead of expiry, carrying on with the current one for %s seconds', delay)
+        return current
+
+    def _from_cache(self, expired_token):
+        """ Look for a token another process stored, never hands back the token we are trying to replace """
+        if self.cache is None:
+            return None
+        try:
+            if expired_token is not None:
+                self.cache.discard(self.cache_key, expired_token)
+            token = self.cache.get(self.cache_key, min_validity=self.margin())
+        except (IOError, OSError) as error:
+            log.debug('Token cache unavailable: %s', error)
+            return None
+        if token is None or token == expired_token or token == self.token:
+            return None
+        self.cache_hits += 1
+        return token
+
+    def _to_cache(self, token):
+        """ Share a freshly fetched token with other processes, cache failures are not fatal """
+        if self.cache is None:
+            return
+        try:
+            self.cache.put(self.cache_key, token)
+        except (IOError, OSError) as error:
+            log.debug('Could not write token cache: %s', error)
+
+    def _schedule(self):
+        """ Arm the background refresh timer for the current token, caller holds the lock """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.background_refresh or self.expires_at is None:
+            return
+        delay = max(0, self.expires_at - self.margin() - time.time())
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        """ Timer callback, errors are left for the next foreground get() to deal with """
+        try:
+            self._refresh(None)
+        except Exception:
+            log.info('Background token refresh failed')
+
+    def stop(self):
+        """ Cancel any pending background refresh """
+        with self._condition:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def stats(self):
+        """ Return refresh statistics as a dictionary """
+        with self._condition:
+            return {'refresh_count': self.refresh_count,
+                    'cache_hits': self.cache_hits,
+                    'refresh_errors': self.refresh_errors,
+                    'last_refresh_latency': self.last_refresh_latency,
+                    'total_refresh_latency': self.total_refresh_latency,
+                    'expires_at': self.expires_at}
@@ -0,0 +1,65 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class BatchResult(object):
+    """ Outcome of a single call in a batch, errors are captured instead of raised """
+
+    __slots__ = ('index', 'method', 'kwargs', 'result', 'error')
+
+    def __init__(self, index, method, kwargs, result=None, error=None):
+        self.index = index
+        self.method = method
+        self.kwargs = kwargs
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        """ True if the call didn't raise """
+        return self.error is None
+
+    def get(self):
+        """ Return the result of the call or raise its error """
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def __repr__(self):
+        return 'BatchResult(index=%s, method=%s, ok=%s)' % (self.index, self.method, self.ok)
+
+def resolve_call(client, method):
+    """ Turn a method name or callable into a callable bound to client """
+    if callable(method):
+        return method
+    bound = getattr(client, method, None)
+    if bound is None or not callable(bound):
+        raise SyntaxError('Unknown EMApi method %s' % method)
+    return bound
+
+def _run_call(index, method, function, kwargs):
+    """ Run a single call, capturing any error in the result """
+    try:
+        return BatchResult(index, method, kwargs, result=function(**kwargs))
+    except Exception as error:
+        return BatchResult(index, method, kwargs, error=error)
+
+def run_batch(client, calls, max_workers=10):
+    """ Run (method, kwargs) calls on a bounded thread pool and yield BatchResult objects as they finish """
+    if max_workers < 1:
+        raise ValueError('max_workers needs to be at least 1')
+    # Resolve everything upfront so a typo fails before anything is sent
+    prepared = [(index, method, resolve_call(client, method), kwargs or {}) for index, (method, kwargs) in enumerate(calls)]
+    if not prepared:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(prepared)))
+    futures = [executor.submit(_run_call, *call) for call in prepared]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Consumer stopped early, don't start calls nobody is waiting for
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
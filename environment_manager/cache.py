@@ -0,0 +1,264 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import copy
+import threading
+import time
+from collections import OrderedDict, deque
+from environment_manager import codec
+
+now = getattr(time, 'monotonic', time.time)
+
+def split_path(request_path):
+    """ Strip the query string from an endpoint """
+    return request_path.split('?', 1)[0].rstrip('/')
+
+def affected_by_write(request_path, written_path):
+    """ True if a PUT/POST/PATCH/DELETE on written_path may change what a GET of request_path returns: the resource
+    itself, its children or its parent collections below the API root """
+    path = split_path(request_path)
+    written = split_path(written_path)
+    return ResponseCache._below(path, written) or ResponseCache._parent(path, written)
+
+class LRUCache(object):
+    """ Thread-safe dictionary bounded to max_entries, least recently used entries are evicted first """
+
+    def __init__(self, max_entries=1024):
+        if max_entries < 1:
+            raise ValueError('max_entries needs to be at least 1')
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the value for key and mark it as recently used """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """ Store value under key, evicting the oldest entries if we are over the bound """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """ Remove key and return its value """
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def remove_if(self, predicate):
+        """ Remove every entry whose key matches predicate, returns how many were removed """
+        with self._lock:
+            doomed = [key for key in self._entries if predicate(key)]
+            for key in doomed:
+                del self._entries[key]
+            return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class ResponseCache(object):
+    """ Read-through cache for GET responses with per-endpoint TTLs, LRU eviction and invalidation on writes """
+
+    # Configuration that rarely changes, in seconds
+    DEFAULT_TTLS = {'/api/v1/config/accounts': 300,
+                    '/api/v1/config/clusters': 300,
+                    '/api/v1/config/environment-types': 300,
+                    '/api/v1/config/services': 300,
+                    '/api/v1/images': 300}
+
+    def __init__(self, max_entries=1024, ttls=None, default_ttl=0, copy_results=True):
+        """ ttls maps endpoint prefixes to seconds, the longest matching prefix wins and unmatched endpoints
+        use default_ttl (0 means not cached). With copy_results callers get their own copy of cached values """
+        self.ttls = dict(self.DEFAULT_TTLS if ttls is None else ttls)
+        self.default_ttl = default_ttl
+        self.copy_results = copy_results
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = LRUCache(max_entries)
+        # Longest prefix first so the most specific policy matches
+        self._prefixes = sorted(self.ttls, key=len, reverse=True)
+        # Invalidation generation and the latest invalidations as (generation, path or None for everything, whether
+        # parent collections were included), so a response fetched across a write isn't stored
+        self._generation = 0
+        self._invalidated = deque(maxlen=256)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def key(cls, request_path, headers=None):
+        """ Cache key for an endpoint and the caller supplied headers """
+        if not headers:
+            return (request_path, ())
+        return (request_path, tuple(sorted(headers.items())))
+
+    def ttl_for(self, request_path):
+        """ TTL in seconds for an endpoint, 0 if it shouldn't be cached """
+        path = split_path(request_path)
+        for prefix in self._prefixes:
+            if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+                return self.ttls[prefix]
+        return self.default_ttl
+
+    def get(self, key):
+        """ Return (True, value) for a fresh entry or (False, None) """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now():
+            if entry is not None:
+                self._entries.pop(key)
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, self._copy(entry[1])
+
+    def generation(self):
+        """ Invalidation generation to take before fetching a value, to be given back to put """
+        return self._generation
+
+    def put(self, key, value, ttl=None, generation=None):
+        """ Store a value using the TTL of its endpoint. With the generation taken before fetching it, a value that
+        was being fetched while its endpoint got invalidated is not stored """
+        if ttl is None:
+            ttl = self.ttl_for(key[0])
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and self._invalidated_since(split_path(key[0]), generation):
+                return
+            self._entries.put(key, (now() + ttl, self._copy(value)))
+
+    def _invalidated_since(self, path, generation):
+        if generation == self._generation:
+            return False
+        if not self._invalidated or self._invalidated[0][0] > generation + 1:
+            # Older than the invalidations we remember, assume the worst
+            return True
+        for written_generation, written, parents in self._invalidated:
+            if written_generation > generation:
+                if written is None or self._below(path, written) or (parents and self._parent(path, written)):
+                    return True
+        return False
+
+    def _invalidation(self, path, parents):
+        """ Move to the next generation, remembering what it invalidated """
+        self._generation += 1
+        self._invalidated.append((self._generation, path, parents))
+
+    def _copy(self, value):
+        if self.copy_results and isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+        return value
+
+    def invalidate(self, request_path=None):
+        """ Drop cached entries for an endpoint and everything below it, or everything if no endpoint is given """
+        with self._lock:
+            if request_path is None:
+                self._invalidation(None, False)
+                self._entries.clear()
+                self.invalidations += 1
+                return
+            path = split_path(request_path)
+            self._invalidation(path, False)
+            self.invalidations += self._entries.remove_if(lambda key: self._below(split_path(key[0]), path))
+
+    def invalidate_for_write(self, request_path):
+        """ Drop what a PUT/POST/PATCH/DELETE on request_path may have changed: the resource, its children and its parent collections """
+        path = split_path(request_path)
+        with self._lock:
+            self._invalidation(path, True)
+            self.invalidations += self._entries.remove_if(lambda key: affected_by_write(key[0], path))
+
+    @classmethod
+    def _parent(cls, path, child):
+        """ True if path is a parent collection of child, below the API root """
+        return child.startswith(path + '/') and path.count('/') >= 3
+
+    @classmethod
+    def _below(cls, path, prefix):
+        return path == prefix or path.startswith(prefix + '/')
+
+    def stats(self):
+        """ Return cache counters as a dictionary """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self._entries.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries)}
+
+class ValidatorStore(object):
+    """ Remembers ETag/Last-Modified validators and the body of GET responses so they can be revalidated with a conditional request """
+
+    def __init__(self, max_entries=256, copy_results=True):
+        """ With copy_results the raw body is kept and decoded again on every 304, so callers get their own objects
+        for the cost of a decode. Without, the decoded value is kept and every 304 returns that same object """
+        self.copy_results = copy_results
+        self.stored = 0
+        self.not_modified = 0
+        self._entries = LRUCache(max_entries)
+
+    def request_headers(self, key):
+        """ Conditional headers to send for key, empty if we have nothing to revalidate """
+        entry = self._entries.get(key)
+        if entry is None:
+            return {}
+        etag, last_modified = entry[:2]
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def store(self, key, response_headers, value, body=None):
+        """ Keep value, or the body it was decoded from, if the response carried validators """
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if not etag and not last_modified:
+            self._entries.pop(key)
+            return
+        if self.copy_results and isinstance(value, (dict, list)):
+            if body is not None:
+                self._entries.put(key, (etag, last_modified, None, bytes(body)))
+            else:
+                self._entries.put(key, (etag, last_modified, copy.deepcopy(value), None))
+        else:
+            self._entries.put(key, (etag, last_modified, value, None))
+        self.stored += 1
+
+    def not_modified_value(self, key):
+        """ Return (True, value) for a 304 answer on key, or (False, None) if we hold nothing for it """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        self.not_modified += 1
+        etag, last_modified, value, body = entry
+        if body is not None:
+            return True, codec.loads(body)
+        if self.copy_results and isinstance(value, (dict, list)):
+            return True, copy.deepcopy(value)
+        return True, value
+
+    def invalidate_for_write(self, request_path):
+        """ Forget validators of a resource we just wrote to, and its children """
+        path = split_path(request_path)
+        self._entries.remove_if(lambda key: ResponseCache._below(split_path(key[0]), path))
+
+    def stats(self):
+        """ Return counters as a dictionary """
+        return {'stored': self.stored,
+                'not_modified': self.not_modified,
+                'evictions': self._entries.evictions,
+                'size': len(self._entries)}
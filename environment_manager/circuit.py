@@ -0,0 +1,201 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import time
+from collections import deque
+from environment_manager.utils import endpoint_family
+
+now = getattr(time, 'monotonic', time.time)
+
+class CircuitOpenError(SystemError):
+    """ Raised instead of sending a request while the circuit is open """
+
+class ConcurrencyLimitError(SystemError):
+    """ Raised when a request couldn't get a concurrency slot in time """
+
+class CircuitBreaker(object):
+    """ Fails fast once the error rate over a sliding window crosses a threshold, then lets a few probes through to test recovery """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name='default', failure_threshold=0.5, minimum_calls=20, window=30, reset_timeout=30, half_open_max_calls=3):
+        """ The circuit opens when at least minimum_calls finished in the last window seconds and the failed share is at
+        least failure_threshold. After reset_timeout seconds up to half_open_max_calls probes are allowed, closing the
+        circuit if they all succeed and reopening it on the first failure """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.rejected = 0
+        self.times_opened = 0
+        self._outcomes = deque()
+        self._failures = 0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Raise CircuitOpenError if the request should not be sent """
+        with self._lock:
+            if self.state == self.OPEN:
+                if now() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError('Circuit %s is open, Environment Manager is failing, not sending request' % self.name)
+                self.state = self.HALF_OPEN
+                self._probes = 0
+                self._probe_successes = 0
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_max_calls:
+                    self.rejected += 1
+                    raise CircuitOpenError('Circuit %s is half open and already probing, not sending request' % self.name)
+                self._probes += 1
+
+    def release_probe(self):
+        """ Give back the half open probe slot allow() took for a request that was then never sent """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_success(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_max_calls:
+                    self._close()
+                return
+            self._record(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._open()
+                return
+            self._record(True)
+            if self.state == self.CLOSED and len(self._outcomes) >= self.minimum_calls and \
+                    self._failures >= self.failure_threshold * len(self._outcomes):
+                self._open()
+
+    def _record(self, failed):
+        """ Add an outcome to the window and expire old ones, caller holds the lock """
+        current = now()
+        self._outcomes.append((current, failed))
+        if failed:
+            self._failures += 1
+        while self._outcomes and self._outcomes[0][0] < current - self.window:
+            if self._outcomes.popleft()[1]:
+                self._failures -= 1
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = now()
+        self.times_opened += 1
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._outcomes.clear()
+        self._failures = 0
+
+    def stats(self):
+        """ Return the breaker state as a dictionary """
+        with self._lock:
+            return {'name': self.name,
+                    'state': self.state,
+                    'calls_in_window': len(self._outcomes),
+                    'failures_in_window': self._failures,
+                    'times_opened': self.times_opened,
+                    'rejected': self.rejected}
+
+class CircuitBreakers(object):
+    """ One CircuitBreaker per server, or per server and endpoint family """
+
+    def __init__(self, per_endpoint_family=False, **breaker_settings):
+        self.per_endpoint_family = per_endpoint_family
+        self.breaker_settings = breaker_settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, server, endpoint):
+        """ Breaker guarding requests to endpoint on server """
+        name = server
+        if self.per_endpoint_family:
+            name = '%s:%s' % (server, endpoint_family(endpoint))
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = self._breakers[name] = CircuitBreaker(name=name, **self.breaker_settings)
+        return breaker
+
+    def stats(self):
+        """ Return the state of every breaker, keyed by name """
+        return dict((name, breaker.stats()) for name, breaker in list(self._breakers.items()))
+
+class AdaptiveLimiter(object):
+    """ AIMD concurrency limit: grows by one per window of healthy calls, shrinks multiplicatively on errors or rising latency """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=200, latency_tolerance=2.0, decrease_factor=0.7, acquire_timeout=30):
+        """ Recent latency (a fast moving average) is compared with the long term average, when it is more than
+        latency_tolerance times higher the limit shrinks, at most once per round trip.
+        A request waiting more than acquire_timeout seconds for a slot fails with ConcurrencyLimitError """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.acquire_timeout = acquire_timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self.baseline_latency = None
+        self.recent_latency = None
+        self._last_decrease = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """ Wait for a free slot """
+        deadline = now() + self.acquire_timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - now()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise ConcurrencyLimitError('Concurrency limit of %s requests reached, shedding load' % int(self.limit))
+                self._condition.wait(remaining)
+            self.in_flight += 1
+
+    def release(self, latency=None, success=True):
+        """ Free a slot and adjust the limit from the call outcome """
+        with self._condition:
+            self.in_flight -= 1
+            congested = not success
+            if success and latency is not None:
+                if self.baseline_latency is None:
+                    self.baseline_latency = self.recent_latency = latency
+                self.recent_latency += (latency - self.recent_latency) * 0.2
+                self.baseline_latency += (latency - self.baseline_latency) * 0.01
+                congested = self.recent_latency > self.baseline_latency * self.latency_tolerance
+            current = now()
+            if congested:
+                if current - self._last_decrease > (self.recent_latency or 0):
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = current
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._condition.notify()
+
+    def stats(self):
+        """ Return the limiter state as a dictionary """
+        with self._condition:
+            return {'limit': int(self.limit),
+                    'in_flight': self.in_flight,
+                    'rejected': self.rejected,
+                    'baseline_latency': self.baseline_latency,
+                    'recent_latency': self.recent_latency}
@@ -0,0 +1,101 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# Fastest first, the first one installed is used unless ENVIRONMENT_MANAGER_JSON names another
+BACKENDS = ('orjson', 'simplejson', 'json')
+_COMPACT = (',', ':')
+# simplejson's and json's default separators
+_SPACED = (', ', ': ')
+
+def _stdlib():
+    """ simplejson, or the standard library json when it isn't installed """
+    return simplejson if simplejson is not None else json
+
+def _fallback_dumps(value):
+    return _stdlib().dumps(value, separators=_COMPACT)
+
+def _orjson_dumps(value):
+    return _orjson_dumps_bytes(value).decode('utf-8')
+
+def _orjson_dumps_bytes(value):
+    try:
+        return orjson.dumps(value)
+    except TypeError:
+        # Non string keys or types orjson doesn't serialise, eg. Decimal
+        return _fallback_dumps(value).encode('utf-8')
+
+def _module_codec(module):
+    def dumps(value):
+        return module.dumps(value, separators=_COMPACT)
+    def dumps_bytes(value):
+        return dumps(value).encode('utf-8')
+    def loads(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return module.loads(data)
+    return dumps, dumps_bytes, loads
+
+def _codec(name):
+    """ (dumps, dumps_bytes, loads) of a backend, ImportError if it isn't installed """
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+        return _orjson_dumps, _orjson_dumps_bytes, orjson.loads
+    if name == 'simplejson':
+        if simplejson is None:
+            raise ImportError('simplejson is not installed')
+        return _module_codec(simplejson)
+    if name == 'json':
+        return _module_codec(json)
+    raise ValueError('Unknown JSON backend %s, pick one of %s' % (name, ', '.join(BACKENDS)))
+
+BACKEND = None
+_dumps = _dumps_bytes = _loads = None
+
+def use(name=None):
+    """ Switch the JSON backend, by default to the fastest one installed. Returns the backend name """
+    global BACKEND, _dumps, _dumps_bytes, _loads
+    for candidate in ([name] if name else BACKENDS):
+        try:
+            _dumps, _dumps_bytes, _loads = _codec(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+        BACKEND = candidate
+        return BACKEND
+
+def dumps(value):
+    """ Compact JSON text of value """
+    return _dumps(value)
+
+def dumps_bytes(value):
+    """ Compact UTF-8 JSON of value, ready to send as a request body """
+    return _dumps_bytes(value)
+
+def dumps_spaced(value):
+    """ JSON text laid out as simplejson.dumps does by default, for files other tools read. orjson can't space its
+    separators, so this always goes through simplejson or json """
+    return _stdlib().dumps(value, separators=_SPACED)
+
+def loads(data):
+    """ Decode JSON from bytes or text without an intermediate copy where the backend allows, raises ValueError """
+    return _loads(data)
+
+def raw_decoder():
+    """ Decoder with raw_decode(text, index), used to parse values out of a larger text incrementally """
+    return _stdlib().JSONDecoder()
+
+use(os.environ.get('ENVIRONMENT_MANAGER_JSON') or None)
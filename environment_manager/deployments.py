@@ -0,0 +1,347 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+from environment_manager import codec
+from environment_manager.pagination import to_epoch
+from environment_manager.utils import LogWrapper
+
+log = LogWrapper(__name__)
+
+SUCCEEDED = ('success',)
+FAILED = ('failed', 'cancelled')
+# (shortest, longest) seconds between polls per phase. Provisioning instances takes minutes, so early polls are spaced
+# out; once every node is done the final status is seconds away
+PHASE_INTERVALS = {'provisioning': (5.0, 60.0), 'deploying': (2.0, 30.0), 'finishing': (1.0, 5.0)}
+
+def deployment_phase(deployment):
+    """ provisioning before any node reports progress, finishing once every node is done, deploying in between """
+    nodes = ((deployment or {}).get('Value') or {}).get('Nodes') or []
+    statuses = [str(node.get('Status', '')).lower() for node in nodes if isinstance(node, dict)]
+    if not statuses:
+        return 'provisioning'
+    if all(status in SUCCEEDED + FAILED for status in statuses):
+        return 'finishing'
+    return 'deploying'
+
+def _status(deployment):
+    return ((deployment or {}).get('Value') or {}).get('Status')
+
+def _node_states(deployment):
+    """ {instance id: (status, last completed stage)} of a deployment's nodes """
+    nodes = ((deployment or {}).get('Value') or {}).get('Nodes') or []
+    return dict((node.get('InstanceId'), (node.get('Status'), node.get('LastCompletedStage')))
+                for node in nodes if isinstance(node, dict))
+
+class DeploymentEvent(object):
+    """ Something that happened to a watched deployment. kind is one of
+    status: the deployment status changed, or was seen for the first time
+    node: a node changed status or stage, instance is its id
+    succeeded, failed: the deployment finished, failed events carry the logs of its failed instances if requested
+    error: the deployment could not be read max_errors times in a row and is no longer watched
+    timeout: the deployment was still running at the deadline """
+
+    __slots__ = ('kind', 'deployment_id', 'status', 'previous_status', 'deployment', 'instance', 'logs', 'error', 'time')
+
+    def __init__(self, kind, deployment_id, status=None, previous_status=None, deployment=None, instance=None, logs=None, error=None):
+        self.kind = kind
+        self.deployment_id = deployment_id
+        self.status = status
+        self.previous_status = previous_status
+        self.deployment = deployment
+        self.instance = instance
+        self.logs = logs
+        self.error = error
+        self.time = time.time()
+
+    def __repr__(self):
+        return 'DeploymentEvent(%s, %s, %s)' % (self.kind, self.deployment_id, self.instance or self.status)
+
+class _Watch(object):
+    """ Polling state of one deployment """
+
+    __slots__ = ('deployment_id', 'deployment', 'status', 'nodes', 'interval', 'next_poll', 'errors')
+
+    def __init__(self, deployment_id, now):
+        self.deployment_id = deployment_id
+        self.deployment = None
+        self.status = None
+        self.nodes = {}
+        self.interval = None
+        self.next_poll = now
+        self.errors = 0
+
+    def schedule(self, now, changed, backoff):
+        """ Poll again soon after a change, backing off while nothing happens, within the bounds of the phase """
+        shortest, longest = PHASE_INTERVALS[deployment_phase(self.deployment)]
+        if changed or self.interval is None:
+            self.interval = shortest
+        else:
+            self.interval = self.interval * backoff
+        self.interval = min(longest, max(shortest, self.interval))
+        self.next_poll = now + self.interval
+
+class DeploymentWaiter(object):
+    """ Watches many deployments with one scheduler: every tick reads the deployments that are due concurrently,
+    and each deployment's poll interval adapts to its phase and to whether it is still changing """
+
+    def __init__(self, em_session, deployment_ids, timeout=3600, max_workers=10, backoff=1.5, stop_on_failure=True,
+                 fetch_logs=False, max_errors=5, coalesce=0.25):
+        """ Deployments due within coalesce of their interval are read in the same tick, so 50 deployments cost a
+        handful of concurrent batches rather than 50 independent loops. The waiter ends at the first failed
+        deployment unless stop_on_failure is False; with fetch_logs failed events carry get_deployment_log of the
+        failed instances """
+        self.em_session = em_session
+        self.deployment_ids = list(deployment_ids)
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.backoff = backoff
+        self.stop_on_failure = stop_on_failure
+        self.fetch_logs = fetch_logs
+        self.max_errors = max_errors
+        self.coalesce = coalesce
+        self.polls = 0
+        self.results = {}
+
+    def _read(self, watches):
+        calls = [('get_deployment', {'deployment_id': watch.deployment_id, 'use_cache': False}) for watch in watches]
+        self.polls += len(calls)
+        return self.em_session.batch(calls, max_workers=self.max_workers)
+
+    def _failed_logs(self, deployment):
+        """ {instance id: log text or error} of the failed nodes of a deployment """
+        failed = [instance for instance, (status, stage) in _node_states(deployment).items()
+                  if str(status).lower() in FAILED and instance]
+        if not failed:
+            return {}
+        account = deployment.get('AccountName') or 'Non-Prod'
+        calls = [('get_deployment_log', {'deployment_id': deployment.get('DeploymentID'), 'account': account, 'instance': instance})
+                 for instance in failed]
+        return dict((result.kwargs['instance'], result.result if result.ok else result.error)
+                    for result in self.em_session.batch(calls, max_workers=self.max_workers))
+
+    def _update(self, watch, deployment, now):
+        """ Events from a fresh read of a deployment """
+        events = []
+        previous = watch.status
+        status = _status(deployment)
+        nodes = _node_states(deployment)
+        changed = status != previous or nodes != watch.nodes
+        if status != previous:
+            events.append(DeploymentEvent('status', watch.deployment_id, status, previous, deployment))
+        for instance, state in sorted(nodes.items()):
+            if watch.nodes.get(instance) != state:
+                events.append(DeploymentEvent('node', watch.deployment_id, state[0], (watch.nodes.get(instance) or (None,))[0],
+                                              deployment, instance=instance))
+        watch.deployment = deployment
+        watch.status = status
+        watch.nodes = nodes
+        watch.errors = 0
+        final = str(status).lower()
+        if final in SUCCEEDED:
+            events.append(DeploymentEvent('succeeded', watch.deployment_id, status, previous, deployment))
+        elif final in FAILED:
+            logs = self._failed_logs(deployment) if self.fetch_logs else None
+            events.append(DeploymentEvent('failed', watch.deployment_id, status, previous, deployment, logs=logs))
+        else:
+            watch.schedule(now, changed, self.backoff)
+        return events
+
+    def __iter__(self):
+        now = time.time()
+        deadline = now + self.timeout if self.timeout is not None else None
+        watching = dict((deployment_id, _Watch(deployment_id, now)) for deployment_id in self.deployment_ids)
+        while watching:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                for watch in watching.values():
+                    self.results[watch.deployment_id] = 'timeout'
+                    yield DeploymentEvent('timeout', watch.deployment_id, watch.status, deployment=watch.deployment)
+                return
+            first_due = min(watch.next_poll for watch in watching.values())
+            if first_due > now:
+                time.sleep(min(first_due, deadline if deadline is not None else first_due) - now)
+                continue
+            due = [watch for watch in watching.values() if watch.next_poll <= now + self.coalesce * (watch.interval or 0)]
+            for result in self._read(due):
+                watch = watching[result.kwargs['deployment_id']]
+                if not result.ok:
+                    watch.errors += 1
+                    log.info('Could not read deployment %s: %s', watch.deployment_id, result.error)
+                    if watch.errors >= self.max_errors:
+                        del watching[watch.deployment_id]
+                        self.results[watch.deployment_id] = 'error'
+                        yield DeploymentEvent('error', watch.deployment_id, watch.status, deployment=watch.deployment, error=result.error)
+                    else:
+                        watch.schedule(time.time(), False, self.backoff)
+                    continue
+                for event in self._update(watch, result.result, time.time()):
+                    if event.kind in ('succeeded', 'failed'):
+                        del watching[watch.deployment_id]
+                        self.results[watch.deployment_id] = event.kind
+                    yield event
+                    if event.kind == 'failed' and self.stop_on_failure:
+                        return
+
+class LogLine(object):
+    """ A new line of an instance's deployment log """
+
+    __slots__ = ('deployment_id', 'instance', 'number', 'text', 'timestamp')
+
+    def __init__(self, deployment_id, instance, number, text, timestamp):
+        self.deployment_id = deployment_id
+        self.instance = instance
+        self.number = number
+        self.text = text
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return 'LogLine(%s:%s %r)' % (self.instance, self.number, self.text)
+
+class _LogCursor(object):
+    """ How much of an instance's log has been emitted and when to read it again """
+
+    __slots__ = ('instance', 'offset', 'lines', 'interval', 'next_poll', 'done', 'errors')
+
+    def __init__(self, instance, now, interval):
+        self.instance = instance
+        self.offset = 0
+        self.lines = 0
+        self.interval = interval
+        self.next_poll = now
+        self.done = False
+        self.errors = 0
+
+def _line_time(line, default):
+    """ Epoch seconds of the timestamp a log line starts with, default if it has none """
+    moment = to_epoch(line.split(' ', 1)[0]) if line[:1].isdigit() else None
+    return moment if moment is not None else default
+
+class DeploymentLogTail(object):
+    """ Follows the logs of every instance of a deployment as one stream of new lines. get_deployment_log returns a
+    whole log, so each instance keeps an offset and only what follows it is emitted. Instances are read concurrently,
+    each as often as its log grows: idle logs back off to max_interval, and an instance is read a last time once its
+    node has finished, then dropped """
+
+    def __init__(self, em_session, deployment_id, account=None, instances=None, follow=True, timeout=3600,
+                 min_interval=1.0, max_interval=30.0, max_workers=10, max_errors=3):
+        """ Instances default to the nodes of the deployment, picked up as they appear. account defaults to the
+        deployment's. Without follow every log is read once. Lines read in the same round are ordered by their
+        leading timestamp. A finished instance whose log could not be read max_errors times in a row is dropped,
+        and the tail ends after timeout seconds in any case """
+        self.em_session = em_session
+        self.deployment_id = deployment_id
+        self.account = account
+        self.instances = list(instances) if instances is not None else None
+        self.follow = follow
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_workers = max_workers
+        self.max_errors = max_errors
+        self.reads = 0
+        self.bytes_read = 0
+
+    def _deployment(self):
+        deployment = self.em_session.get_deployment(deployment_id=self.deployment_id, use_cache=False)
+        if self.account is None:
+            self.account = deployment.get('AccountName') or 'Non-Prod'
+        return deployment
+
+    def _read_logs(self, cursors):
+        calls = [('get_deployment_log', {'deployment_id': self.deployment_id, 'account': self.account,
+                                         'instance': cursor.instance, 'use_cache': False}) for cursor in cursors]
+        self.reads += len(calls)
+        return self.em_session.batch(calls, max_workers=self.max_workers)
+
+    def _new_lines(self, cursor, text, now):
+        """ Lines after the cursor's offset, holding back a trailing partial line unless the instance is done """
+        if not isinstance(text, str):
+            text = '\n'.join(text) if isinstance(text, list) else codec.dumps(text)
+        self.bytes_read += len(text)
+        if len(text) < cursor.offset:
+            log.info('Log of %s got shorter, reading it from the start', cursor.instance)
+            cursor.offset = 0
+        end = len(text) if cursor.done else text.rfind('\n') + 1
+        if end <= cursor.offset:
+            return []
+        fresh = text[cursor.offset:end]
+        cursor.offset = end
+        lines = []
+        for line in fresh.splitlines():
+            cursor.lines += 1
+            lines.append(LogLine(self.deployment_id, cursor.instance, cursor.lines, line, _line_time(line, now)))
+        return lines
+
+    def __iter__(self):
+        now = time.time()
+        deadline = now + self.timeout if self.timeout is not None else None
+        cursors = {}
+        completed = set()
+        finished = False
+        if self.instances is not None:
+            for instance in self.instances:
+                cursors[instance] = _LogCursor(instance, now, self.min_interval)
+        while True:
+            now = time.time()
+            if not finished:
+                deployment = self._deployment()
+                finished = not self.follow or str(_status(deployment)).lower() in SUCCEEDED + FAILED
+                for instance, (status, stage) in _node_states(deployment).items():
+                    if self.instances is None and instance not in cursors and instance not in completed:
+                        cursors[instance] = _LogCursor(instance, now, self.min_interval)
+                    if instance in cursors and str(status).lower() in SUCCEEDED + FAILED:
+                        cursors[instance].done = True
+                for cursor in cursors.values():
+                    if finished:
+                        cursor.done = True
+                    if cursor.done:
+                        # One last read picks up the end of the log
+                        cursor.next_poll = now
+            due = [cursor for cursor in cursors.values() if cursor.next_poll <= now]
+            lines = []
+            for result in self._read_logs(due):
+                cursor = cursors[result.kwargs['instance']]
+                if not result.ok:
+                    cursor.errors += 1
+                    log.info('Could not read the log of %s: %s', cursor.instance, result.error)
+                    if cursor.done and cursor.errors >= self.max_errors:
+                        log.warning('Giving up on the log of %s after %s failed reads', cursor.instance, cursor.errors)
+                        del cursors[cursor.instance]
+                        completed.add(cursor.instance)
+                        continue
+                    cursor.interval = min(self.max_interval, cursor.interval * 2)
+                    cursor.next_poll = time.time() + cursor.interval
+                    continue
+                cursor.errors = 0
+                fresh = self._new_lines(cursor, result.result, now)
+                lines.extend(fresh)
+                if cursor.done:
+                    del cursors[cursor.instance]
+                    completed.add(cursor.instance)
+                    continue
+                cursor.interval = self.min_interval if fresh else min(self.max_interval, cursor.interval * 2)
+                cursor.next_poll = time.time() + cursor.interval
+            lines.sort(key=lambda line: (line.timestamp, line.instance, line.number))
+            for line in lines:
+                yield line
+            if finished and not cursors:
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            wake = min([cursor.next_poll for cursor in cursors.values()] or [time.time() + self.min_interval])
+            if not finished:
+                # The deployment is read again at least every max_interval to notice new and finished nodes
+                wake = min(wake, time.time() + self.max_interval)
+            if deadline is not None:
+                wake = min(wake, deadline)
+            time.sleep(max(0.0, wake - time.time()))
+
+def wait_for_deployments(em_session, deployment_ids, timeout=3600, **settings):
+    """ Yield DeploymentEvents of the given deployments until they have all finished or timeout seconds have passed,
+    see DeploymentWaiter for settings """
+    return iter(DeploymentWaiter(em_session, deployment_ids, timeout=timeout, **settings))
+
+def tail_deployment_logs(em_session, deployment_id, follow=True, **settings):
+    """ Yield the new LogLines of every instance of a deployment until it has finished, see DeploymentLogTail """
+    return iter(DeploymentLogTail(em_session, deployment_id, follow=follow, **settings))
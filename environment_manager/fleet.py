@@ -0,0 +1,246 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from environment_manager.retry import Deadline
+from environment_manager.utils import LogWrapper
+
+log = LogWrapper(__name__)
+
+def _asg_names(result):
+    """ ASG names out of a get_service_asgs response, a list of names or of ASG objects """
+    names = []
+    for item in result if isinstance(result, list) else []:
+        if isinstance(item, dict):
+            item = item.get('AutoScalingGroupName') or item.get('Name')
+        if item:
+            names.append(item)
+    return names
+
+def _health_verdict(health):
+    """ True or False from a service health response, by its OverallHealth or else its unhealthy counts, None if it
+    says neither """
+    if not isinstance(health, dict):
+        return None
+    if 'OverallHealth' in health:
+        return str(health['OverallHealth']).lower() == 'healthy'
+    counts = [health.get(name) for name in ('UnhealthyCount', 'Unhealthy', 'UnhealthyInstances')]
+    counts = [count for count in counts if count is not None]
+    if counts:
+        return not any(len(count) if isinstance(count, list) else count for count in counts)
+    return None
+
+class ServiceStatus(object):
+    """ Health of one service in one environment, a cell of the fleet matrix """
+
+    __slots__ = ('service', 'environment', 'overall', 'slices', 'asgs', 'errors', 'pending')
+
+    def __init__(self, service, environment):
+        self.service = service
+        self.environment = environment
+        self.overall = None
+        # slice: get_service_health result
+        self.slices = {}
+        # ASG name: {'ready': get_asg_ready result, 'ips': get_asg_ips result}
+        self.asgs = {}
+        # (method, kwargs) of the calls feeding this cell that failed, with their error
+        self.errors = []
+        # Calls feeding this cell that hadn't finished at the deadline
+        self.pending = 0
+
+    @property
+    def complete(self):
+        return not self.errors and not self.pending
+
+    @property
+    def healthy(self):
+        """ True if the service and each checked slice report healthy and every ASG is ready, False if anything says
+        otherwise, None if that can't be told from the results that came back """
+        verdicts = [_health_verdict(self.overall)]
+        verdicts.extend(_health_verdict(health) for health in self.slices.values())
+        verdicts = [verdict for verdict in verdicts if verdict is not None]
+        for asg in self.asgs.values():
+            ready = asg.get('ready')
+            if isinstance(ready, dict) and 'ReadyToDeploy' in ready:
+                verdicts.append(bool(ready['ReadyToDeploy']))
+        if False in verdicts:
+            return False
+        if not verdicts or not self.complete:
+            return None
+        return True
+
+    def __repr__(self):
+        return 'ServiceStatus(%s, %s, healthy=%s)' % (self.service, self.environment, self.healthy)
+
+class FleetHealth(object):
+    """ Consolidated result of a fleet check: one ServiceStatus per service and environment """
+
+    def __init__(self, cells, calls, deduplicated, elapsed, timed_out):
+        self.cells = cells
+        self.calls = calls
+        self.deduplicated = deduplicated
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+    def __getitem__(self, key):
+        """ ServiceStatus of a (service, environment) """
+        return self.cells[key]
+
+    @property
+    def complete(self):
+        """ True if every call came back """
+        return all(cell.complete for cell in self.cells.values())
+
+    @property
+    def healthy(self):
+        """ True if every cell is healthy, False if any isn't, None if some can't be told """
+        verdicts = [cell.healthy for cell in self.cells.values()]
+        if False in verdicts:
+            return False
+        if None in verdicts:
+            return None
+        return True
+
+    def matrix(self):
+        """ {service: {environment: True, False or None}} """
+        matrix = {}
+        for (service, environment), cell in self.cells.items():
+            matrix.setdefault(service, {})[environment] = cell.healthy
+        return matrix
+
+    def unhealthy(self):
+        """ Cells known to be unhealthy """
+        return [cell for cell in self.cells.values() if cell.healthy is False]
+
+class FleetCheck(object):
+    """ Checks a set of services across a set of environments with as few Environment Manager calls as possible.
+    Every (service, environment) needs its overall health and ASGs; every ASG found then needs its readiness (and IPs),
+    read once however many services share it. Calls run concurrently, the ASG ones starting as soon as the ASG list
+    they depend on comes back. Whatever hasn't finished by the deadline is reported as pending """
+
+    def __init__(self, em_session, services, environments, slices=None, include_ips=True, inventory=None,
+                 deadline=30, max_workers=20):
+        """ slices adds get_service_health of each slice. With an Inventory the ASGs of each service are looked up
+        locally instead of calling get_service_asgs. deadline is in seconds, None waits for everything """
+        self.em_session = em_session
+        self.services = list(services)
+        self.environments = list(environments)
+        self.slices = list(slices or [])
+        self.include_ips = include_ips
+        self.inventory = inventory
+        self.deadline = deadline
+        self.max_workers = max_workers
+
+    def plan(self):
+        """ Calls needed before any ASG is known, as (method, kwargs, cell keys) """
+        calls = []
+        for service in self.services:
+            for environment in self.environments:
+                cell = [(service, environment)]
+                calls.append(('get_service_overall_health', {'service': service, 'environment': environment}, cell))
+                if self.inventory is None:
+                    calls.append(('get_service_asgs', {'service': service, 'environment': environment}, cell))
+                for slice in self.slices:
+                    calls.append(('get_service_health', {'service': service, 'environment': environment, 'slice': slice}, cell))
+        return calls
+
+    def _asg_calls(self, environment, asgnames, cell):
+        calls = []
+        for asgname in asgnames:
+            calls.append(('get_asg_ready', {'environment': environment, 'asgname': asgname}, [cell]))
+            if self.include_ips:
+                calls.append(('get_asg_ips', {'environment': environment, 'asgname': asgname}, [cell]))
+        return calls
+
+    def run(self):
+        """ Run the check and return a FleetHealth """
+        started = time.time()
+        deadline = Deadline(self.deadline)
+        cells = dict(((service, environment), ServiceStatus(service, environment))
+                     for service in self.services for environment in self.environments)
+        calls = self.plan()
+        if self.inventory is not None:
+            for service, environment in cells:
+                asgnames = [asg.name for asg in self.inventory.service_asgs(service, environment)]
+                calls.extend(self._asg_calls(environment, asgnames, (service, environment)))
+        # Call key: cells waiting on it, so an ASG shared by services is read once and feeds them all
+        planned = {}
+        futures = {}
+        finished = {}
+        remaining = set()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        deduplicated = [0]
+
+        def submit(pending_calls):
+            for method, kwargs, keys in pending_calls:
+                call_key = (method, tuple(sorted(kwargs.items())))
+                if call_key in planned:
+                    added = [key for key in keys if key not in planned[call_key]]
+                    planned[call_key].extend(added)
+                    deduplicated[0] += 1
+                    if call_key in finished:
+                        # Already answered for other cells, hand the same result to these
+                        self._record(finished[call_key], method, kwargs, [cells[key] for key in added])
+                    continue
+                planned[call_key] = list(keys)
+                futures[executor.submit(getattr(self.em_session, method), **kwargs)] = (method, kwargs, call_key)
+
+        try:
+            self.em_session._get_token()
+            submit(calls)
+            remaining.update(futures)
+            while remaining:
+                timeout = deadline.remaining()
+                if timeout is not None and timeout <= 0:
+                    break
+                done, remaining = wait(remaining, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    method, kwargs, call_key = futures[future]
+                    finished[call_key] = future
+                    more = self._record(future, method, kwargs, [cells[key] for key in planned[call_key]])
+                    if more:
+                        before = set(futures)
+                        submit(more)
+                        remaining.update(set(futures) - before)
+        finally:
+            for future in futures:
+                future.cancel()
+            # Calls still running at the deadline are left to finish in the background, nobody waits for them
+            executor.shutdown(wait=False)
+        for future in remaining:
+            method, kwargs, call_key = futures[future]
+            for key in planned[call_key]:
+                cells[key].pending += 1
+        if remaining:
+            log.info('Fleet check deadline reached with %s calls pending', len(remaining))
+        return FleetHealth(cells, len(futures), deduplicated[0], time.time() - started, bool(remaining))
+
+    def _record(self, future, method, kwargs, targets):
+        """ Store a call's result in the cells waiting on it, returns the calls it makes necessary """
+        error = future.exception()
+        if error is not None:
+            for cell in targets:
+                cell.errors.append(((method, kwargs), error))
+            return []
+        result = future.result()
+        more = []
+        for cell in targets:
+            if method == 'get_service_overall_health':
+                cell.overall = result
+            elif method == 'get_service_health':
+                cell.slices[kwargs['slice']] = result
+            elif method == 'get_service_asgs':
+                asgnames = _asg_names(result)
+                for asgname in asgnames:
+                    cell.asgs.setdefault(asgname, {})
+                more.extend(self._asg_calls(kwargs['environment'], asgnames, (cell.service, cell.environment)))
+            elif method == 'get_asg_ready':
+                cell.asgs.setdefault(kwargs['asgname'], {})['ready'] = result
+            elif method == 'get_asg_ips':
+                cell.asgs.setdefault(kwargs['asgname'], {})['ips'] = result
+        return more
+
+def check_fleet(em_session, services, environments, **settings):
+    """ Health of services across environments in one FleetHealth, see FleetCheck for settings """
+    return FleetCheck(em_session, services, environments, **settings).run()
@@ -0,0 +1,202 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import hashlib
+import threading
+import time
+from environment_manager import codec
+from environment_manager.models import Asg, Instance
+from environment_manager.utils import LogWrapper
+
+log = LogWrapper(__name__)
+
+def _group(records, key):
+    """ Index records by key(record), skipping records without one """
+    index = {}
+    for record in records:
+        value = key(record)
+        if value is not None:
+            index.setdefault(value, []).append(record)
+    return index
+
+class _Indexes(object):
+    """ Immutable lookup tables over one snapshot, swapped whole on refresh so readers never see a partial update """
+
+    def __init__(self, instances, asgs):
+        self.instance_by_id = dict((record.instance_id, record) for record in instances)
+        self.asg_by_name = dict((record.name, record) for record in asgs)
+        # An instance or ASG listed under two accounts is only counted once
+        self.instances = instances = list(self.instance_by_id.values())
+        self.asgs = asgs = list(self.asg_by_name.values())
+        self.instance_by_ip = dict((record.ip, record) for record in instances if record.ip)
+        # Instances only know their ASG from a tag, fill in what the ASG knows
+        for asg in asgs:
+            for instance_id in asg.instance_ids:
+                instance = self.instance_by_id.get(instance_id)
+                if instance is not None and instance.asg is None:
+                    instance.asg = asg.name
+        for instance in instances:
+            asg = self.asg_by_name.get(instance.asg)
+            if asg is not None:
+                instance.environment = instance.environment or asg.environment
+                instance.cluster = instance.cluster or asg.cluster
+                instance.service = instance.service or asg.service
+        self.instances_by = {
+            'environment': _group(instances, lambda record: record.environment),
+            'cluster': _group(instances, lambda record: record.cluster),
+            'service': _group(instances, lambda record: record.service),
+            'asg': _group(instances, lambda record: record.asg),
+            'service_environment': _group(instances, lambda record: (record.service, record.environment) if record.service else None),
+        }
+        self.asgs_by = {
+            'environment': _group(asgs, lambda record: record.environment),
+            'cluster': _group(asgs, lambda record: record.cluster),
+            'service': _group(asgs, lambda record: record.service),
+            'service_environment': _group(asgs, lambda record: (record.service, record.environment) if record.service else None),
+        }
+
+def _select(records_by, everything, criteria):
+    """ Records matching every criterion, starting from the smallest matching index """
+    criteria = dict((name, value) for name, value in criteria.items() if value is not None)
+    if 'service' in criteria and 'environment' in criteria:
+        candidates = records_by['service_environment'].get((criteria.pop('service'), criteria.pop('environment')), [])
+    elif criteria:
+        candidates = min((records_by[name].get(value, []) for name, value in criteria.items()), key=len)
+    else:
+        return list(everything)
+    return [record for record in candidates if all(getattr(record, name) == value for name, value in criteria.items())]
+
+class Inventory(object):
+    """ In-memory snapshot of instances and ASGs of some accounts, indexed by environment, cluster, service, ASG name,
+    instance id and IP. Each account is downloaded with one get_instances and one get_asgs call, lookups are local """
+
+    def __init__(self, em_session, accounts=None, max_age=300, max_workers=4):
+        """ accounts defaults to every account from get_accounts_config. refresh re-downloads a snapshot older than
+        max_age seconds. With a client made with conditional_requests=ValidatorStore(copy_results=False) an unchanged
+        collection costs a 304 and is not parsed again. Building the inventory doesn't download anything, call
+        refresh or start """
+        self.em_session = em_session
+        self.accounts = list(accounts) if accounts is not None else None
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.loaded_at = None
+        self.errors = {}
+        self._parts = {}
+        self._digests = {}
+        self._indexes = _Indexes([], [])
+        self._refresh_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _account_names(self):
+        if self.accounts is None:
+            self.accounts = [account['AccountName'] for account in self.em_session.get_accounts_config()]
+        return self.accounts
+
+    def _load(self, kind, account):
+        """ Normalised records of one collection of an account, None if it hasn't changed since the last load """
+        record_type = Instance if kind == 'instances' else Asg
+        if self.em_session.validators is None:
+            # Streamed, only one decoded item is held at a time
+            items = getattr(self.em_session, 'iter_%s' % kind)(account=account)
+        else:
+            # Conditional request, an unchanged collection costs a 304 and comes back equal to the previous one. Only
+            # a digest of it is kept to tell
+            items = getattr(self.em_session, 'get_%s' % kind)(account=account)
+            digest = hashlib.sha1(codec.dumps_bytes(items)).digest()
+            if digest == self._digests.get((kind, account)):
+                return None
+            self._digests[(kind, account)] = digest
+        return [record_type.from_response(item, account) for item in items if isinstance(item, dict)]
+
+    def refresh(self, force=False):
+        """ Download the snapshot again if it's older than max_age, or always with force. Collections that fail keep
+        their previous records and their error is kept in errors. Returns True if anything changed """
+        with self._refresh_lock:
+            if not force and self.loaded_at is not None and time.time() - self.loaded_at < self.max_age:
+                return False
+            started = time.time()
+            calls = [(self._load, {'kind': kind, 'account': account})
+                     for account in self._account_names() for kind in ('instances', 'asgs')]
+            changed = False
+            errors = {}
+            for result in self.em_session.batch(calls, max_workers=self.max_workers):
+                part = (result.kwargs['kind'], result.kwargs['account'])
+                if not result.ok:
+                    log.info('Could not load %s of account %s: %s', part[0], part[1], result.error)
+                    errors[part] = result.error
+                elif result.result is not None:
+                    self._parts[part] = result.result
+                    changed = True
+            self.errors = errors
+            if changed or self.loaded_at is None:
+                instances = [record for (kind, account), records in self._parts.items() if kind == 'instances' for record in records]
+                asgs = [record for (kind, account), records in self._parts.items() if kind == 'asgs' for record in records]
+                self._indexes = _Indexes(instances, asgs)
+            self.loaded_at = started
+            return changed
+
+    def start(self, interval=None):
+        """ Load now, then refresh from a background thread every interval seconds (default max_age) """
+        interval = interval or self.max_age
+        self.refresh(force=True)
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._refresh_loop, args=(interval,), name='em-inventory-refresh')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _refresh_loop(self, interval):
+        while not self._stopping.wait(interval):
+            try:
+                self.refresh(force=True)
+            except Exception as error:
+                log.error('Inventory refresh failed: %s', error)
+
+    def stop(self):
+        """ Stop background refreshes """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def instance(self, instance_id):
+        """ Instance with this id, None if unknown """
+        return self._indexes.instance_by_id.get(instance_id)
+
+    def instance_by_ip(self, ip):
+        """ Instance with this private IP, None if unknown """
+        return self._indexes.instance_by_ip.get(ip)
+
+    def instances(self, environment=None, cluster=None, service=None, asg=None):
+        """ Instances matching all the given criteria """
+        indexes = self._indexes
+        return _select(indexes.instances_by, indexes.instances,
+                       {'environment': environment, 'cluster': cluster, 'service': service, 'asg': asg})
+
+    def asg(self, name):
+        """ ASG with this name, None if unknown """
+        return self._indexes.asg_by_name.get(name)
+
+    def asgs(self, environment=None, cluster=None, service=None):
+        """ ASGs matching all the given criteria """
+        indexes = self._indexes
+        return _select(indexes.asgs_by, indexes.asgs, {'environment': environment, 'cluster': cluster, 'service': service})
+
+    def environment_servers(self, environment):
+        """ Instances of an environment grouped by ASG name, the local counterpart of get_environment_servers """
+        return _group(self.instances(environment=environment), lambda record: record.asg)
+
+    def service_asgs(self, service, environment, slice=None):
+        """ ASGs a service runs on in an environment, the local counterpart of get_service_asgs """
+        return [asg for asg in self.asgs(environment=environment, service=service) if slice is None or asg.slice == slice]
+
+    def __len__(self):
+        return len(self._indexes.instances)
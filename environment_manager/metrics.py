@@ -0,0 +1,146 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import bisect
+import threading
+
+# Seconds, tuned for calls that usually take tens to hundreds of milliseconds
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(object):
+    """ Cumulative-bucket histogram, not thread-safe on its own """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, quantile):
+        """ Upper bound of the bucket holding the given quantile, None without observations """
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def as_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += bucket_count
+            buckets['+Inf' if bound == float('inf') else repr(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+class MetricsRegistry(object):
+    """ In-process metrics fed by EMApi request hooks: per-endpoint latency histograms, request, error and retry counters """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS, prefix='environment_manager'):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.latency = {}
+        self.decode_latency = {}
+        self.requests = {}
+        self.errors = {}
+        self.retries = {}
+        self.response_bytes = {}
+        self._lock = threading.Lock()
+
+    def install(self, client):
+        """ Register our hooks on an EMApi """
+        client.add_hook('post_request', self.post_request)
+        client.add_hook('decode', self.decoded)
+        return self
+
+    @classmethod
+    def _increment(cls, counters, key, value=1):
+        counters[key] = counters.get(key, 0) + value
+
+    def post_request(self, event):
+        """ Hook receiving every finished HTTP request """
+        key = (event['template'], event['method'])
+        with self._lock:
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram(self.buckets)
+            histogram.observe(event['elapsed'])
+            status = event.get('status')
+            self._increment(self.requests, key + (str(status) if status is not None else 'none',))
+            if event.get('attempt', 1) > 1:
+                self._increment(self.retries, key)
+            if event.get('error') is not None:
+                self._increment(self.errors, key + (event['error'],))
+            elif status is not None and status >= 400:
+                self._increment(self.errors, key + ('http_%s' % status,))
+            if event.get('bytes'):
+                self._increment(self.response_bytes, key, event['bytes'])
+
+    def decoded(self, event):
+        """ Hook receiving JSON decode timings """
+        with self._lock:
+            histogram = self.decode_latency.get(event['template'])
+            if histogram is None:
+                histogram = self.decode_latency[event['template']] = Histogram(self.buckets)
+            histogram.observe(event['elapsed'])
+
+    def as_dict(self):
+        """ Snapshot of every metric as plain dictionaries """
+        with self._lock:
+            return {'latency': dict(('%s %s' % (method, template), histogram.as_dict()) for (template, method), histogram in self.latency.items()),
+                    'decode_latency': dict((template, histogram.as_dict()) for template, histogram in self.decode_latency.items()),
+                    'requests': dict(('%s %s %s' % (method, template, status), count) for (template, method, status), count in self.requests.items()),
+                    'errors': dict(('%s %s %s' % (method, template, kind), count) for (template, method, kind), count in self.errors.items()),
+                    'retries': dict(('%s %s' % (method, template), count) for (template, method), count in self.retries.items()),
+                    'response_bytes': dict(('%s %s' % (method, template), count) for (template, method), count in self.response_bytes.items())}
+
+    @classmethod
+    def _labels(cls, **labels):
+        return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in sorted(labels.items()))
+
+    def _histogram_lines(self, name, histogram, **labels):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{%s} %s' % (name, self._labels(le=le, **labels), cumulative))
+        lines.append('%s_sum{%s} %s' % (name, self._labels(**labels), histogram.sum))
+        lines.append('%s_count{%s} %s' % (name, self._labels(**labels), histogram.count))
+        return lines
+
+    def as_prometheus(self):
+        """ Metrics in the Prometheus text exposition format """
+        prefix = self.prefix
+        lines = []
+        with self._lock:
+            lines.append('# TYPE %s_request_duration_seconds histogram' % prefix)
+            for (template, method), histogram in sorted(self.latency.items()):
+                lines.extend(self._histogram_lines('%s_request_duration_seconds' % prefix, histogram, endpoint=template, method=method))
+            lines.append('# TYPE %s_decode_duration_seconds histogram' % prefix)
+            for template, histogram in sorted(self.decode_latency.items()):
+                lines.extend(self._histogram_lines('%s_decode_duration_seconds' % prefix, histogram, endpoint=template))
+            lines.append('# TYPE %s_requests_total counter' % prefix)
+            for (template, method, status), count in sorted(self.requests.items()):
+                lines.append('%s_requests_total{%s} %s' % (prefix, self._labels(endpoint=template, method=method, status=status), count))
+            lines.append('# TYPE %s_errors_total counter' % prefix)
+            for (template, method, kind), count in sorted(self.errors.items()):
+                lines.append('%s_errors_total{%s} %s' % (prefix, self._labels(endpoint=template, method=method, kind=kind), count))
+            lines.append('# TYPE %s_retries_total counter' % prefix)
+            for (template, method), count in sorted(self.retries.items()):
+                lines.append('%s_retries_total{%s} %s' % (prefix, self._labels(endpoint=template, method=method), count))
+            lines.append('# TYPE %s_response_bytes_total counter' % prefix)
+            for (template, method), count in sorted(self.response_bytes.items()):
+                lines.append('%s_response_bytes_total{%s} %s' % (prefix, self._labels(endpoint=template, method=method), count))
+        return '\n'.join(lines) + '\n'
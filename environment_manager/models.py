@@ -0,0 +1,128 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+from environment_manager import codec
+from environment_manager.utils import intern_string
+
+# Tag AWS puts on instances launched by an auto scaling group
+ASG_TAG = 'aws:autoscaling:groupName'
+
+def tags_of(item):
+    """ AWS style [{'Key': k, 'Value': v}] tags of an item as a dict """
+    tags = item.get('Tags')
+    if isinstance(tags, dict):
+        return tags
+    return dict((tag.get('Key'), tag.get('Value')) for tag in tags or () if isinstance(tag, dict))
+
+def _first(item, tags, *names):
+    """ First of the given attributes set on the item itself or in its tags """
+    for name in names:
+        value = item.get(name)
+        if value is None:
+            value = tags.get(name)
+        if value is not None:
+            return value
+    return None
+
+def _encode(value):
+    # Through text, orjson's bytes results keep their over-allocated buffer and would cost 1KiB each
+    return codec.dumps(value).encode('utf-8') if value is not None else None
+
+def _nested(name):
+    """ Property decoding a nested field kept as compact JSON, parsed again on every access """
+    slot = '_' + name
+    def getter(self):
+        encoded = getattr(self, slot)
+        return codec.loads(encoded) if encoded is not None else None
+    def setter(self, value):
+        setattr(self, slot, _encode(value))
+    return property(getter, setter, doc='%s, decoded on access' % name)
+
+class Model(object):
+    """ Compact record of an Environment Manager response item. Fields used for lookups are slots, with repeated
+    names interned; nested structures are kept encoded and only decoded when read. Subclasses build records from
+    response items with their from_response classmethod """
+
+    __slots__ = ()
+    # Plain fields, then nested ones stored in a slot of the same name with a leading underscore
+    _fields = ()
+    _nested_fields = ()
+
+    def _set(self, interned=(), nested=None, **values):
+        for name in self._fields:
+            value = values.get(name)
+            setattr(self, name, intern_string(value) if name in interned else value)
+        for name in self._nested_fields:
+            setattr(self, '_' + name, _encode((nested or {}).get(name)))
+
+    def as_dict(self):
+        """ Fields as a dict, nested ones decoded """
+        values = dict((name, getattr(self, name)) for name in self._fields)
+        values.update((name, getattr(self, name)) for name in self._nested_fields)
+        return values
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self._fields[:3]))
+
+class Instance(Model):
+    """ Item of get_instances """
+
+    _fields = ('instance_id', 'ip', 'state', 'environment', 'cluster', 'service', 'asg', 'account', 'instance_type',
+               'availability_zone', 'launch_time')
+    _nested_fields = ('tags',)
+    __slots__ = _fields + tuple('_' + name for name in _nested_fields)
+    tags = _nested('tags')
+
+    @classmethod
+    def from_response(cls, item, account=None):
+        tags = tags_of(item)
+        state = item.get('State')
+        placement = item.get('Placement') or {}
+        record = cls()
+        record._set(instance_id=item.get('InstanceId'), ip=item.get('PrivateIpAddress'),
+                    state=state.get('Name') if isinstance(state, dict) else state,
+                    environment=_first(item, tags, 'Environment', 'EnvironmentName'),
+                    cluster=_first(item, tags, 'OwningCluster', 'Cluster'), service=_first(item, tags, 'ServiceName', 'Role'),
+                    asg=_first(item, tags, 'AutoScalingGroup', ASG_TAG), account=account or item.get('AccountName'),
+                    instance_type=item.get('InstanceType'), availability_zone=placement.get('AvailabilityZone'),
+                    launch_time=item.get('LaunchTime'), nested={'tags': tags or None},
+                    interned=('state', 'environment', 'cluster', 'service', 'asg', 'account', 'instance_type', 'availability_zone'))
+        return record
+
+class Asg(Model):
+    """ Item of get_asgs """
+
+    _fields = ('name', 'environment', 'cluster', 'service', 'slice', 'account', 'desired', 'min_size', 'max_size', 'instance_ids')
+    _nested_fields = ('tags', 'instances')
+    __slots__ = _fields + tuple('_' + name for name in _nested_fields)
+    tags = _nested('tags')
+    instances = _nested('instances')
+
+    @classmethod
+    def from_response(cls, item, account=None):
+        tags = tags_of(item)
+        instances = item.get('Instances') or []
+        record = cls()
+        record._set(name=item.get('AutoScalingGroupName'), environment=_first(item, tags, 'Environment', 'EnvironmentName'),
+                    cluster=_first(item, tags, 'OwningCluster', 'Cluster'), service=_first(item, tags, 'ServiceName', 'Role'),
+                    slice=_first(item, tags, 'Slice'), account=account or item.get('AccountName'),
+                    desired=item.get('DesiredCapacity'), min_size=item.get('MinSize'), max_size=item.get('MaxSize'),
+                    instance_ids=tuple(instance.get('InstanceId') for instance in instances if isinstance(instance, dict)),
+                    nested={'tags': tags or None, 'instances': instances or None},
+                    interned=('environment', 'cluster', 'service', 'slice', 'account'))
+        return record
+
+def as_models(items, model, **extra):
+    """ Lazily turn response items into model records, eg. as_models(em_session.iter_instances(), Instance) keeps
+    neither the response nor its dicts in memory. Items that aren't dicts are skipped """
+    for item in items:
+        if isinstance(item, dict):
+            yield model.from_response(item, **extra)
@@ -0,0 +1,169 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import calendar
+import datetime
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import ConnectionError, Timeout
+from environment_manager import codec
+from environment_manager.circuit import CircuitOpenError, ConcurrencyLimitError
+from environment_manager.ratelimit import RateLimitError
+from environment_manager.utils import LogWrapper
+
+log = LogWrapper(__name__)
+
+_ISO_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+def to_epoch(value):
+    """ Epoch seconds of a datetime (naive ones are UTC), a number or an ISO 8601 UTC string, None if unreadable """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+    text = str(value).strip()
+    if text.endswith('Z'):
+        text = text[:-1]
+    elif len(text) > 6 and text[-6] in '+-' and text[-3] == ':' and text[-6:] in ('+00:00', '-00:00'):
+        text = text[:-6]
+    for time_format in _ISO_FORMATS:
+        try:
+            return to_epoch(datetime.datetime.strptime(text, time_format))
+        except ValueError:
+            continue
+    return None
+
+def to_iso(epoch):
+    """ ISO 8601 UTC timestamp with milliseconds, the format Environment Manager uses """
+    # Rounded as a whole, so .9996 carries into the seconds
+    seconds, millis = divmod(int(round(epoch * 1000)), 1000)
+    return '%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)), millis)
+
+def audit_timestamp(record):
+    return record.get('Timestamp') if isinstance(record, dict) else None
+
+def audit_key(record):
+    return record.get('AuditID') if isinstance(record, dict) else None
+
+def deployment_timestamp(record):
+    if not isinstance(record, dict):
+        return None
+    return (record.get('Value') or {}).get('StartTimestamp') or record.get('StartTimestamp')
+
+def deployment_key(record):
+    return record.get('DeploymentID') if isinstance(record, dict) else None
+
+class TimeWindowPager(object):
+    """ Fetches a time range as consecutive windows, concurrently, and yields the records in time order.
+    Windows returning more than target_records shrink the following ones, sparse windows grow them, and a window
+    whose request fails (typically a timeout on a huge response) is split in two and fetched again """
+
+    # Errors that mean the client is shedding load, splitting the window would only make it worse
+    _NOT_SPLITTABLE = (CircuitOpenError, ConcurrencyLimitError, RateLimitError)
+
+    def __init__(self, fetch, since, until=None, timestamp=audit_timestamp, key=audit_key, window=3600,
+                 min_window=60, max_window=7 * 86400, target_records=500, max_workers=4):
+        """ fetch(since_iso, until_iso) returns the records of a window. timestamp(record) and key(record) give a
+        record's time and identity, used to keep records inside their window, order them and drop duplicates
+        returned by two windows. The range includes both since and until, until defaults to now, sizes are in seconds """
+        self.fetch = fetch
+        self.since = to_epoch(since)
+        self.until = to_epoch(until) if until is not None else time.time()
+        if self.since is None or self.until is None:
+            raise ValueError('since and until need to be datetimes, epoch seconds or ISO 8601 strings')
+        if max_workers < 1:
+            raise ValueError('max_workers needs to be at least 1')
+        self.timestamp = timestamp
+        self.key = key
+        self.window = float(window)
+        self.min_window = float(min_window)
+        self.max_window = float(max_window)
+        self.target_records = target_records
+        self.max_workers = max_workers
+        self.windows_fetched = 0
+        self.windows_split = 0
+        self.duplicates = 0
+        self._seen = (set(), set())
+
+    def _fetch(self, start, end):
+        return self.fetch(to_iso(start), to_iso(end)) or []
+
+    def _adapt(self, duration, count):
+        """ Resize the next windows from how many records the last one held """
+        if count > self.target_records:
+            self.window = max(self.min_window, duration * self.target_records / float(count))
+        elif count < self.target_records / 4.0:
+            self.window = min(self.max_window, max(self.window, duration * 2))
+
+    def _in_order(self, records, start, end):
+        """ Records of a window inside its bounds, unseen, sorted by time. Windows are half-open except the last one,
+        which also keeps records stamped exactly at until """
+        previous, current = self._seen
+        last = end >= self.until
+        kept = []
+        for record in records if isinstance(records, list) else [records]:
+            moment = to_epoch(self.timestamp(record))
+            if moment is not None and not (start <= moment < end or last and moment == end):
+                continue
+            identity = self.key(record)
+            if identity is None:
+                identity = codec.dumps(record)
+            if identity in previous or identity in current:
+                self.duplicates += 1
+                continue
+            current.add(identity)
+            kept.append((moment if moment is not None else start, record))
+        # Only the previous window can overlap the next one, keep memory to two windows of keys
+        self._seen = (current, set())
+        kept.sort(key=lambda pair: pair[0])
+        return [record for moment, record in kept]
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        queue = deque()
+        futures = {}
+        next_start = self.since
+
+        def submit(window):
+            futures[window] = executor.submit(self._fetch, *window)
+
+        try:
+            while True:
+                # Keep max_workers windows in flight ahead of the one being yielded
+                while len(queue) < self.max_workers and next_start < self.until:
+                    window = (next_start, min(self.until, next_start + self.window))
+                    queue.append(window)
+                    submit(window)
+                    next_start = window[1]
+                if not queue:
+                    return
+                start, end = window = queue.popleft()
+                try:
+                    records = futures.pop(window).result()
+                except self._NOT_SPLITTABLE:
+                    raise
+                except (SystemError, ConnectionError, Timeout) as error:
+                    if end - start <= self.min_window:
+                        raise
+                    middle = start + (end - start) / 2.0
+                    log.info('Window %s to %s failed (%s), splitting it', to_iso(start), to_iso(end), error)
+                    self.windows_split += 1
+                    self.window = max(self.min_window, (end - start) / 2.0)
+                    queue.appendleft((middle, end))
+                    queue.appendleft((start, middle))
+                    submit((start, middle))
+                    submit((middle, end))
+                    continue
+                self.windows_fetched += 1
+                self._adapt(end - start, len(records) if isinstance(records, list) else 1)
+                for record in self._in_order(records, start, end):
+                    yield record
+        finally:
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,148 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import threading
+import time
+from environment_manager import codec
+from environment_manager.utils import file_lock, write_private_file
+
+class RateLimitError(SystemError):
+    """ Raised when a request would have to wait longer than allowed for its rate limit budget """
+
+class TokenBucket(object):
+    """ Token bucket shared by the threads of a process. Reservations may take the bucket negative, callers then wait their turn """
+
+    def __init__(self, rate, burst=None, name='default'):
+        """ rate is the sustained requests per second, burst how many can go at once (defaults to one second worth) """
+        if rate <= 0:
+            raise ValueError('rate needs to be above 0')
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.name = name
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, updated, max_wait, current):
+        """ Refill from elapsed time and reserve one token. Returns (tokens, delay) or raises RateLimitError """
+        tokens = min(self.burst, tokens + (current - updated) * self.rate)
+        delay = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+        if max_wait is not None and delay > max_wait:
+            raise RateLimitError('Rate limit %s of %s/s exhausted, would wait %.2fs' % (self.name, self.rate, delay))
+        return tokens - 1, delay
+
+    def reserve(self, max_wait=None):
+        """ Reserve a request slot and return how many seconds to wait before sending it """
+        with self._lock:
+            current = time.time()
+            self._tokens, delay = self._take(self._tokens, self._updated, max_wait, current)
+            self._updated = current
+            return delay
+
+    def refund(self):
+        """ Give back a token reserved for a request that won't be sent """
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+class SharedTokenBucket(TokenBucket):
+    """ Token bucket whose state lives in a locked file, so every process on the host shares the same budget """
+
+    def __init__(self, rate, burst=None, name='default', path=None):
+        TokenBucket.__init__(self, rate, burst=burst, name=name)
+        if path is None:
+            raise ValueError('SharedTokenBucket needs a path to keep its state in')
+        self.path = path
+        self.lock_path = '%s.lock' % path
+
+    def _read_state(self):
+        """ Every bucket's (tokens, updated) from the state file, caller holds the file lock """
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as state_file:
+                return codec.loads(state_file.read())
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def reserve(self, max_wait=None):
+        """ Reserve a request slot under the file lock and return how many seconds to wait before sending it """
+        with self._lock:
+            with file_lock(self.lock_path):
+                state = self._read_state()
+                current = time.time()
+                tokens, updated = state.get(self.name, (self.burst, current))
+                tokens, delay = self._take(tokens, updated, max_wait, current)
+                state[self.name] = (tokens, current)
+                write_private_file(self.path, codec.dumps(state))
+                return delay
+
+    def refund(self):
+        """ Give back a token reserved for a request that won't be sent """
+        with self._lock:
+            with file_lock(self.lock_path):
+                state = self._read_state()
+                if self.name not in state:
+                    return
+                tokens, updated = state[self.name]
+                state[self.name] = (min(self.burst, tokens + 1), updated)
+                write_private_file(self.path, codec.dumps(state))
+
+class RateLimiter(object):
+    """ Client side rate limit: a global budget plus stricter per-endpoint-prefix budgets """
+
+    def __init__(self, rate=10, burst=None, overrides=None, shared_path=None, max_wait=None):
+        """ overrides maps endpoint prefixes to (rate, burst), eg. {'/api/v1/deployments': (1, 2)}; those requests spend
+        from both their own and the global budget. With shared_path the budget is shared by every process using that file.
+        A request that would wait more than max_wait seconds fails with RateLimitError instead """
+        self.max_wait = max_wait
+        self.waits = 0
+        self.total_wait = 0.0
+        self.buckets = {None: self._bucket(rate, burst, 'global', shared_path)}
+        for prefix, (prefix_rate, prefix_burst) in (overrides or {}).items():
+            self.buckets[prefix] = self._bucket(prefix_rate, prefix_burst, prefix, shared_path)
+        self._prefixes = sorted((prefix for prefix in self.buckets if prefix is not None), key=len, reverse=True)
+
+    @classmethod
+    def _bucket(cls, rate, burst, name, shared_path):
+        if shared_path is None:
+            return TokenBucket(rate, burst, name=name)
+        return SharedTokenBucket(rate, burst, name=name, path=shared_path)
+
+    def buckets_for(self, endpoint):
+        """ Buckets a request to endpoint spends from """
+        path = endpoint.split('?', 1)[0]
+        buckets = [self.buckets[None]]
+        for prefix in self._prefixes:
+            if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+                buckets.append(self.buckets[prefix])
+                break
+        return buckets
+
+    def reserve(self, endpoint):
+        """ Reserve budget for a request and return the seconds to wait before sending it. Nothing is spent when
+        one of its budgets raises RateLimitError """
+        reserved = []
+        delay = 0.0
+        try:
+            for bucket in self.buckets_for(endpoint):
+                delay = max(delay, bucket.reserve(self.max_wait))
+                reserved.append(bucket)
+        except RateLimitError:
+            for bucket in reserved:
+                bucket.refund()
+            raise
+        if delay > 0:
+            self.waits += 1
+            self.total_wait += delay
+        return delay
+
+    def acquire(self, endpoint):
+        """ Block until a request to endpoint fits in the budget """
+        delay = self.reserve(endpoint)
+        if delay > 0:
+            time.sleep(delay)
+
+    def stats(self):
+        """ Return how often and how long requests were held back """
+        return {'waits': self.waits, 'total_wait': self.total_wait}
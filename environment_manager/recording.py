@@ -0,0 +1,258 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import base64
+import datetime
+import gzip
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.structures import CaseInsensitiveDict
+from environment_manager import codec
+from environment_manager.api import EMApi
+from environment_manager.transport import SessionTransport
+from environment_manager.utils import LogWrapper
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+log = LogWrapper(__name__)
+
+RECORDING_FORMAT = 'environment_manager-recording'
+RECORDING_VERSION = 1
+REDACTED = 'REDACTED'
+# Response headers the client looks at, the rest is left out to keep recordings small
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+# Unsigned token valid until 2100, handed out on replay instead of the recorded bearer token
+REPLAY_TOKEN = 'eyJhbGciOiJub25lIn0.eyJleHAiOjQxMDI0NDQ4MDB9.replay'
+
+class ReplayMissError(SystemError):
+    """ Raised when a replayed request has no recorded response """
+
+def _path(url):
+    """ Path and query string of a URL, so recordings don't depend on the server they were made against """
+    parts = urlsplit(url)
+    return '%s?%s' % (parts.path, parts.query) if parts.query else parts.path
+
+def _redact_credentials(data):
+    """ Token request body with the password taken out """
+    try:
+        payload = codec.loads(data)
+        payload['password'] = REDACTED
+        return codec.dumps(payload)
+    except (ValueError, TypeError):
+        return REDACTED
+
+def read_recording(path):
+    """ Yield the recorded exchanges of a recording file in order """
+    with gzip.open(path, 'rb') as recording:
+        header = codec.loads(recording.readline().decode('utf-8') or '{}')
+        if header.get('format') != RECORDING_FORMAT:
+            raise ValueError('%s is not an environment_manager recording' % path)
+        if header.get('version', 0) > RECORDING_VERSION:
+            raise ValueError('%s was written by a newer environment_manager, version %s' % (path, header.get('version')))
+        for line in recording:
+            if line.strip():
+                yield codec.loads(line.decode('utf-8'))
+
+class RecordingTransport(object):
+    """ Transport wrapper writing every request/response pair to a gzipped JSON lines file.
+    Bearer tokens, passwords and issued tokens are redacted, so recordings are safe to share """
+
+    def __init__(self, path, transport=None, record_bodies=True):
+        """ Requests go through transport (a new SessionTransport by default). Without record_bodies only
+        methods, paths, statuses and timings are kept, enough to replay the traffic pattern against a server """
+        self.path = path
+        self.transport = transport if transport is not None else SessionTransport()
+        self.record_bodies = record_bodies
+        self.recorded = 0
+        self._file = None
+        self._started = None
+        self._lock = threading.Lock()
+
+    def _write(self, entry):
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'wb')
+                header = {'format': RECORDING_FORMAT, 'version': RECORDING_VERSION, 'started': self._started}
+                self._file.write((codec.dumps(header) + '\n').encode('utf-8'))
+            self._file.write((codec.dumps(entry) + '\n').encode('utf-8'))
+            self.recorded += 1
+
+    def request(self, method, url, **kwargs):
+        """ Send the request through the wrapped transport and record it """
+        started = time.time()
+        if self._started is None:
+            with self._lock:
+                if self._started is None:
+                    self._started = started
+        response = None
+        error = None
+        try:
+            response = self.transport.request(method, url, **kwargs)
+            return response
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            try:
+                self._record(started, method, url, kwargs.get('data'), response, error, time.time() - started)
+            except Exception:
+                log.error('Could not record %s %s', method, url)
+
+    def _record(self, started, method, url, data, response, error, elapsed):
+        path = _path(url)
+        token_request = path == '/api/v1/token'
+        entry = {'t': round(max(0.0, started - self._started), 6), 'method': method.upper(), 'path': path, 'elapsed': round(elapsed, 6)}
+        if self.record_bodies and data is not None:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8', 'replace')
+            entry['body'] = _redact_credentials(data) if token_request else data
+        if error is not None:
+            entry['error'] = type(error).__name__
+        else:
+            entry['status'] = response.status_code
+            headers = dict((name, response.headers[name]) for name in RECORDED_HEADERS if name in response.headers)
+            if headers:
+                entry['headers'] = headers
+            if self.record_bodies:
+                if token_request and response.status_code < 300:
+                    entry['text'] = REPLAY_TOKEN
+                else:
+                    try:
+                        entry['text'] = response.content.decode('utf-8')
+                    except UnicodeDecodeError:
+                        entry['content'] = base64.b64encode(response.content).decode('ascii')
+        self._write(entry)
+
+    def close(self):
+        """ Finish the recording file and close the wrapped transport """
+        with self._lock:
+            recording, self._file = self._file, None
+        if recording is not None:
+            recording.close()
+        self.transport.close()
+
+# Errors raised instead of a recorded connection problem, anything else becomes a ConnectionError
+_REPLAYED_ERRORS = {'ConnectTimeout': requests.exceptions.ConnectTimeout,
+                    'ReadTimeout': requests.exceptions.ReadTimeout,
+                    'Timeout': requests.exceptions.Timeout,
+                    'ConnectionError': requests.exceptions.ConnectionError}
+
+class ReplayTransport(object):
+    """ Transport answering from a recording instead of the network """
+
+    def __init__(self, path, timing='fast', speed=1.0, strict=False):
+        """ With timing 'fast' responses come back straight away, to profile parsing and our own processing at full
+        speed; with 'real' each takes as long as it did when recorded, divided by speed. Requests are matched on
+        method and path, repeats get the recorded responses in order and start over once they run out, unless strict
+        is set and ReplayMissError is raised instead """
+        if timing not in ('fast', 'real'):
+            raise ValueError('timing needs to be fast or real')
+        if speed <= 0:
+            raise ValueError('speed needs to be above 0')
+        self.path = path
+        self.timing = timing
+        self.speed = speed
+        self.strict = strict
+        self.replayed = 0
+        self.misses = 0
+        self._responses = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        for entry in read_recording(path):
+            self._responses.setdefault((entry['method'], entry['path']), []).append(entry)
+
+    def _next_entry(self, key):
+        with self._lock:
+            entries = self._responses.get(key)
+            if not entries:
+                if key == ('POST', '/api/v1/token'):
+                    # Recorded with an already valid token, hand out one that never needs renewing
+                    return {'status': 200, 'text': REPLAY_TOKEN}
+                self.misses += 1
+                raise ReplayMissError('Nothing recorded for %s %s' % key)
+            position = self._positions.get(key, 0)
+            if position >= len(entries):
+                if self.strict:
+                    self.misses += 1
+                    raise ReplayMissError('All %s recorded responses for %s %s already replayed' % ((len(entries),) + key))
+                position = 0
+            self._positions[key] = position + 1
+            self.replayed += 1
+            return entries[position]
+
+    def request(self, method, url, **kwargs):
+        """ Return the next recorded response for this request """
+        entry = self._next_entry((method.upper(), _path(url)))
+        if self.timing == 'real' and entry.get('elapsed'):
+            time.sleep(entry['elapsed'] / self.speed)
+        if 'error' in entry:
+            raise _REPLAYED_ERRORS.get(entry['error'], requests.exceptions.ConnectionError)('Replayed %s' % entry['error'])
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry.get('headers') or {})
+        if 'content' in entry:
+            response._content = base64.b64decode(entry['content'])
+        else:
+            response._content = (entry.get('text') or '').encode('utf-8')
+        response.encoding = 'utf-8'
+        # Body already in memory, lets iter_content work for streamed queries
+        response._content_consumed = True
+        response.url = url
+        response.elapsed = datetime.timedelta(seconds=entry.get('elapsed') or 0)
+        return response
+
+    def close(self):
+        pass
+
+def replay_against(path, server, user, password, timing='real', speed=1.0, max_workers=10, **client_settings):
+    """ Send the requests of a recording to server, eg. a FakeEMServer, keeping their recorded pacing (divided by
+    speed) or as fast as max_workers allow with timing 'fast'. Returns a summary with request count, errors by type,
+    p50/p99 latency and how far behind schedule requests started """
+    entries = [entry for entry in read_recording(path) if entry['path'] != '/api/v1/token']
+    latencies = []
+    lags = []
+    errors = {}
+    errors_lock = threading.Lock()
+    client_settings.setdefault('coalesce_requests', False)
+    client = EMApi(server, user, password, pool_maxsize=max_workers, **client_settings)
+
+    def send(entry, scheduled):
+        started = time.time()
+        lags.append(max(0.0, started - scheduled))
+        body = entry.get('body')
+        data = codec.loads(body) if body is not None else ({} if entry['method'] == 'POST' else None)
+        try:
+            client.query(query_endpoint=entry['path'], data=data, query_type=entry['method'], use_cache=False)
+        except Exception as error:
+            with errors_lock:
+                errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+        finally:
+            latencies.append(time.time() - started)
+
+    try:
+        client._get_token()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        start = time.time()
+        try:
+            for entry in entries:
+                scheduled = start
+                if timing == 'real':
+                    scheduled = start + entry['t'] / speed
+                    delay = scheduled - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(send, entry, scheduled)
+        finally:
+            executor.shutdown(wait=True)
+        seconds = time.time() - start
+    finally:
+        client.close()
+    latencies.sort()
+    percentile = lambda fraction: latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else None
+    return {'requests': len(latencies), 'errors': errors, 'seconds': seconds,
+            'p50': percentile(0.5), 'p99': percentile(0.99), 'max_lag': max(lags) if lags else 0.0}
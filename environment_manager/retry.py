@@ -0,0 +1,149 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+from requests.exceptions import ConnectTimeout
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+now = getattr(time, 'monotonic', time.time)
+
+def connection_not_established(error):
+    """ True if a connection error happened before the request could reach the server """
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if getattr(error, 'args', None) else None
+    return isinstance(reason, NewConnectionError)
+
+class Deadline(object):
+    """ Overall time budget for a call and all its retries, None means unbounded """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires = None if seconds is None else now() + seconds
+
+    def remaining(self):
+        """ Seconds left, None if unbounded """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - now())
+
+    def expired(self):
+        return self.expires is not None and now() >= self.expires
+
+    def allows(self, delay):
+        """ True if we can sleep delay seconds and still have time left for another attempt """
+        remaining = self.remaining()
+        return remaining is None or delay < remaining
+
+class RetryPolicy(object):
+    """ When and how long to wait before retrying an Environment Manager call """
+
+    def __init__(self, max_attempts=5, backoff_base=0.5, backoff_max=30, jitter=True, deadline=None,
+                 retry_statuses=(429, 500, 502, 503, 504), respect_retry_after=True, max_retry_after=120,
+                 idempotent_methods=('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'), idempotent_endpoints=('/api/v1/token',),
+                 connect_timeout=5, read_timeout=30, timeouts=None):
+        """ Backoff is exponential from backoff_base up to backoff_max seconds, with full jitter unless jitter is False.
+        deadline bounds the total seconds spent on a call including retries. Non-idempotent methods (POST, PATCH) are
+        only retried when the server provably didn't process them: connection never established, or a 429.
+        timeouts maps endpoint prefixes to (connect, read) seconds, longest prefix wins """
+        if max_attempts < 1:
+            raise ValueError('max_attempts needs to be at least 1')
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_statuses = frozenset(retry_statuses)
+        self.respect_retry_after = respect_retry_after
+        self.max_retry_after = max_retry_after
+        self.idempotent_methods = frozenset(method.upper() for method in idempotent_methods)
+        self.idempotent_endpoints = tuple(idempotent_endpoints)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.timeouts = dict(timeouts or {})
+        self._timeout_prefixes = sorted(self.timeouts, key=len, reverse=True)
+
+    def copy(self, **overrides):
+        """ Return a copy of this policy with some settings replaced """
+        settings = {'max_attempts': self.max_attempts,
+                    'backoff_base': self.backoff_base,
+                    'backoff_max': self.backoff_max,
+                    'jitter': self.jitter,
+                    'deadline': self.deadline,
+                    'retry_statuses': self.retry_statuses,
+                    'respect_retry_after': self.respect_retry_after,
+                    'max_retry_after': self.max_retry_after,
+                    'idempotent_methods': self.idempotent_methods,
+                    'idempotent_endpoints': self.idempotent_endpoints,
+                    'connect_timeout': self.connect_timeout,
+                    'read_timeout': self.read_timeout,
+                    'timeouts': self.timeouts}
+        settings.update((key, value) for key, value in overrides.items() if value is not None)
+        return RetryPolicy(**settings)
+
+    def start(self):
+        """ Start the deadline clock for a new call """
+        return Deadline(self.deadline)
+
+    def is_idempotent(self, method, endpoint):
+        """ True if sending the request twice has the same effect as sending it once """
+        if method.upper() in self.idempotent_methods:
+            return True
+        path = endpoint.split('?', 1)[0]
+        return any(path == prefix or path.startswith(prefix + '/') for prefix in self.idempotent_endpoints)
+
+    def retry_on_error(self, method, endpoint, error):
+        """ Should a connection error or timeout be retried """
+        return self.is_idempotent(method, endpoint) or connection_not_established(error)
+
+    def retry_on_status(self, method, endpoint, status_code):
+        """ Should an HTTP status be retried """
+        if status_code not in self.retry_statuses:
+            return False
+        return status_code == 429 or self.is_idempotent(method, endpoint)
+
+    def backoff(self, attempt):
+        """ Seconds to wait after the given failed attempt (1 based) """
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        if self.jitter:
+            return random.uniform(0, ceiling)
+        return ceiling
+
+    def retry_after(self, response):
+        """ Seconds the server asked us to wait in Retry-After on a 429/503, None if absent or unusable """
+        if not self.respect_retry_after or response is None or response.status_code not in (429, 503):
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            parsed = parsedate_tz(value)
+            if parsed is None:
+                return None
+            seconds = mktime_tz(parsed) - time.time()
+        return min(max(0.0, seconds), self.max_retry_after)
+
+    def delay(self, attempt, response=None):
+        """ Seconds to wait before the next attempt, Retry-After wins over our own backoff """
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return retry_after
+        return self.backoff(attempt)
+
+    def timeout_for(self, endpoint, deadline=None):
+        """ (connect, read) timeout for an endpoint, clamped to what is left of the deadline """
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        path = endpoint.split('?', 1)[0]
+        for prefix in self._timeout_prefixes:
+            if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+                connect_timeout, read_timeout = self.timeouts[prefix]
+                break
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None:
+            connect_timeout = min(connect_timeout, max(remaining, 0.001))
+            read_timeout = min(read_timeout, max(remaining, 0.001))
+        return (connect_timeout, read_timeout)
@@ -0,0 +1,99 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import re
+
+# Path templates of every endpoint called by EMApi, query strings left out
+ROUTE_TEMPLATES = [
+    '/api/v1/token',
+    '/api/v1/config/accounts',
+    '/api/v1/config/accounts/{accountnumber}',
+    '/api/v1/images',
+    '/api/v1/asgs',
+    '/api/v1/asgs/{asgname}',
+    '/api/v1/asgs/{asgname}/ready',
+    '/api/v1/asgs/{asgname}/ips',
+    '/api/v1/asgs/{asgname}/scaling-schedule',
+    '/api/v1/asgs/{asgname}/size',
+    '/api/v1/asgs/{asgname}/launch-config',
+    '/api/v1/config/audit',
+    '/api/v1/config/audit/{key}',
+    '/api/v1/config/clusters',
+    '/api/v1/config/clusters/{cluster}',
+    '/api/v1/deployments',
+    '/api/v1/deployments/{deployment_id}',
+    '/api/v1/deployments/{deployment_id}/log',
+    '/api/v1/config/deployments-maps',
+    '/api/v1/deployment-maps/{deployment_name}',
+    '/api/v1/environments',
+    '/api/v1/environments/{environment}',
+    '/api/v1/environments/{environment}/protected',
+    '/api/v1/environments/{environment}/servers',
+    '/api/v1/environments/{environment}/servers/{asgname}',
+    '/api/v1/environments/{environment}/schedule',
+    '/api/v1/environments/{environment}/accountName',
+    '/api/v1/environments/{environment}/schedule-status',
+    '/api/v1/config/environments',
+    '/api/v1/config/environments/{environment}',
+    '/api/v1/config/environment-types',
+    '/api/v1/config/environment-types/{environmenttype}',
+    '/api/v1/config/export/{resource}',
+    '/api/v1/config/import/{resource}',
+    '/api/v1/instances',
+    '/api/v1/instances/{instance_id}',
+    '/api/v1/instances/{instance_id}/connect',
+    '/api/v1/instances/{instance_id}/maintenance',
+    '/api/v1/load-balancer/{id}',
+    '/api/v1/config/lb-settings',
+    '/api/v1/config/lb-settings/{environment}/{vhostname}',
+    '/api/v1/config/notification-settings',
+    '/api/v1/notification-settings/{notification_id}',
+    '/api/v1/package-upload-url/{service}/{version}/{environment}',
+    '/api/v1/package-upload-url/{service}/{version}',
+    '/api/v1/config/permissions',
+    '/api/v1/config/permissions/{name}',
+    '/api/v1/services',
+    '/api/v1/services/{service}',
+    '/api/v1/services/{service}/asgs',
+    '/api/v1/services/{service}/health',
+    '/api/v1/services/{service}/health/{slice}',
+    '/api/v1/services/{service}/slices',
+    '/api/v1/services/{service}/slices/toggle',
+    '/api/v1/config/services',
+    '/api/v1/config/services/{service}/{cluster}',
+    '/api/v1/diagnostics/healthcheck',
+    '/api/v1/target-state/{environment}',
+    '/api/v1/target-state/{environment}/{service}',
+    '/api/v1/target-state/{environment}/{service}/{version}',
+    '/api/v1/upstreams/{upstream}/slices',
+    '/api/v1/upstreams/{upstream}/slices/toggle',
+    '/api/v1/config/upstreams',
+    '/api/v1/config/upstreams/{upstream}',
+]
+
+def _compile(template):
+    """ Regex matching a template, placeholders match a single path segment """
+    pattern = re.sub(r'\\?\{[a-z_]+\\?\}', '[^/]+', re.escape(template))
+    return re.compile('^%s/?$' % pattern)
+
+# Templates with more literal text are tried first, so a specific route wins over a generic one of the same shape
+_ROUTES = sorted(((_compile(template), template) for template in ROUTE_TEMPLATES),
+                 key=lambda route: -len(re.sub(r'\{[a-z_]+\}', '', route[1])))
+_template_cache = {}
+
+def endpoint_template(endpoint):
+    """ Template of an endpoint, eg. '/api/v1/asgs/my-asg/ready?environment=c50' is '/api/v1/asgs/{asgname}/ready'.
+    Unknown endpoints are reported as 'unknown' so metric labels can't explode on ids we don't recognise """
+    path = endpoint.split('?', 1)[0]
+    template = _template_cache.get(path)
+    if template is not None:
+        return template
+    template = 'unknown'
+    for regex, candidate in _ROUTES:
+        if regex.match(path):
+            template = candidate
+            break
+    # Bounded memoisation, paths carry ids so this could otherwise grow forever
+    if len(_template_cache) < 4096:
+        _template_cache[path] = template
+    return template
@@ -0,0 +1,77 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import copy
+import threading
+
+class _Call(object):
+    """ A call in flight, followers wait on its event """
+
+    __slots__ = ('event', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class SingleFlight(object):
+    """ Deduplicates concurrent calls sharing a key: one caller runs the function, the others wait and share its result or error """
+
+    def __init__(self, copy_results=True):
+        """ With copy_results every follower gets its own copy of a dict or list result """
+        self.copy_results = copy_results
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """ Run function, or wait for the identical call already in flight under key """
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+                self.calls += 1
+            else:
+                call.followers += 1
+                self.shared += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return self._copy(call.result)
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._in_flight.get(key) is call:
+                    del self._in_flight[key]
+                followers = call.followers
+            call.event.set()
+        # Followers copy the pristine result, so the leader can't hand out the original either
+        if followers:
+            return self._copy(call.result)
+        return call.result
+
+    def detach(self, predicate):
+        """ Stop new callers from joining the calls in flight whose key matches predicate, they start a call of their
+        own instead. Callers already waiting still get the detached call's result. Returns how many were detached """
+        with self._lock:
+            keys = [key for key in self._in_flight if predicate(key)]
+            for key in keys:
+                del self._in_flight[key]
+        return len(keys)
+
+    def _copy(self, result):
+        if self.copy_results and isinstance(result, (dict, list)):
+            return copy.deepcopy(result)
+        return result
+
+    def stats(self):
+        """ Return how many calls went out and how many callers piggybacked on them """
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._in_flight)}
@@ -0,0 +1,130 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import codecs
+from environment_manager import codec
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Largest single item we accept, a bigger one means the endpoint isn't a list of small records and streaming won't help
+DEFAULT_MAX_BUFFER = 16 * 1024 * 1024
+_WHITESPACE = ' \t\n\r'
+
+class StreamingDecodeError(ValueError):
+    """ Raised when a streamed body isn't valid JSON or an item doesn't fit in the buffer """
+
+class _Reader(object):
+    """ Text buffer over an iterator of byte chunks, dropping what has been parsed """
+
+    def __init__(self, chunks, max_buffer, decoder):
+        self.chunks = iter(chunks)
+        self.max_buffer = max_buffer
+        self.decoder = decoder
+        self.text = codecs.getincrementaldecoder('utf-8')('strict')
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Append the next chunk, False once the body is exhausted """
+        if self.eof:
+            return False
+        # Compact once most of the buffer has been consumed, keeping memory bounded by the item being parsed
+        if self.pos > DEFAULT_CHUNK_SIZE and self.pos * 2 > len(self.buffer):
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += self.text.decode(chunk)
+                return True
+        self.buffer += self.text.decode(b'', True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """ Next significant character, '' at the end of the body """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise StreamingDecodeError('Expected %r at offset %s of the streamed body' % (character, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """ Decode the JSON value starting at the next significant character """
+        self.peek()
+        # Retry only once the pending text has doubled, so a large item is parsed a logarithmic number of times
+        wanted = 0
+        while True:
+            pending = len(self.buffer) - self.pos
+            if pending >= wanted or self.eof:
+                try:
+                    value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                except ValueError as error:
+                    if self.eof:
+                        raise StreamingDecodeError('Invalid JSON in streamed body: %s' % error)
+                else:
+                    # A value running to the end of the buffer may be a truncated number or literal
+                    if end < len(self.buffer) or self.eof:
+                        self.pos = end
+                        return value
+                wanted = max(pending * 2, 1)
+            if pending > self.max_buffer:
+                raise StreamingDecodeError('Streamed item is larger than the %s bytes buffer' % self.max_buffer)
+            self.fill()
+
+def iter_json_items(chunks, key=None, max_buffer=DEFAULT_MAX_BUFFER):
+    """ Incrementally decode a JSON body given as byte chunks, yielding the items of its top level array one at a time.
+    For a top level object the items of the array under key (by default the first array member) are yielded, other
+    members are skipped; an object without such an array is yielded whole. Any other document is yielded whole.
+    Only the item being decoded is held in memory """
+    reader = _Reader(chunks, max_buffer, codec.raw_decoder())
+    first = reader.peek()
+    if first == '':
+        return
+    if first == '{':
+        reader.pos += 1
+        # Members read so far, the document itself if it turns out not to hold the array
+        members = {}
+        while True:
+            character = reader.peek()
+            if character == '}':
+                reader.pos += 1
+                yield members
+                return
+            if character == ',':
+                reader.pos += 1
+                continue
+            if character == '':
+                raise StreamingDecodeError('Streamed body ended inside an object')
+            name = reader.value()
+            reader.expect(':')
+            if reader.peek() == '[' and (key is None or name == key):
+                for item in _iter_array(reader):
+                    yield item
+                return
+            members[name] = reader.value()
+    elif first == '[':
+        for item in _iter_array(reader):
+            yield item
+    else:
+        yield reader.value()
+
+def _iter_array(reader):
+    reader.expect('[')
+    while True:
+        character = reader.peek()
+        if character == ']':
+            reader.pos += 1
+            return
+        if character == ',':
+            reader.pos += 1
+            continue
+        if character == '':
+            raise StreamingDecodeError('Streamed body ended inside an array')
+        yield reader.value()
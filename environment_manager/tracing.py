@@ -0,0 +1,217 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import random
+import re
+import threading
+import time
+from collections import deque
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+TRACEPARENT_HEADER = 'traceparent'
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+def parse_traceparent(value):
+    """ (trace_id, span_id) from a W3C traceparent header value, None if it isn't one """
+    match = _TRACEPARENT.match((value or '').strip().lower())
+    if match is None or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2)
+
+class _CurrentSpan(object):
+    """ Span active in this thread, or in this asyncio task where contextvars exist (Python 3.7+) """
+
+    def __init__(self):
+        if contextvars is not None:
+            self._var = contextvars.ContextVar('environment_manager_span', default=None)
+        else:
+            self._local = threading.local()
+
+    def get(self):
+        if contextvars is not None:
+            return self._var.get()
+        return getattr(self._local, 'span', None)
+
+    def set(self, span):
+        """ Activate span and return what reset needs to restore the previous one """
+        if contextvars is not None:
+            return self._var.set(span)
+        previous = self.get()
+        self._local.span = span
+        return previous
+
+    def reset(self, token):
+        if contextvars is not None:
+            self._var.reset(token)
+        else:
+            self._local.span = token
+
+class Span(object):
+    """ A timed operation in a trace, used as a context manager it is the parent of spans started inside the block """
+
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'status', 'error', '_token')
+
+    def __init__(self, tracer, name, trace_id, span_id, parent_id=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.error = None
+        self._token = None
+
+    @property
+    def duration(self):
+        """ Seconds between start and finish, None while the span is open """
+        return None if self.end is None else self.end - self.start
+
+    @property
+    def traceparent(self):
+        """ W3C traceparent header value identifying this span """
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        """ Mark the span failed, error is an exception or a short description """
+        self.status = 'error'
+        self.error = error if isinstance(error, str) else type(error).__name__
+
+    def finish(self):
+        """ Close the span and hand it to the exporter, finishing twice is harmless """
+        if self.end is None:
+            self.end = time.time()
+            self.tracer._export(self)
+
+    def as_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'start': self.start, 'end': self.end, 'duration': self.duration, 'attributes': dict(self.attributes),
+                'status': self.status, 'error': self.error}
+
+    def __enter__(self):
+        self._token = self.tracer._current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._current.reset(self._token)
+        if exc_value is not None:
+            self.record_error(exc_value)
+        self.finish()
+
+    def __repr__(self):
+        return '<Span %s %s/%s %s>' % (self.name, self.trace_id, self.span_id, self.status)
+
+class NoopSpan(object):
+    """ Span standing in when tracing is disabled, every operation does nothing """
+
+    __slots__ = ()
+    trace_id = span_id = parent_id = traceparent = duration = None
+    attributes = {}
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+class NoopTracer(object):
+    """ Default tracer, creates nothing and injects nothing. Clients check enabled to skip tracing work entirely """
+
+    enabled = False
+
+    def start_span(self, name, attributes=None, parent=None):
+        return NOOP_SPAN
+
+    def current_span(self):
+        return NOOP_SPAN
+
+    def inject(self, headers, span=None):
+        return headers
+
+NOOP_TRACER = NoopTracer()
+
+class InMemoryExporter(object):
+    """ Keeps the last max_spans finished spans in memory, to inspect traces in tests or from a shell """
+
+    def __init__(self, max_spans=10000):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def finished_spans(self, name=None, trace_id=None):
+        """ Finished spans in finish order, optionally only those with a name or in a trace """
+        with self._lock:
+            spans = list(self._spans)
+        return [span for span in spans if (name is None or span.name == name) and (trace_id is None or span.trace_id == trace_id)]
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+class SimpleTracer(object):
+    """ Minimal tracer creating W3C trace context compatible spans and handing finished ones to an exporter.
+    Any object with an export(span) method works as exporter, eg. one forwarding to your tracing backend """
+
+    enabled = True
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter if exporter is not None else InMemoryExporter()
+        self._current = _CurrentSpan()
+
+    @classmethod
+    def _new_id(cls, bits):
+        return '%0*x' % (bits // 4, random.getrandbits(bits) or 1)
+
+    def start_span(self, name, attributes=None, parent=None):
+        """ Start a span under parent (a Span, a traceparent header value) or else under the active span.
+        The span is not active until entered with a with block """
+        if parent is None:
+            parent = self._current.get()
+        if isinstance(parent, str):
+            parent = parse_traceparent(parent)
+            trace_id, parent_id = parent if parent is not None else (None, None)
+        elif parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id = parent_id = None
+        return Span(self, name, trace_id or self._new_id(128), self._new_id(64), parent_id, attributes)
+
+    def current_span(self):
+        """ Active span, NOOP_SPAN outside any """
+        span = self._current.get()
+        return span if span is not None else NOOP_SPAN
+
+    def inject(self, headers, span=None):
+        """ Return a copy of headers carrying the trace context of span, or of the active span """
+        span = span if span is not None else self._current.get()
+        if span is None:
+            return headers
+        headers = dict(headers or {})
+        headers[TRACEPARENT_HEADER] = span.traceparent
+        return headers
+
+    def _export(self, span):
+        self.exporter.export(span)
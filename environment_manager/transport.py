@@ -0,0 +1,57 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+class SessionTransport(object):
+    """ Pooled keep-alive HTTP transport backed by a requests Session """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True, verify=False):
+        """ Initialise transport, pool_connections is the number of hosts to keep pools for and pool_maxsize the number of connections kept per host """
+        if pool_connections < 1 or pool_maxsize < 1:
+            raise ValueError('pool_connections and pool_maxsize need to be at least 1')
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.verify = verify
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _build_session(self):
+        """ Create a new session with our own adapters mounted """
+        session = requests.Session()
+        # Retries are handled by EMApi, never let urllib3 retry behind our back
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block,
+                              max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.verify = self.verify
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def session(self):
+        """ Return the underlying session, creating it on first use """
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """ Send a request through the pooled session and return the response """
+        kwargs.setdefault('verify', self.verify)
+        return self.session.request(method.upper(), url, **kwargs)
+
+    def close(self):
+        """ Close all pooled connections, the transport can still be used afterwards and will reconnect """
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
@@ -3,6 +3,7 @@
 
 import os
 import re
+import sys
 import ast
 import traceback
 import logging
@@ -11,37 +12,90 @@ import types
 import subprocess
 import random
 import time
-import simplejson
+import contextlib
+from environment_manager import codec
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from sys import intern
+except ImportError:
+    from __builtin__ import intern
+
+# Let logging itself find who called the wrapper, two frames up: LogWrapper.<level>, LogWrapper._log
+CALLER_STACKLEVEL = {'stacklevel': 3} if sys.version_info >= (3, 8) else {}
+
+class LazyMessage(object):
+    """ A message and its arguments, only formatted if a handler actually emits the record """
+
+    __slots__ = ('message', 'args')
+
+    def __init__(self, message, args):
+        self.message = message
+        self.args = args
+
+    def __str__(self):
+        return self.message % self.args if self.args else str(self.message)
 
 class LogWrapper(object):
-    """ Instanciates logging wrapper to add useful information to all logs without repeating code """
+    """ Instanciates logging wrapper to add useful information to all logs without repeating code.
+    Messages are formatted lazily from args and nothing is done unless the level is enabled. The calling function is
+    prefixed to the message and kept in the em_caller attribute of the record, records of other loggers are untouched """
 
-    def __init__(self):
+    with_process = False
+
+    def __init__(self, name='environment_manager'):
         """ Initialise logger """
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(name)
 
-    def debug(self, message):
+    def _log(self, level, message, args, exc_info=False):
+        """ Log through the standard logger, telling it which frame is the real caller """
+        caller = sys._getframe(2).f_code.co_name
+        extra = {'em_caller': caller}
+        if self.with_process:
+            import multiprocessing
+            self.logger.log(level, '%s %s - %s', multiprocessing.current_process().name or 'Main', caller,
+                            LazyMessage(message, args), exc_info=exc_info, extra=extra, **CALLER_STACKLEVEL)
+        else:
+            self.logger.log(level, '%s - %s', caller, LazyMessage(message, args), exc_info=exc_info, extra=extra,
+                            **CALLER_STACKLEVEL)
+
+    def debug(self, message, *args):
         """ Debug """
-        self.logger.debug("%s - %s", function_name(), message)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, message, args)
 
-    def info(self, message):
+    def info(self, message, *args):
         """ Info """
-        self.logger.info("%s - %s", function_name(), message)
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, message, args)
 
-    def warn(self, message):
+    def warn(self, message, *args):
         """ Warn """
-        self.logger.warn("%s - %s", function_name(), message)
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, message, args)
+
+    warning = warn
 
-    def error(self, message):
+    def error(self, message, *args):
         """ Error """
-        self.logger.error("%s - %s", function_name(), message, exc_info=True)
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, message, args, exc_info=True)
 
-    def critical(self, message):
+    def critical(self, message, *args):
         """ Critical """
-        self.logger.critical("%s - %s", function_name(), message, exc_info=True)
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self._log(logging.CRITICAL, message, args, exc_info=True)
+
+log = LogWrapper(__name__)
+
+class LogWrapperMultiprocess(LogWrapper):
+    """ Instanciates logging wrapper to add useful information to all logs without repeating code, records also carry the process name """
 
-class LogWrapperMultiprocess(object):
-    """ Instanciates logging wrapper to add useful information to all logs without repeating code """
+    with_process = True
 
     @classmethod
     def install_mp_handler(cls, logger=None):
@@ -51,14 +105,16 @@ class LogWrapperMultiprocess(object):
         if logger is None:
             logger = logging.getLogger()
         for i, orig_handler in enumerate(list(logger.handlers)):
+            if isinstance(orig_handler, multiprocessing_logging.MultiProcessingHandler):
+                continue
             handler = multiprocessing_logging.MultiProcessingHandler(
                 'mp-handler-{0}'.format(i), sub_handler=orig_handler)
             logger.removeHandler(orig_handler)
             logger.addHandler(handler)
 
-    def __init__(self):
+    def __init__(self, name='environment_manager.mp'):
         """ Initialise logger """
-        self.logger = logging.getLogger()
+        LogWrapper.__init__(self, name)
         self.install_mp_handler()
 
     @classmethod
@@ -70,26 +126,6 @@ class LogWrapperMultiprocess(object):
             mp_name = "Main"
         return mp_name
 
-    def debug(self, message):
-        """ Debug """
-        self.logger.debug("%s %s - %s", self.process_name(), function_name(), message)
-
-    def info(self, message):
-        """ Info """
-        self.logger.info("%s %s - %s", self.process_name(), function_name(), message)
-
-    def warn(self, message):
-        """ Warn """
-        self.logger.warn("%s %s - %s", self.process_name(), function_name(), message)
-
-    def error(self, message):
-        """ Error """
-        self.logger.error("%s %s - %s", self.process_name(), function_name(), message, exc_info=True)
-
-    def critical(self, message):
-        """ Critical """
-        self.logger.critical("%s %s - %s", self.process_name(), function_name(), message, exc_info=True)
-
 def to_bool(value):
     """Converts 'something' to boolean. Raises exception for invalid formats
     Possible True  values: 1, True, "1", "TRue", "yes", "y", "t"
@@ -123,34 +159,79 @@ def function_name():
     """ Return the name of the function calling this code """
     return traceback.extract_stack(None, 3)[0][2]
 
+@contextlib.contextmanager
+def file_lock(lock_filename):
+    """ Hold an exclusive advisory lock on lock_filename for the duration of the block, a no-op where fcntl is unavailable """
+    lock_fd = os.open(lock_filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+def write_private_file(filename, content):
+    """ Atomically replace filename with content, readable and writable by the owner only """
+    tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    tmp_fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(tmp_fd, content.encode('utf-8'))
+    finally:
+        os.close(tmp_fd)
+    if hasattr(os, 'replace'):
+        os.replace(tmp_filename, filename)
+    else:
+        os.rename(tmp_filename, filename)
+
+def intern_string(value):
+    """ Canonical copy of a string, so the many records naming the same environment or cluster share one object.
+    Values intern won't take, eg. unicode on python 2, are returned as they are """
+    if value is None:
+        return None
+    try:
+        return intern(value)
+    except TypeError:
+        return value
+
+def endpoint_family(endpoint):
+    """ Group an endpoint by resource, eg. '/api/v1/asgs/x/ready?environment=y' is 'asgs' and '/api/v1/config/clusters/x' is 'config/clusters' """
+    path = endpoint.split('?', 1)[0].strip('/')
+    segments = path.split('/')
+    if len(segments) > 2 and segments[0] == 'api':
+        segments = segments[2:]
+    if segments and segments[0] == 'config' and len(segments) > 1:
+        return '/'.join(segments[:2])
+    return segments[0] if segments else ''
+
 def json_encode(input_object):
-    """ Encode and returns a JSON stream """
-    return simplejson.dumps(input_object)
+    """ Encode and returns a JSON stream, with simplejson's spacing as other tools read what we write """
+    return codec.dumps_spaced(input_object)
 
 def json_decode(string):
     """ Decode a JSON stream and returns a python dictionary version """
-    log = LogWrapper()
     try:
-        decoded_json = simplejson.loads(string)
-    except simplejson.JSONDecodeError:
-        log.debug('Can\'t decode JSON string: %s' % string)
+        decoded_json = codec.loads(string)
+    except ValueError:
+        log.debug('Can\'t decode JSON string: %s', string)
         return None
     return decoded_json
 
 def json_load_file(input_file, retries=10, sleep_time=0.1):
     """ Load a JSON file and decode it, we keep an eye on malformed json outputs """
-    log = LogWrapper()
     missing_data = True
     output_object = None
     current_retry = 1
     while missing_data:
         if retries < current_retry:
-            log.error('Cannot read file %s after trying %s times, aborting' % (input_file, retries))
+            log.error('Cannot read file %s after trying %s times, aborting', input_file, retries)
             raise SystemError
         else:
             retries += 1
         try:
-            with open(input_file, 'r') as input_stream:
+            # Bytes go straight to the decoder, no text copy
+            with open(input_file, 'rb') as input_stream:
                 try:
                     output_object = json_decode(input_stream.read())
                 except Exception:
@@ -161,7 +242,7 @@ def json_load_file(input_file, retries=10, sleep_time=0.1):
                 else:
                     time.sleep(sleep_time)
         except Exception as error:
-            log.error('Cannot open file for reading: %s' % input_file)
+            log.error('Cannot open file for reading: %s', input_file)
             raise error
     return output_object
 
@@ -235,25 +316,24 @@ def generate_sensu_check(check_name=None,
 
 def compare_file_write(filename=None, content=None):
     """ The function compares a file against a string of content and writes the file if it differs """
-    log = LogWrapper()
     if filename is None or content is None:
-        log.info('Cannot write new file %s as nothing to compare against' % filename)
+        log.info('Cannot write new file %s as nothing to compare against', filename)
         return False
     if os.path.isfile(filename):
         with open(filename, "r") as original_file:
             orig_file_string = original_file.read()
             if re.sub('[ \n]', '', orig_file_string) == re.sub('[ \n]', '', content):
-                log.debug('File %s has not changed' % filename)
+                log.debug('File %s has not changed', filename)
                 write_file = False
             else:
-                log.info('File %s changed, refreshing' % filename)
+                log.info('File %s changed, refreshing', filename)
                 write_file = True
     else:
         write_file = True
 
     # Creating destination directory files
     if write_file is True:
-        log.debug('Writing file %s' % filename)
+        log.debug('Writing file %s', filename)
         with open(filename, 'w') as em_file:
             em_file.write(content)
         return True
@@ -262,7 +342,6 @@ def compare_file_write(filename=None, content=None):
 
 def compare_purge_dir(file_list=[], directory=None, pattern=None):
     """ The function compares a file against a string of content and writes the file if it differs """
-    log = LogWrapper()
     if directory is None:
         log.info('Cannot purge directory as no directory specified')
         return False
@@ -271,31 +350,30 @@ def compare_purge_dir(file_list=[], directory=None, pattern=None):
         for local_file in local_files:
             if pattern is not None:
                 if not local_file.startswith(pattern):
-                    log.debug('File %s is outside our realm, skipping...' % local_file)
+                    log.debug('File %s is outside our realm, skipping...', local_file)
                     continue
             full_local_filename = "%s/%s" % (directory, local_file)
             if full_local_filename not in file_list:
-                log.debug('Checking file %s' % full_local_filename)
+                log.debug('Checking file %s', full_local_filename)
                 # Remove this file as it shoudldn't be here
-                log.info('Removing file %s' % full_local_filename)
+                log.info('Removing file %s', full_local_filename)
                 try:
                     os.remove(full_local_filename)
                 except OSError:
-                    log.debug('Can\'t delete file %s, continuing' % full_local_filename)
+                    log.debug('Can\'t delete file %s, continuing', full_local_filename)
     return True
 
 def reload_program(command, max_tries=10, sleep_time=30):
     """ The function will reload a program, capture output and return the state and exec args """
-    log = LogWrapper()
     reload_try = True
     tries = 0
     while reload_try:
-        log.info('Reloading program %s' % command)
+        log.info('Reloading program %s', command)
         myproc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
         # Write state to file
         program_run_output = myproc.communicate()
         program_run_returncode = myproc.returncode
-        log.info('Reload finished %s (%s)' % (command, program_run_returncode))
+        log.info('Reload finished %s (%s)', command, program_run_returncode)
         if program_run_returncode == 0:
             reload_try = False
         else:
@@ -304,6 +382,6 @@ def reload_program(command, max_tries=10, sleep_time=30):
             else:
                 tries += 1
             mysleep = random.randint(1, sleep_time)
-            log.info('Will retry, sleeping for %s seconds' % mysleep)
+            log.info('Will retry, sleeping for %s seconds', mysleep)
             time.sleep(mysleep)
     return program_run_returncode, program_run_output
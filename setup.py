@@ -7,7 +7,8 @@ setup(name='environment_manager',
       url="https://github.com/trainline/python-environment_manager",
       author="Trainline Engineering",
       author_email="platform.development@thetrainline.com",
-      install_requires=['requests', 'simplejson'],
+      install_requires=['requests', 'simplejson', 'futures; python_version < "3"'],
+      extras_require={'async': ['aiohttp>=3.3'], 'fast': ['orjson; python_version >= "3.6"']},
       license='Apache 2.0',
       classifiers=['Development Status :: 3 - Alpha',
                    'Intended Audience :: Developers',
@@ -0,0 +1,42 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+import pytest
+from environment_manager import EMApi
+from tests.fake_server import FakeEMServer
+
+@pytest.fixture
+def server():
+    with FakeEMServer(seed=1) as fake_server:
+        yield fake_server
+
+class SlowReadsServer(FakeEMServer):
+    """ Holds GET answers back for 300ms and answers everything else straight away, so a write can start and finish
+    while a read of what it replaced is in flight """
+
+    def handle(self, method, path, headers, raw_body):
+        answer = FakeEMServer.handle(self, method, path, headers, raw_body)
+        if method == 'GET':
+            time.sleep(0.3)
+        return answer
+
+@pytest.fixture
+def slow_server():
+    with SlowReadsServer(seed=1) as fake_server:
+        yield fake_server
+
+@pytest.fixture
+def client():
+    """ Connects EMApi sessions to a FakeEMServer, already authenticated, and closes them after the test """
+    sessions = []
+
+    def connect(fake_server, **settings):
+        em_session = EMApi(fake_server.url, 'user', 'password', **settings)
+        em_session._get_token()
+        sessions.append(em_session)
+        return em_session
+
+    yield connect
+    for em_session in sessions:
+        em_session.close()
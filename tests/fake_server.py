@@ -0,0 +1,442 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Local stand-in for Environment Manager, to test and benchmark the client without a real server:
+#   python -m tests.fake_server --port 8080 --latency 0.02 --error-rate 0.01
+#   em_session = EMApi('http://127.0.0.1:8080', 'user', 'password')
+
+import argparse
+import base64
+import hashlib
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from environment_manager import codec
+from environment_manager.pagination import audit_timestamp, deployment_timestamp, to_epoch, to_iso
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+# What nodes of a deployment go through, LastCompletedStage of their status
+_STAGES = ('Pre-deployment', 'Downloading', 'Installing', 'Starting', 'Health checks', 'Complete')
+# Collections filtered by the since/until query arguments, with the timestamp of their records
+_TIME_FILTERED = {'/api/v1/config/audit': audit_timestamp, '/api/v1/deployments': deployment_timestamp}
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid response, eg. a streamed query abandoned early, are not server errors
+        if not isinstance(sys.exc_info()[1], (socket.error, IOError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+class FakeEMHandler(BaseHTTPRequestHandler):
+    """ Serves requests from the FakeEMServer attached to the HTTP server """
+
+    # Keep-alive, so client connection pooling behaves like it does against the real thing
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes, without this delayed ACKs add 40ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body=None, headers=None):
+        if body is None:
+            content = b''
+        elif isinstance(body, bytes):
+            content = body
+        elif isinstance(body, str):
+            content = body.encode('utf-8')
+        else:
+            content = codec.dumps_bytes(body)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None and not isinstance(body, (bytes, str)):
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+        status, body, headers = self.server.em.handle(self.command, self.path, self.headers, raw_body)
+        self._respond(status, body, headers)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+class FakeEMServer(object):
+    """ In-memory Environment Manager serving /api/v1/token and the main GET/PUT/POST/PATCH/DELETE endpoints of EMApi """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0, error_status=503,
+                 payload_items=20, payload_padding=0, token_ttl=3600, deployment_duration=0.0, deployment_failure_rate=0.0,
+                 deployment_nodes=2, deployment_log_lines=20, audit_entries=0, history=7 * 86400, max_response_items=None,
+                 seed=None):
+        """ Every request waits latency plus up to latency_jitter seconds. A share error_rate of requests other than
+        authentication fail with error_status. Collections hold payload_items items, each carrying payload_padding
+        extra bytes. Tokens expire after token_ttl seconds and deployments succeed deployment_duration seconds after
+        being created, going through deployment_nodes instances that each log deployment_log_lines lines meanwhile;
+        a share deployment_failure_rate of them fail instead. audit_entries audit log entries and the deployments are spread over the last history seconds.
+        Lists longer than max_response_items fail with a 504, like a time range too big for the real server.
+        The port is bound straight away, 0 picks a free one """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.payload_items = payload_items
+        self.payload_padding = payload_padding
+        self.token_ttl = token_ttl
+        self.deployment_duration = deployment_duration
+        self.deployment_failure_rate = deployment_failure_rate
+        self.deployment_nodes = deployment_nodes
+        self.deployment_log_lines = deployment_log_lines
+        self.audit_entries = audit_entries
+        self.history = history
+        self.max_response_items = max_response_items
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._store = {}
+        # Deployment path: (creation time, whether it fails)
+        self._deployments_started = {}
+        self._stats = {}
+        self._thread = None
+        self._seed_store()
+        self.httpd = _ThreadingHTTPServer((host, port), FakeEMHandler)
+        self.httpd.em = self
+
+    @property
+    def address(self):
+        """ host:port the server listens on """
+        host, port = self.httpd.server_address[:2]
+        return '%s:%s' % (host, port)
+
+    @property
+    def url(self):
+        """ Base URL to give EMApi as server """
+        return 'http://%s' % self.address
+
+    def start(self):
+        """ Serve from a background thread """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-em-server')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """ Serve from the calling thread until interrupted """
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+
+    def stop(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stats(self):
+        """ Request counters: requests, per method, tokens issued, injected errors, not modified responses """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+    def _seed_store(self):
+        """ Generate payload_items of every main resource """
+        count = max(1, self.payload_items)
+        padding = 'x' * self.payload_padding
+        store = self._store
+        environments = ['env%02d' % index for index in range(count)]
+        clusters = ['cluster%02d' % index for index in range(count)]
+        services = ['service%02d' % index for index in range(count)]
+        store['/api/v1/config/accounts'] = [{'AccountName': 'account%02d' % index, 'AccountNumber': 100000000000 + index,
+                                             'IsProd': False, 'Description': padding} for index in range(count)]
+        store['/api/v1/config/clusters'] = [{'ClusterName': cluster, 'Value': {'GroupMembership': cluster, 'Description': padding}}
+                                            for cluster in clusters]
+        store['/api/v1/environments'] = []
+        store['/api/v1/config/environments'] = []
+        store['/api/v1/services'] = []
+        store['/api/v1/config/services'] = []
+        store['/api/v1/asgs'] = []
+        store['/api/v1/instances'] = []
+        store['/api/v1/deployments'] = []
+        store['/api/v1/config/audit'] = []
+        now = time.time()
+        for index, environment in enumerate(environments):
+            cluster = clusters[index]
+            item = {'EnvironmentName': environment, 'Value': {'EnvironmentType': 'Cluster', 'OwningCluster': cluster, 'Description': padding}}
+            store['/api/v1/environments'].append(item)
+            store['/api/v1/config/environments'].append(item)
+            store['/api/v1/environments/%s' % environment] = item
+            store['/api/v1/config/environments/%s' % environment] = item
+            store['/api/v1/environments/%s/accountName' % environment] = 'account%02d' % index
+            store['/api/v1/environments/%s/schedule-status' % environment] = {'Status': 'ON'}
+        for index, service in enumerate(services):
+            environment = environments[index]
+            cluster = clusters[index]
+            asgname = '%s-%s' % (environment, service)
+            instances = []
+            for number in range(2):
+                instance_id = 'i-%012x' % (index * 2 + number)
+                instance = {'InstanceId': instance_id, 'PrivateIpAddress': '10.0.%s.%s' % (index // 250, (index * 2 + number) % 250 + 1),
+                            'State': {'Name': 'running'}, 'Environment': environment, 'Role': service, 'AutoScalingGroup': asgname,
+                            'Description': padding}
+                instances.append(instance)
+                store['/api/v1/instances'].append(instance)
+                store['/api/v1/instances/%s' % instance_id] = instance
+            service_item = {'ServiceName': service, 'OwningCluster': cluster, 'Description': padding}
+            store['/api/v1/services'].append(service_item)
+            store['/api/v1/services/%s' % service] = service_item
+            store['/api/v1/config/services'].append({'ServiceName': service, 'OwningCluster': cluster, 'Value': {'Description': padding}})
+            store['/api/v1/config/services/%s/%s' % (service, cluster)] = store['/api/v1/config/services'][-1]
+            store['/api/v1/services/%s/health' % service] = {'OverallHealth': 'Healthy', 'Service': service, 'Environment': environment}
+            for slice in ('blue', 'green'):
+                store['/api/v1/services/%s/health/%s' % (service, slice)] = {'Service': service, 'Slice': slice, 'OverallHealth': 'Healthy'}
+            store['/api/v1/services/%s/asgs' % service] = [{'AutoScalingGroupName': asgname}]
+            asg = {'AutoScalingGroupName': asgname, 'DesiredCapacity': 2, 'MinSize': 0, 'MaxSize': 4,
+                   'Instances': [{'InstanceId': instance['InstanceId'], 'LifecycleState': 'InService'} for instance in instances],
+                   'Tags': [{'Key': 'Environment', 'Value': environment}, {'Key': 'Role', 'Value': service}],
+                   'Description': padding}
+            store['/api/v1/asgs'].append(asg)
+            store['/api/v1/asgs/%s' % asgname] = asg
+            store['/api/v1/asgs/%s/ready' % asgname] = {'InstancesCount': {'All': 2, 'InService': 2}, 'InstancesState': 'All Instances are in service', 'ReadyToDeploy': True}
+            store['/api/v1/asgs/%s/ips' % asgname] = [instance['PrivateIpAddress'] for instance in instances]
+            store['/api/v1/asgs/%s/size' % asgname] = {'min': 0, 'desired': 2, 'max': 4}
+            store['/api/v1/asgs/%s/scaling-schedule' % asgname] = []
+            store['/api/v1/environments/%s/servers/%s' % (environment, asgname)] = {'Name': asgname, 'Instances': instances}
+            deployment_id = str(uuid.UUID(int=index + 1))
+            started = now - self.history * (count - index) / float(count)
+            deployment = {'DeploymentID': deployment_id, 'AccountName': 'account%02d' % index, 'Value': {
+                'EnvironmentName': environment, 'ServiceName': service, 'ServiceVersion': '1.0.%s' % index,
+                'Status': 'Success', 'StartTimestamp': to_iso(started), 'EndTimestamp': to_iso(started + 60)}}
+            store['/api/v1/deployments'].append(deployment)
+            store['/api/v1/deployments/%s' % deployment_id] = deployment
+            store['/api/v1/deployments/%s/log' % deployment_id] = 'Deployment %s started\nDeployment %s succeeded\n' % (deployment_id, deployment_id)
+        for index in range(self.audit_entries):
+            service = services[index % count]
+            entry = {'AuditID': str(uuid.UUID(int=index + 1)), 'TransactionID': str(uuid.UUID(int=(index // 3) + 1)),
+                     'Entity': {'Type': 'ConfigServices', 'Key': '%s/%s' % (service, clusters[index % count]), 'Version': index},
+                     'ChangeType': ('Created', 'Updated', 'Deleted')[index % 3], 'ChangedBy': 'user%02d' % (index % 7),
+                     'Timestamp': to_iso(now - self.history * (self.audit_entries - index) / float(self.audit_entries))}
+            store['/api/v1/config/audit'].append(entry)
+            store['/api/v1/config/audit/%s' % entry['AuditID']] = entry
+        store['/api/v1/diagnostics/healthcheck'] = {'OK': True}
+
+    def _issue_token(self, raw_body):
+        try:
+            username = codec.loads(raw_body).get('username', 'user')
+        except (ValueError, AttributeError):
+            return 400, 'Missing credentials', None
+        header = _b64(b'{"alg":"none","typ":"JWT"}')
+        payload = _b64(codec.dumps({'sub': username, 'exp': int(time.time() + self.token_ttl)}).encode('utf-8'))
+        self._count('tokens_issued')
+        return 200, '%s.%s.fake' % (header, payload), None
+
+    @classmethod
+    def _token_error(cls, authorization):
+        """ Why a bearer token is refused, None if it is fine """
+        try:
+            payload = authorization.split(' ', 1)[1].split('.')[1]
+            claims = codec.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+        except (AttributeError, IndexError, TypeError, ValueError):
+            return 'invalid token'
+        if claims.get('exp', 0) <= time.time():
+            return 'jwt expired'
+        return None
+
+    def handle(self, method, path, headers, raw_body):
+        """ Answer a request, returns (status, body, headers) """
+        self._count('requests')
+        self._count(method)
+        delay = self.latency + (self._random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+        path, _, query = path.partition('?')
+        path = path.rstrip('/') or '/'
+        if path == '/api/v1/token' and method == 'POST':
+            return self._issue_token(raw_body)
+        token_error = self._token_error(headers.get('Authorization'))
+        if token_error is not None:
+            self._count('unauthorized')
+            return 401, token_error, None
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._count('errors_injected')
+            return self.error_status, 'Injected error', None
+        body = None
+        if raw_body:
+            try:
+                body = codec.loads(raw_body)
+            except ValueError:
+                return 400, {'error': 'Body is not valid JSON'}, None
+        if method in ('GET', 'HEAD'):
+            return self._get(path, headers, query)
+        if method == 'DELETE':
+            with self._lock:
+                if self._store.pop(path, None) is None:
+                    return 404, {'error': 'Resource %s not found' % path}, None
+            return 200, {'ok': True}, None
+        if method == 'POST' and path == '/api/v1/deployments':
+            return self._create_deployment(body or {})
+        with self._lock:
+            current = self._store.get(path)
+            if method == 'POST' and isinstance(current, list):
+                current.append(body)
+                return 201, body, None
+            if method in ('PUT', 'PATCH') and isinstance(current, dict) and isinstance(body, dict):
+                current = dict(current)
+                current.update(body)
+                body = current
+            self._store[path] = body
+        return 201 if method == 'POST' else 200, body, None
+
+    def _get(self, path, headers, query=''):
+        with self._lock:
+            simulated = self._deployments_started.get(path[:-len('/log')]) if path.endswith('/log') else None
+            if simulated is not None:
+                return 200, self._deployment_log(parse_qs(query).get('instance', [''])[0], *simulated), None
+            if path not in self._store:
+                return 404, {'error': 'Resource %s not found' % path}, None
+            value = self._store[path]
+            if path in _TIME_FILTERED:
+                value = self._in_time_range(value, _TIME_FILTERED[path], parse_qs(query))
+            too_large = self.max_response_items is not None and isinstance(value, list) and len(value) > self.max_response_items
+            if path in self._deployments_started:
+                self._advance_deployment(value, *self._deployments_started[path])
+            content = None if too_large else codec.dumps_bytes(value)
+        if too_large:
+            self._count('too_large')
+            return 504, 'Gateway Timeout', None
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if headers.get('If-None-Match') == etag:
+            self._count('not_modified')
+            return 304, b'', {'ETag': etag}
+        return 200, content, {'ETag': etag, 'Content-Type': 'application/json'}
+
+    @classmethod
+    def _in_time_range(cls, records, timestamp, arguments):
+        """ Records whose timestamp is within the since and until query arguments """
+        # Stored timestamps all have the to_iso format, so they compare as strings without parsing every record
+        since = to_iso(to_epoch(arguments['since'][0])) if 'since' in arguments else None
+        until = to_iso(to_epoch(arguments['until'][0])) if 'until' in arguments else None
+        if since is None and until is None:
+            return records
+        selected = []
+        for record in records:
+            moment = timestamp(record)
+            if moment is None or (since is None or moment >= since) and (until is None or moment <= until):
+                selected.append(record)
+        return selected
+
+    def _progress(self, started):
+        if self.deployment_duration <= 0:
+            return 1.0
+        return min(1.0, (time.time() - started) / self.deployment_duration)
+
+    def _advance_deployment(self, deployment, started, failing):
+        """ Bring a deployment and its nodes up to date, caller holds the lock. The first node fails a failing one """
+        value = deployment['Value']
+        progress = self._progress(started)
+        stage = _STAGES[min(len(_STAGES) - 1, int(progress * len(_STAGES)))]
+        for number, node in enumerate(value['Nodes']):
+            if progress < 1:
+                node.update({'Status': 'In Progress', 'LastCompletedStage': stage})
+            else:
+                node.update({'Status': 'Failed' if failing and number == 0 else 'Success', 'LastCompletedStage': _STAGES[-1]})
+        if progress >= 1 and value['Status'] == 'In Progress':
+            value['Status'] = 'Failed' if failing else 'Success'
+            value['EndTimestamp'] = to_iso(started + self.deployment_duration)
+            if failing:
+                value['ErrorReason'] = 'Deployment failed on %s' % value['Nodes'][0]['InstanceId']
+
+    def _deployment_log(self, instance, started, failing):
+        """ Log of an instance taking part in a deployment, the lines written so far """
+        total = self.deployment_log_lines
+        written = int(self._progress(started) * total)
+        lines = ['%s [%s] Step %s/%s %s' % (to_iso(started + self.deployment_duration * number / float(max(total, 1))), instance,
+                                            number + 1, total, _STAGES[number * len(_STAGES) // max(total, 1)])
+                 for number in range(written)]
+        if written == total and failing and instance.endswith('-0'):
+            lines.append('%s [%s] ERROR Health check did not pass' % (to_iso(started + self.deployment_duration), instance))
+        return ''.join('%s\n' % line for line in lines)
+
+    def _create_deployment(self, request):
+        """ New deployment, In Progress until deployment_duration has passed """
+        deployment_id = str(uuid.uuid4())
+        started = time.time()
+        failing = bool(self.deployment_failure_rate) and self._random.random() < self.deployment_failure_rate
+        nodes = [{'InstanceId': 'i-%s-%s' % (deployment_id[:8], number), 'Status': 'In Progress', 'LastCompletedStage': _STAGES[0]}
+                 for number in range(max(1, self.deployment_nodes))]
+        deployment = {'DeploymentID': deployment_id, 'AccountName': 'account00', 'Value': {
+            'EnvironmentName': request.get('environment'), 'ServiceName': request.get('service'),
+            'ServiceVersion': request.get('version'), 'Status': 'In Progress', 'StartTimestamp': to_iso(started),
+            'Nodes': nodes}}
+        path = '/api/v1/deployments/%s' % deployment_id
+        with self._lock:
+            self._store['/api/v1/deployments'].append(deployment)
+            self._store[path] = deployment
+            self._deployments_started[path] = (started, failing)
+        return 201, {'id': deployment_id, 'isAccepted': True}, None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local fake Environment Manager')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Up to this many more random seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing, 0 to 1')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--payload-items', type=int, default=20, help='Items in every collection')
+    parser.add_argument('--payload-padding', type=int, default=0, help='Extra bytes in every item')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='Seconds tokens stay valid')
+    parser.add_argument('--deployment-duration', type=float, default=0.0, help='Seconds new deployments stay In Progress')
+    parser.add_argument('--deployment-failure-rate', type=float, default=0.0, help='Share of new deployments failing, 0 to 1')
+    parser.add_argument('--deployment-nodes', type=int, default=2, help='Instances new deployments go through')
+    parser.add_argument('--deployment-log-lines', type=int, default=20, help='Log lines each instance writes during a deployment')
+    parser.add_argument('--audit-entries', type=int, default=0, help='Audit log entries spread over the history')
+    parser.add_argument('--history', type=float, default=7 * 86400, help='Seconds of audit and deployment history')
+    parser.add_argument('--max-response-items', type=int, default=None, help='Longer lists fail with a 504')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+    server = FakeEMServer(host=args.host, port=args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+                          error_rate=args.error_rate, error_status=args.error_status, payload_items=args.payload_items,
+                          payload_padding=args.payload_padding, token_ttl=args.token_ttl,
+                          deployment_duration=args.deployment_duration, deployment_failure_rate=args.deployment_failure_rate,
+                          deployment_nodes=args.deployment_nodes, deployment_log_lines=args.deployment_log_lines, audit_entries=args.audit_entries,
+                          history=args.history, max_response_items=args.max_response_items, seed=args.seed)
+    print('Fake Environment Manager listening on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
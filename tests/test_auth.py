@@ -0,0 +1,19 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+from environment_manager.auth import TokenCache, TokenManager
+
+class ReadOnlyCache(TokenCache):
+    """ Token cache on a read-only filesystem, every access fails """
+    def get(self, key, min_validity=0):
+        raise OSError(30, 'Read-only file system')
+
+    def discard(self, key, token):
+        raise OSError(30, 'Read-only file system')
+
+def test_renew_falls_back_to_fetch_when_cache_fails(tmpdir):
+    tokens = iter(['first', 'second'])
+    manager = TokenManager(lambda: next(tokens), cache=ReadOnlyCache(str(tmpdir.join('tokens.json'))), cache_key='key')
+    assert manager.get() == 'first'
+    assert manager.renew('first') == 'second'
+    assert manager.refresh_errors == 0
@@ -0,0 +1,74 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import time
+from environment_manager.cache import ResponseCache, ValidatorStore
+
+SERVICES = '/api/v1/config/services'
+NEW_SERVICE = {'ServiceName': 'new', 'OwningCluster': 'cluster00', 'Value': {}}
+
+def in_background(function):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function()))
+    thread.start()
+    return thread, results
+
+def add_service(em_session):
+    em_session.query(SERVICES, data=NEW_SERVICE, query_type='POST')
+
+def test_cached_for_the_endpoint_ttl(server, client):
+    em_session = client(server, cache=ResponseCache(ttls={SERVICES: 60}))
+    first = em_session.get_services_config()
+    assert em_session.get_services_config() == first
+    em_session.get_accounts_config()
+    em_session.get_accounts_config()
+    assert server.stats()['GET'] == 3
+
+def test_write_invalidates_cached_collection(server, client):
+    em_session = client(server, cache=ResponseCache(ttls={SERVICES: 60}))
+    em_session.get_services_config()
+    add_service(em_session)
+    assert em_session.get_services_config()[-1] == NEW_SERVICE
+    assert server.stats()['GET'] == 2
+
+def test_read_started_before_a_write_is_not_cached(slow_server, client):
+    em_session = client(slow_server, cache=ResponseCache(ttls={SERVICES: 60}), coalesce_requests=False)
+    thread, results = in_background(em_session.get_services_config)
+    time.sleep(0.1)
+    add_service(em_session)
+    thread.join()
+    assert NEW_SERVICE not in results[0]
+    assert em_session.get_services_config()[-1] == NEW_SERVICE
+
+def test_invalidation_only_touches_related_paths():
+    cache = ResponseCache(default_ttl=60)
+    sibling = ResponseCache.key('/api/v1/config/services/service01')
+    parent = ResponseCache.key(SERVICES)
+    generation = cache.generation()
+    cache.invalidate_for_write('/api/v1/config/services/service00')
+    cache.put(sibling, 'sibling', generation=generation)
+    cache.put(parent, 'parent', generation=generation)
+    assert cache.get(sibling) == (True, 'sibling')
+    assert cache.get(parent) == (False, None)
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2, default_ttl=60)
+    for path in ('/a', '/b', '/c'):
+        cache.put(ResponseCache.key(path), path)
+    assert cache.get(ResponseCache.key('/a')) == (False, None)
+    assert cache.stats()['evictions'] == 1
+
+def test_not_modified_decodes_the_stored_body_again():
+    validators = ValidatorStore()
+    validators.store(('/api/v1/asgs', None), {'ETag': '"1"'}, [{'name': 'a'}], b'[{"name":"a"}]')
+    first = validators.not_modified_value(('/api/v1/asgs', None))[1]
+    first[0]['name'] = 'changed'
+    assert validators.not_modified_value(('/api/v1/asgs', None)) == (True, [{'name': 'a'}])
+    assert validators.request_headers(('/api/v1/asgs', None)) == {'If-None-Match': '"1"'}
+
+def test_not_modified_shares_the_stored_value_without_copies():
+    validators = ValidatorStore(copy_results=False)
+    value = [{'name': 'a'}]
+    validators.store(('/api/v1/asgs', None), {'ETag': '"1"'}, value, b'[{"name":"a"}]')
+    assert validators.not_modified_value(('/api/v1/asgs', None))[1] is value
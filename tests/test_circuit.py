@@ -0,0 +1,59 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+import pytest
+from environment_manager.circuit import AdaptiveLimiter, CircuitBreaker, CircuitBreakers, CircuitOpenError, ConcurrencyLimitError
+
+def open_breaker(**settings):
+    breaker = CircuitBreaker(minimum_calls=2, reset_timeout=0.05, **settings)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+def test_open_circuit_rejects_until_reset_timeout():
+    breaker = open_breaker()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    time.sleep(0.06)
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+def test_half_open_limits_probes_and_closes_on_success():
+    breaker = open_breaker(half_open_max_calls=2)
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_half_open_probe_failure_reopens():
+    breaker = open_breaker(half_open_max_calls=2)
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+
+def test_probe_without_concurrency_slot_is_given_back(server, client):
+    breakers = CircuitBreakers(minimum_calls=2, reset_timeout=0.05, half_open_max_calls=1)
+    limiter = AdaptiveLimiter(initial_limit=1, acquire_timeout=0)
+    em_session = client(server, circuit_breaker=breakers, concurrency_limiter=limiter)
+    breaker = breakers.get(em_session.server, '/api/v1/config/accounts')
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    # Authenticating grew the limit, take the only slot
+    limiter.limit = 1
+    limiter.acquire()
+    with pytest.raises(ConcurrencyLimitError):
+        em_session.get_accounts_config()
+    limiter.release()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    em_session.get_accounts_config()
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,48 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+import pytest
+from tests.fake_server import FakeEMServer
+
+class MissingLogsServer(FakeEMServer):
+    """ Answers 404 for every deployment log, like logs that were never written or have been purged """
+    def handle(self, method, path, headers, raw_body):
+        if path.split('?')[0].endswith('/log'):
+            return 404, {'error': 'Log not found'}, None
+        return FakeEMServer.handle(self, method, path, headers, raw_body)
+
+@pytest.fixture
+def missing_logs_server():
+    with MissingLogsServer(deployment_duration=0.2, seed=1) as fake_server:
+        yield fake_server
+
+def test_tail_gives_up_on_logs_that_keep_failing(missing_logs_server, client):
+    em_session = client(missing_logs_server)
+    deployment_id = em_session.post_deployments(data={'environment': 'c50', 'service': 'Svc', 'version': '1.0.0'})['id']
+    start = time.time()
+    tail = em_session.tail_deployment_logs(deployment_id, min_interval=0.05, max_interval=0.1, timeout=None)
+    assert list(tail) == []
+    assert time.time() - start < 10
+
+@pytest.fixture
+def failing_server():
+    with FakeEMServer(deployment_duration=0.2, deployment_failure_rate=1.0, seed=1) as fake_server:
+        yield fake_server
+
+def start_deployments(em_session, count):
+    return [em_session.post_deployments(data={'environment': 'c50', 'service': 'Svc%s' % index, 'version': '1.0.0'})['id']
+            for index in range(count)]
+
+def test_waiter_stops_at_the_first_failure(failing_server, client):
+    em_session = client(failing_server)
+    deployment_ids = start_deployments(em_session, 3)
+    events = list(em_session.wait_for_deployments(deployment_ids, timeout=30))
+    assert [event.kind for event in events].count('failed') == 1
+    assert events[-1].kind == 'failed'
+
+def test_waiter_can_wait_for_every_failure(failing_server, client):
+    em_session = client(failing_server)
+    deployment_ids = start_deployments(em_session, 3)
+    events = list(em_session.wait_for_deployments(deployment_ids, timeout=30, stop_on_failure=False))
+    assert [event.kind for event in events].count('failed') == 3
@@ -0,0 +1,56 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+import pytest
+from environment_manager.retry import RetryPolicy
+from tests.fake_server import FakeEMServer
+
+def test_serves_the_main_collections(server, client):
+    em_session = client(server)
+    assert len(em_session.get_services_config()) == 20
+    assert em_session.get_asg_ready(environment='env00', asgname='env00-service00')['ReadyToDeploy'] is True
+    assert server.stats()['tokens_issued'] == 1
+
+def test_writes_are_read_back(server, client):
+    em_session = client(server)
+    em_session.query('/api/v1/config/clusters', data={'ClusterName': 'new'}, query_type='POST')
+    assert em_session.get_clusters_config()[-1] == {'ClusterName': 'new'}
+    with pytest.raises(ValueError):
+        em_session.get_cluster_config(cluster='nothing-there')
+
+def test_latency_is_added_to_every_request(client):
+    with FakeEMServer(latency=0.1, seed=1) as server:
+        em_session = client(server)
+        started = time.time()
+        em_session.get_accounts_config()
+        assert time.time() - started >= 0.1
+
+def test_injected_errors(client):
+    with FakeEMServer(error_rate=1.0, error_status=502, seed=1) as server:
+        em_session = client(server, retry_policy=RetryPolicy(max_attempts=2, backoff_base=0.01))
+        with pytest.raises(SystemError):
+            em_session.get_accounts_config()
+        assert server.stats()['errors_injected'] == 2
+
+def test_expired_tokens_are_refused(client):
+    with FakeEMServer(token_ttl=1, seed=1) as server:
+        em_session = client(server)
+        time.sleep(1.1)
+        # Have the client send its expired token, it renews it on the server's refusal
+        em_session.token_manager.expires_at = time.time() + 3600
+        em_session.get_accounts_config()
+        assert server.stats()['unauthorized'] == 1
+        assert server.stats()['tokens_issued'] == 2
+
+def test_payload_size(client):
+    with FakeEMServer(payload_items=3, payload_padding=100, seed=1) as server:
+        accounts = client(server).get_accounts_config()
+        assert len(accounts) == 3
+        assert len(accounts[0]['Description']) == 100
+
+def test_conditional_get_answers_not_modified(server, client):
+    em_session = client(server, conditional_requests=True)
+    first = em_session.get_services_config()
+    assert em_session.get_services_config() == first
+    assert server.stats()['not_modified'] == 1
@@ -0,0 +1,13 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+from environment_manager.inventory import Inventory
+
+def test_unchanged_collections_are_not_parsed_again(server, client):
+    em_session = client(server, conditional_requests=True)
+    inventory = Inventory(em_session, accounts=['account00'])
+    assert inventory.refresh(force=True)
+    instances = inventory.instances()
+    assert not inventory.refresh(force=True)
+    assert server.stats()['not_modified'] == 2
+    assert inventory.instances() == instances
@@ -0,0 +1,56 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+import pytest
+from environment_manager.pagination import TimeWindowPager, to_epoch, to_iso
+from tests.fake_server import FakeEMServer
+
+DAY = 86400
+
+@pytest.fixture
+def audit_server():
+    """ 600 audit entries over a day, lists of more than 100 items fail like a time range too big for the real server """
+    with FakeEMServer(audit_entries=600, history=DAY, max_response_items=100, seed=1) as fake_server:
+        yield fake_server
+
+def test_windows_cover_the_range_in_order(audit_server, client):
+    em_session = client(audit_server)
+    until = time.time()
+    fetch = lambda since, until: em_session.get_audit_config(since=since, until=until)
+    pager = TimeWindowPager(fetch, until - DAY - 60, until, window=3600, target_records=50)
+    records = list(pager)
+    timestamps = [to_epoch(record['Timestamp']) for record in records]
+    assert len(records) == 600
+    assert len(set(record['AuditID'] for record in records)) == 600
+    assert timestamps == sorted(timestamps)
+
+def test_failing_windows_are_split(audit_server, client):
+    em_session = client(audit_server)
+    until = time.time()
+    fetch = lambda since, until: em_session.get_audit_config(since=since, until=until)
+    pager = TimeWindowPager(fetch, until - DAY - 60, until, window=DAY, target_records=50, max_workers=2)
+    assert len(list(pager)) == 600
+    assert pager.windows_split > 0
+
+def test_paginate_audit_config(audit_server, client):
+    em_session = client(audit_server)
+    records = list(em_session.paginate_audit_config(since=time.time() - DAY - 60, window=1800, target_records=50))
+    assert len(records) == 600
+
+def test_records_outside_their_window_and_duplicates_are_dropped():
+    records = [{'AuditID': str(index), 'Timestamp': to_iso(1000 + index * 10)} for index in range(10)]
+    # Returns the whole list whatever the window, like a server ignoring until
+    pager = TimeWindowPager(lambda since, until: records, 1000, 1100, window=25, max_workers=1)
+    assert [record['AuditID'] for record in pager] == [str(index) for index in range(10)]
+
+def test_records_at_the_end_of_the_range_are_kept():
+    records = [{'AuditID': str(index), 'Timestamp': to_iso(1000 + index * 10)} for index in range(11)]
+    fetch = lambda since, until: [record for record in records if since <= record['Timestamp'] <= until]
+    pager = TimeWindowPager(fetch, 1000, 1100, window=50, max_workers=1)
+    assert [record['AuditID'] for record in pager] == [str(index) for index in range(11)]
+    assert pager.duplicates == 0
+
+def test_to_iso_carries_rounded_milliseconds():
+    assert to_iso(1700000000.9996) == '2023-11-14T22:13:21.000Z'
+    assert to_epoch(to_iso(1700000000.25)) == 1700000000.25
@@ -0,0 +1,17 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import pytest
+from environment_manager.ratelimit import RateLimiter, RateLimitError
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_rejected_request_spends_no_budget(tmpdir, shared):
+    shared_path = os.path.join(str(tmpdir), 'ratelimit.json') if shared else None
+    limiter = RateLimiter(rate=0.5, burst=2, overrides={'/api/v1/deployments': (0.1, 1)}, shared_path=shared_path, max_wait=1)
+    limiter.reserve('/api/v1/deployments')
+    for _ in range(3):
+        with pytest.raises(RateLimitError):
+            limiter.reserve('/api/v1/deployments')
+    # The global budget still holds its second token
+    assert limiter.reserve('/api/v1/asgs') == 0
@@ -0,0 +1,54 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import time
+import pytest
+from environment_manager.retry import Deadline, RetryPolicy
+from tests.fake_server import FakeEMServer
+
+def test_deadline_stops_retries_early(client):
+    policy = RetryPolicy(max_attempts=20, backoff_base=0.2, jitter=False, deadline=0.5)
+    with FakeEMServer(error_rate=1.0, error_status=503, seed=1) as server:
+        em_session = client(server, retry_policy=policy)
+        started = time.time()
+        with pytest.raises(SystemError):
+            em_session.get_accounts_config()
+        assert time.time() - started < 1.0
+        assert server.stats()['errors_injected'] < 5
+
+def test_attempts_are_retried_until_max_attempts(client):
+    policy = RetryPolicy(max_attempts=3, backoff_base=0.01, jitter=False)
+    with FakeEMServer(error_rate=1.0, error_status=503, seed=1) as server:
+        em_session = client(server, retry_policy=policy)
+        with pytest.raises(SystemError):
+            em_session.get_accounts_config()
+        assert server.stats()['errors_injected'] == 3
+
+def test_deadline_allows_only_delays_that_leave_time():
+    deadline = Deadline(1)
+    assert deadline.allows(0.5)
+    assert not deadline.allows(2)
+    assert Deadline().allows(1000)
+    assert Deadline().remaining() is None
+
+def test_timeouts_are_clamped_to_deadline():
+    policy = RetryPolicy(connect_timeout=5, read_timeout=30)
+    connect_timeout, read_timeout = policy.timeout_for('/api/v1/asgs', Deadline(2))
+    assert connect_timeout <= 2 and read_timeout <= 2
+
+class Response(object):
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+def test_retry_after_wins_over_backoff():
+    policy = RetryPolicy(backoff_base=10, jitter=False, max_retry_after=5)
+    assert policy.delay(1, Response(429, {'Retry-After': '2'})) == 2
+    assert policy.delay(1, Response(503, {'Retry-After': '600'})) == 5
+    assert policy.delay(1, Response(500, {'Retry-After': '2'})) == 10
+
+def test_non_idempotent_requests_only_retried_on_429():
+    policy = RetryPolicy()
+    assert policy.retry_on_status('PUT', '/api/v1/asgs/x', 503)
+    assert not policy.retry_on_status('POST', '/api/v1/deployments', 503)
+    assert policy.retry_on_status('POST', '/api/v1/deployments', 429)
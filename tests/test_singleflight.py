@@ -0,0 +1,60 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import time
+import pytest
+from environment_manager.singleflight import SingleFlight
+
+SERVICES = '/api/v1/config/services'
+NEW_SERVICE = {'ServiceName': 'new', 'OwningCluster': 'cluster00', 'Value': {}}
+
+def in_background(function):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function()))
+    thread.start()
+    return thread, results
+
+def test_concurrent_identical_reads_are_coalesced(slow_server, client):
+    em_session = client(slow_server)
+    calls = [in_background(em_session.get_services_config) for _ in range(5)]
+    for thread, results in calls:
+        thread.join()
+    assert slow_server.stats()['GET'] == 1
+    assert em_session.single_flight.stats() == {'calls': 1, 'shared': 4, 'in_flight': 0}
+
+def test_write_is_followed_by_a_new_request_instead_of_a_coalesced_one(slow_server, client):
+    em_session = client(slow_server)
+    before, before_results = in_background(em_session.get_services_config)
+    time.sleep(0.1)
+    em_session.query(SERVICES, data=NEW_SERVICE, query_type='POST')
+    after, after_results = in_background(em_session.get_services_config)
+    before.join()
+    after.join()
+    assert NEW_SERVICE not in before_results[0]
+    assert after_results[0][-1] == NEW_SERVICE
+    assert em_session.single_flight.stats()['shared'] == 0
+
+def test_followers_share_the_error():
+    single_flight = SingleFlight()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise SystemError('down')
+
+    errors = []
+    def follow():
+        started.wait()
+        try:
+            single_flight.do('key', failing)
+        except SystemError as error:
+            errors.append(error)
+    follower = threading.Thread(target=follow)
+    follower.start()
+    with pytest.raises(SystemError):
+        single_flight.do('key', failing)
+    follower.join()
+    assert len(errors) == 1
+    assert single_flight.stats()['calls'] == 1
@@ -0,0 +1,52 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+from environment_manager.streaming import StreamingDecodeError, iter_json_items
+
+ITEMS = [{'Name': u'café ☃', 'Tags': ['[', ']', '{', '}', ','], 'Escaped': '\\"quoted\\"'},
+         12345, -0.5, True, None, u'\U0001f680', [], {}]
+
+def chunked(data, size):
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64])
+def test_items_split_across_chunks(size):
+    body = json.dumps(ITEMS, ensure_ascii=False).encode('utf-8')
+    assert list(iter_json_items(chunked(body, size))) == ITEMS
+
+@pytest.mark.parametrize('size', [1, 5, 4096])
+def test_array_member_of_an_object(size):
+    body = json.dumps({'Count': 3, 'Skipped': [1], 'Items': ITEMS}).encode('utf-8')
+    assert list(iter_json_items(chunked(body, size), key='Items')) == ITEMS
+    assert list(iter_json_items(chunked(body, size))) == [1]
+
+@pytest.mark.parametrize('size', [1, 5, 4096])
+def test_object_without_array_is_yielded_whole(size):
+    document = {'OverallHealth': 'Healthy', 'Counts': {'Healthy': 2}, 'Name': u'café'}
+    body = json.dumps(document).encode('utf-8')
+    assert list(iter_json_items(chunked(body, size))) == [document]
+    assert list(iter_json_items(chunked(b'{"Items": [1, 2]}', size), key='Missing')) == [{'Items': [1, 2]}]
+    assert list(iter_json_items([b'{}'])) == [{}]
+
+def test_number_at_a_chunk_boundary_is_not_truncated():
+    assert list(iter_json_items([b'[12', b'34', b'5]'])) == [12345]
+    assert list(iter_json_items([b'12', b'345'])) == [12345]
+
+def test_empty_body_yields_nothing():
+    assert list(iter_json_items([])) == []
+    assert list(iter_json_items([b'', b'  '])) == []
+
+def test_truncated_body_raises():
+    with pytest.raises(StreamingDecodeError):
+        list(iter_json_items([b'[{"a": 1}, {"b"']))
+
+def test_item_larger_than_buffer_raises():
+    with pytest.raises(StreamingDecodeError):
+        list(iter_json_items(chunked(json.dumps(['x' * 1000]).encode('utf-8'), 10), max_buffer=100))
+
+def test_streamed_query_matches_whole_response(server, client):
+    em_session = client(server)
+    assert list(em_session.iter_instances()) == em_session.get_instances()
@@ -0,0 +1,16 @@
+""" Copyright (c) Trainline Limited, 2016. All rights reserved. See LICENSE.txt in the project root for license information. """
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import logging
+from environment_manager.utils import LogWrapper
+
+def test_wrapper_prefixes_only_its_own_records(caplog):
+    log = LogWrapper('environment_manager.tests')
+    with caplog.at_level(logging.INFO, logger='environment_manager.tests'):
+        log.info('read %s items', 3)
+        logging.getLogger('environment_manager.tests').info('plain %s', 'record')
+    wrapped, plain = caplog.records
+    assert wrapped.getMessage() == 'test_wrapper_prefixes_only_its_own_records - read 3 items'
+    assert wrapped.em_caller == wrapped.funcName == 'test_wrapper_prefixes_only_its_own_records'
+    assert plain.getMessage() == 'plain record'
+    assert not hasattr(plain, 'em_caller')